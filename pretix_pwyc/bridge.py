@@ -0,0 +1,177 @@
+"""
+Native pricing mode: the PWYC configuration of an item is mapped onto pretix' own free price
+input, so custom prices are handled by pretix' cart and tax code and no plugin code runs when
+carts are priced. The plugin only serves the explanation text from the configuration snapshot.
+
+The minimum becomes the item's default price and the suggested amount its suggested price.
+The prices the items had before are kept on their configuration and restored when PWYC is
+disabled for an item or the mode is turned off.
+"""
+from decimal import Decimal
+
+from django.db import transaction
+from pretix.base.models import Item, ItemVariation
+
+from .config import ItemConfig, _merge, invalidate_config
+from .log import get_logger
+from .models import PWYCItemConfig, PWYCVariationConfig
+
+logger = get_logger(__name__, 'general')
+
+ITEM_FIELDS = ('free_price', 'default_price', 'free_price_suggestion')
+VARIATION_FIELDS = ('default_price', 'free_price_suggestion')
+
+
+def native_pricing(event):
+    """
+    Whether the PWYC configuration of ``event`` is mapped onto pretix' free price input. On
+    the storefront, ``ConfigSnapshot.native`` tells the same from the items' recorded prices
+    without a settings lookup.
+    """
+    return event.settings.get('pwyc_native_pricing', False, as_type=bool)
+
+
+def _str(value):
+    return str(value) if value is not None else None
+
+
+def _decimal(value):
+    return Decimal(value) if value is not None else None
+
+
+def _original_prices(item, variations):
+    return {
+        'default_price': _str(item.default_price),
+        'free_price': item.free_price,
+        'free_price_suggestion': _str(item.free_price_suggestion),
+        'variations': {
+            str(v.pk): [_str(v.default_price), _str(v.free_price_suggestion)] for v in variations
+        },
+    }
+
+
+def _map(config, item, variations, variation_fields):
+    """Set the free price fields of an item and its variations from its PWYC configuration"""
+    original = config.native_prices
+    item.free_price = True
+    item.default_price = config.min_amount or Decimal('0.00')
+    item.free_price_suggestion = config.suggested_amount
+    base = ItemConfig(True, config.min_amount, config.suggested_amount, '')
+    for variation in variations:
+        fields = variation_fields.get(variation.pk)
+        if fields is None:
+            # Use the minimum and suggestion of the item
+            variation.default_price = variation.free_price_suggestion = None
+            continue
+        merged = _merge(base, *fields)
+        if not merged.enabled:
+            # pretix' free price input is on for all variations or none, the variation keeps
+            # its original price as the minimum
+            price, _ = original['variations'].get(str(variation.pk), (None, None))
+            variation.default_price = _decimal(price) or _decimal(original['default_price'])
+            variation.free_price_suggestion = None
+            continue
+        variation.default_price = merged.min_amount or Decimal('0.00')
+        variation.free_price_suggestion = merged.suggested_amount
+
+
+def _restore(config, item, variations):
+    """Set the prices of an item and its variations back to the ones recorded on ``config``"""
+    original = config.native_prices
+    item.default_price = _decimal(original['default_price'])
+    item.free_price = original['free_price']
+    item.free_price_suggestion = _decimal(original['free_price_suggestion'])
+    for variation in variations:
+        price, suggestion = original['variations'].get(str(variation.pk), (None, None))
+        variation.default_price = _decimal(price)
+        variation.free_price_suggestion = _decimal(suggestion)
+    config.native_prices = {}
+
+
+def _save(event, configs, items, variations):
+    with transaction.atomic():
+        Item.objects.bulk_update(items, ITEM_FIELDS, batch_size=500)
+        ItemVariation.objects.bulk_update(variations, VARIATION_FIELDS, batch_size=500)
+        PWYCItemConfig.objects.bulk_update(configs, ['native_prices'], batch_size=500)
+    # Item.save() clears the cached product lists, bulk updates do not
+    event.cache.clear()
+    invalidate_config(event)
+
+
+def sync_native_pricing(event, item_ids=None):
+    """
+    Write the PWYC configuration of the items of ``event``, or of ``item_ids``, onto their free
+    price fields, and restore the prices of items PWYC was disabled for. The configuration is
+    read from the database, as the snapshot is not updated before the transaction commits.
+    Returns the number of items written.
+    """
+    configs = PWYCItemConfig.objects.filter(event=event).select_related('item').prefetch_related('item__variations')
+    variation_configs = PWYCVariationConfig.objects.filter(event=event)
+    if item_ids is not None:
+        configs = configs.filter(item_id__in=item_ids)
+        variation_configs = variation_configs.filter(item_id__in=item_ids)
+    variation_fields = {
+        variation_id: (enabled, min_amount, suggested_amount)
+        for variation_id, enabled, min_amount, suggested_amount in variation_configs.values_list(
+            'variation_id', 'enabled', 'min_amount', 'suggested_amount'
+        )
+    }
+
+    changed, items, variations = [], [], []
+    for config in configs:
+        item = config.item
+        item_variations = list(item.variations.all())
+        if config.enabled:
+            if not config.native_prices:
+                config.native_prices = _original_prices(item, item_variations)
+            _map(config, item, item_variations, variation_fields)
+        elif config.native_prices:
+            _restore(config, item, item_variations)
+        else:
+            continue
+        changed.append(config)
+        items.append(item)
+        variations += item_variations
+
+    if changed:
+        _save(event, changed, items, variations)
+        logger.info("PWYC: Mapped the configuration of %d items of event %s to free prices", len(items), event.pk)
+    return len(items)
+
+
+def restore_plugin_pricing(event):
+    """Restore the prices of all items of ``event`` that were mapped onto free prices"""
+    configs = list(
+        PWYCItemConfig.objects.filter(event=event).exclude(native_prices={}).select_related('item').prefetch_related(
+            'item__variations'
+        )
+    )
+    items, variations = [], []
+    for config in configs:
+        item_variations = list(config.item.variations.all())
+        _restore(config, config.item, item_variations)
+        items.append(config.item)
+        variations += item_variations
+
+    if configs:
+        _save(event, configs, items, variations)
+        logger.info("PWYC: Restored the prices of %d items of event %s", len(items), event.pk)
+    return len(items)
+
+
+def convert_event(event, native):
+    """Turn the native pricing mode of ``event`` on or off and convert its items accordingly"""
+    with transaction.atomic():
+        event.settings.set('pwyc_native_pricing', native)
+        if native:
+            return sync_native_pricing(event)
+        return restore_plugin_pricing(event)
+
+
+def schedule_sync(event, item_ids=None):
+    """
+    Map changed configurations onto free prices once the current transaction commits, after
+    pretix has saved the item form of the same request. Does nothing outside the native mode.
+    """
+    if native_pricing(event):
+        transaction.on_commit(lambda: sync_native_pricing(event, item_ids))
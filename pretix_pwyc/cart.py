@@ -0,0 +1,67 @@
+from pretix.base.models import CartPosition
+
+from .log import get_logger
+from .storage import lookup_price
+
+logger = get_logger(__name__, 'fee_calculation')
+
+#: Fields of a cart position written when a custom price is applied to it
+STAMPED_FIELDS = (
+    'price_after_voucher', 'custom_price_input', 'custom_price_input_is_net', 'line_price_gross', 'price', 'meta_info',
+)
+
+
+def is_stamped(position):
+    """
+    Whether a custom price has been written onto a cart position. The price is kept in
+    ``custom_price_input`` and ``price_after_voucher``, so pretix' own price computations carry
+    it along. The original price stays in ``listed_price``, which pretix sets when the
+    product is added, and is recorded as ``pwyc_original_price`` in the position's meta
+    information, which pretix copies onto the order position.
+    """
+    return position.custom_price_input is not None and position.price_after_voucher == position.custom_price_input
+
+
+def stamp_positions(positions, prices, snapshot):
+    """
+    Write the chosen prices onto the PWYC positions among ``positions`` with one batched
+    update. Prices below the minimum of the position's variation and date are not applied.
+    Returns the changed positions.
+    """
+    changed = []
+    for pos in positions:
+        if not snapshot.is_enabled(pos.item_id, pos.subevent_id, pos.variation_id):
+            continue
+        price = lookup_price(prices, pos.item_id, pos.variation_id)
+        if price is None:
+            continue
+        minimum = snapshot.get(pos.item_id, pos.subevent_id, pos.variation_id).min_amount
+        if minimum is not None and price < minimum:
+            # Prices are validated against the loosest minimum of all dates when they are set
+            logger.detail(
+                "PWYC: Custom price %s of item %s is below the minimum of date %s", price, pos.item_id, pos.subevent_id
+            )
+            continue
+        if is_stamped(pos) and pos.custom_price_input == price and pos.price == price:
+            continue
+        meta = pos.meta_info_data
+        if pos.listed_price is not None or 'pwyc_original_price' not in meta:
+            original = pos.listed_price if pos.listed_price is not None else pos.price
+            pos.meta_info_data = {**meta, 'pwyc_original_price': str(original)}
+        pos.price_after_voucher = pos.custom_price_input = pos.line_price_gross = pos.price = price
+        pos.custom_price_input_is_net = False
+        changed.append(pos)
+
+    if changed:
+        CartPosition.objects.bulk_update([pos for pos in changed if pos.pk], STAMPED_FIELDS)
+    return changed
+
+
+def stamp_cart(event, cart_id, prices, snapshot):
+    """Write changed prices onto the positions already in a cart"""
+    if not cart_id or not prices:
+        return []
+    positions = CartPosition.objects.filter(
+        event=event, cart_id=cart_id, item_id__in={item_id for item_id, _ in prices}
+    )
+    return stamp_positions(positions, prices, snapshot)
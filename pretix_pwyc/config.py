@@ -0,0 +1,526 @@
+import threading
+import time
+from collections import Counter, OrderedDict, namedtuple
+from contextlib import contextmanager
+from contextvars import ContextVar
+from types import MappingProxyType
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import BooleanField, ExpressionWrapper, F, IntegerField, Q, Value
+
+from .models import PWYCItemConfig, PWYCSubEventConfig, PWYCVariationConfig
+
+ItemConfig = namedtuple('ItemConfig', ('enabled', 'min_amount', 'suggested_amount', 'explanation'))
+
+_UNCONFIGURED = ItemConfig(False, None, None, '')
+
+
+def _merge(config, enabled, min_amount, suggested_amount):
+    """Apply the non-empty fields of an override to an ItemConfig"""
+    return config._replace(
+        enabled=config.enabled if enabled is None else enabled,
+        min_amount=config.min_amount if min_amount is None else min_amount,
+        suggested_amount=config.suggested_amount if suggested_amount is None else suggested_amount,
+    )
+
+
+def _loosest(configs):
+    """Enabled configuration with the lowest minimum of a list of enabled configurations"""
+    minimums = [c.min_amount for c in configs]
+    return configs[0]._replace(enabled=True, min_amount=None if None in minimums else min(minimums))
+
+
+class BoundedCache(OrderedDict):
+    """Dictionary that drops the entries added first once it holds more than ``maxsize``"""
+
+    def __init__(self, maxsize):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        while len(self) > self.maxsize:
+            try:
+                self.popitem(last=False)
+            except KeyError:
+                # Emptied by another thread
+                break
+
+
+def _max_fragments():
+    return settings.CONFIG_FILE.getint('pretix_pwyc', 'fragment_cache_size', fallback=1024)
+
+
+class ConfigSnapshot:
+    """
+    Immutable view of the PWYC configuration of all items of an event.
+
+    The snapshot contains every configured item of the event, so an item id that is
+    not part of it is known not to be PWYC-enabled without any further lookup.
+
+    Variation and subevent overrides are merged with the item defaults when the snapshot
+    is built, so the effective configuration of an item, variation and date is at most two
+    dictionary lookups, however many variations and dates the event has. On a date, the
+    override of the date takes precedence over the one of the variation.
+
+    ``native`` tells whether the event uses pretix' free price input instead of the price
+    widget, see bridge.py.
+
+    ``fragments`` holds HTML rendered from this version of the configuration, see
+    fragments.py, up to ``fragment_cache_size`` entries. It is dropped together with the
+    snapshot.
+    """
+    __slots__ = (
+        'event_id', 'version', '_configs', '_variations', '_item_variations', '_overrides', '_override_fields',
+        '_subevent_items', '_permissive', 'native', 'fragments',
+    )
+
+    def __init__(self, event_id, version, configs, overrides=None, variations=None, native=False):
+        """
+        ``overrides`` and ``variations`` map ``(subevent_id, item_id)`` and ``(item_id, variation_id)``
+        to the ``(enabled, min_amount, suggested_amount)`` fields of the override, None meaning
+        the field is not overridden
+        """
+        self.event_id = event_id
+        self.version = version
+        self.native = native
+        self._configs = MappingProxyType(configs)
+        self._override_fields = MappingProxyType(overrides or {})
+        self._overrides = MappingProxyType({
+            (subevent_id, item_id): _merge(configs.get(item_id, _UNCONFIGURED), *fields)
+            for (subevent_id, item_id), fields in self._override_fields.items()
+        })
+        self._variations = MappingProxyType({
+            (item_id, variation_id): _merge(configs.get(item_id, _UNCONFIGURED), *fields)
+            for (item_id, variation_id), fields in (variations or {}).items()
+        })
+        self._item_variations = {}
+        for item_id, variation_id in self._variations:
+            self._item_variations.setdefault(item_id, []).append(variation_id)
+        self._subevent_items = {}
+        for subevent_id, item_id in self._overrides:
+            self._subevent_items.setdefault(subevent_id, []).append(item_id)
+
+        permissive = {}
+        for (subevent_id, item_id), config in self._overrides.items():
+            if config.enabled:
+                permissive.setdefault(item_id, []).append(config)
+        self._permissive = {}
+        for item_id, configs_on_dates in permissive.items():
+            base = self._configs.get(item_id)
+            if base is not None and base.enabled:
+                configs_on_dates.append(base)
+            self._permissive[item_id] = _loosest(configs_on_dates)
+        self.fragments = BoundedCache(_max_fragments())
+
+    def __len__(self):
+        return len(self._configs)
+
+    def get(self, item_id, subevent_id=None, variation_id=None):
+        """
+        Return the ItemConfig of an item, for a variation and on a date if given, or None if
+        it has no PWYC configuration
+        """
+        config = self._variations.get((item_id, variation_id)) if variation_id is not None else None
+        if config is not None:
+            if subevent_id is not None:
+                fields = self._override_fields.get((subevent_id, item_id))
+                if fields is not None:
+                    return _merge(config, *fields)
+            return config
+        if subevent_id is not None:
+            config = self._overrides.get((subevent_id, item_id))
+            if config is not None:
+                return config
+        return self._configs.get(item_id)
+
+    def get_permissive(self, item_id, variation_id=None):
+        """
+        Return the loosest configuration of an item (or variation) across all dates: enabled
+        if it is enabled on any of them, with the lowest minimum. Used where the date is not
+        known.
+        """
+        config = self.get(item_id, variation_id=variation_id)
+        loosest = self._permissive.get(item_id)
+        if loosest is None:
+            return config
+        if config is None or not config.enabled:
+            return loosest
+        return _loosest([config, loosest])
+
+    def has_date_overrides(self, subevent_id):
+        """Whether the configuration of any item is overridden on the date ``subevent_id``"""
+        return subevent_id in self._subevent_items
+
+    def is_enabled(self, item_id, subevent_id=None, variation_id=None):
+        config = self.get(item_id, subevent_id, variation_id)
+        return config is not None and config.enabled
+
+    def has_variation_configs(self, item_id):
+        """Whether the variations of an item are configured, and priced, one by one"""
+        return item_id in self._item_variations
+
+    def variation_ids(self, item_id):
+        """Return the configured variations of an item"""
+        return self._item_variations.get(item_id, [])
+
+    def enabled_item_ids(self, subevent_id=None):
+        """
+        Return the items PWYC is enabled for, or for one of their variations, on a date, or
+        without ``subevent_id`` on any date
+        """
+        if subevent_id is None:
+            return list(dict.fromkeys(
+                [item_id for item_id, config in self._configs.items() if config.enabled]
+                + list(self._permissive)
+                + [item_id for (item_id, _), config in self._variations.items() if config.enabled]
+            ))
+        item_ids = dict.fromkeys(
+            list(self._configs) + self._subevent_items.get(subevent_id, []) + list(self._item_variations)
+        )
+        return [
+            item_id for item_id in item_ids
+            if self.is_enabled(item_id, subevent_id) or any(
+                self.is_enabled(item_id, subevent_id, variation_id) for variation_id in self.variation_ids(item_id)
+            )
+        ]
+
+
+_snapshots = OrderedDict()
+_snapshots_lock = threading.Lock()
+
+
+def _max_snapshots():
+    return settings.CONFIG_FILE.getint('pretix_pwyc', 'snapshot_cache_size', fallback=256)
+
+
+def _version_key(event_id):
+    return f'pretix_pwyc:config_version:{event_id}'
+
+
+def _new_version():
+    return time.time_ns()
+
+
+def get_config_version(event_id):
+    """
+    Return the current configuration version of an event from the shared cache.
+
+    If the shared cache has no version (evicted, or no real cache configured), a new one is
+    created, which forces every worker to rebuild its snapshot.
+    """
+    version = cache.get(_version_key(event_id))
+    if version is None:
+        version = _new_version()
+        if not cache.add(_version_key(event_id), version, timeout=None):
+            version = cache.get(_version_key(event_id), version)
+    return version
+
+
+_ITEM, _SUBEVENT, _VARIATION = 0, 1, 2
+
+
+def _build_snapshot(event_id, version):
+    """
+    Read the item configurations and the subevent and variation overrides of an event with
+    one query and build the snapshot from them. The event uses the native pricing mode if its
+    enabled items have their original prices recorded, see bridge.py.
+    """
+    columns = ('kind', 'item_id', 'other_id', 'enabled', 'min_amount', 'suggested_amount', 'text', 'native')
+    rows = PWYCItemConfig.objects.filter(event_id=event_id).annotate(
+        kind=Value(_ITEM), other_id=Value(None, output_field=IntegerField()), text=F('explanation'),
+        native=ExpressionWrapper(~Q(native_prices={}), output_field=BooleanField()),
+    ).values_list(*columns).union(
+        PWYCSubEventConfig.objects.filter(event_id=event_id).annotate(
+            kind=Value(_SUBEVENT), other_id=F('subevent_id'), text=Value(''), native=Value(False),
+        ).values_list(*columns),
+        PWYCVariationConfig.objects.filter(event_id=event_id).annotate(
+            kind=Value(_VARIATION), other_id=F('variation_id'), text=Value(''), native=Value(False),
+        ).values_list(*columns),
+        all=True,
+    )
+    configs, overrides, variations = {}, {}, {}
+    native = False
+    for kind, item_id, other_id, enabled, min_amount, suggested_amount, explanation, item_native in rows:
+        if kind == _ITEM:
+            configs[item_id] = ItemConfig(enabled, min_amount, suggested_amount, explanation)
+            native = native or bool(enabled and item_native)
+        elif kind == _SUBEVENT:
+            overrides[(other_id, item_id)] = (enabled, min_amount, suggested_amount)
+        else:
+            variations[(item_id, other_id)] = (enabled, min_amount, suggested_amount)
+    return ConfigSnapshot(event_id, version, configs, overrides, variations, native)
+
+
+class RequestConfigCache:
+    """
+    Memo of the configuration snapshots used while handling one request.
+
+    All signal receivers running for the same request share it, so the snapshot of an event
+    is fetched (version check plus, if outdated, one bulk query) at most once per request.
+    """
+    __slots__ = ('snapshots', 'lookups', 'fetches')
+
+    def __init__(self):
+        self.snapshots = {}
+        self.lookups = 0
+        self.fetches = 0
+
+    def snapshot(self, event):
+        self.lookups += 1
+        snapshot = self.snapshots.get(event.pk)
+        if snapshot is None:
+            self.fetches += 1
+            snapshot = self.snapshots[event.pk] = _load_snapshot(event)
+        return snapshot
+
+
+_request_cache = ContextVar('pretix_pwyc_request_cache', default=None)
+
+#: Process-wide totals of the request memos, for tests and production sampling
+request_cache_stats = Counter()
+_request_cache_stats_lock = threading.Lock()
+
+
+def get_request_cache():
+    """Return the memo of the request currently being handled, or None"""
+    return _request_cache.get()
+
+
+def begin_request_cache():
+    return _request_cache.set(RequestConfigCache())
+
+
+def end_request_cache(token=None):
+    memo = _request_cache.get()
+    if token is not None:
+        _request_cache.reset(token)
+    else:
+        _request_cache.set(None)
+    if memo is None or not memo.lookups:
+        return
+    with _request_cache_stats_lock:
+        request_cache_stats['requests'] += 1
+        request_cache_stats['lookups'] += memo.lookups
+        request_cache_stats['fetches'] += memo.fetches
+        request_cache_stats['max_fetches_per_request'] = max(
+            request_cache_stats['max_fetches_per_request'], memo.fetches
+        )
+
+
+@contextmanager
+def request_cache():
+    """Share configuration lookups within a block of code, e.g. outside of a request"""
+    token = begin_request_cache()
+    try:
+        yield _request_cache.get()
+    finally:
+        end_request_cache(token)
+
+
+def _load_snapshot(event):
+    version = get_config_version(event.pk)
+    with _snapshots_lock:
+        snapshot = _snapshots.get(event.pk)
+        if snapshot is not None and snapshot.version == version:
+            _snapshots.move_to_end(event.pk)
+            return snapshot
+
+    snapshot = _build_snapshot(event.pk, version)
+    with _snapshots_lock:
+        _snapshots[event.pk] = snapshot
+        _snapshots.move_to_end(event.pk)
+        while len(_snapshots) > _max_snapshots():
+            _snapshots.popitem(last=False)
+    return snapshot
+
+
+def get_config_snapshot(event, refresh=False):
+    """
+    Return the PWYC configuration snapshot of an event, building it if it is missing or outdated.
+
+    Within a request, the snapshot is taken from the request memo, unless ``refresh`` is set.
+    """
+    memo = _request_cache.get()
+    if memo is not None and not refresh:
+        return memo.snapshot(event)
+    snapshot = _load_snapshot(event)
+    if memo is not None:
+        memo.snapshots[event.pk] = snapshot
+    return snapshot
+
+
+def get_item_config(event, item):
+    """Return the ItemConfig of an item, or None"""
+    return get_config_snapshot(event).get(item.pk)
+
+
+def invalidate_config(event):
+    """
+    Bump the configuration version of an event once the current transaction commits, so all
+    workers drop their snapshot of it on their next lookup.
+    """
+    event_id = getattr(event, 'pk', event)
+    memo = _request_cache.get()
+    if memo is not None:
+        memo.snapshots.pop(event_id, None)
+
+    def bump():
+        with _snapshots_lock:
+            _snapshots.pop(event_id, None)
+        cache.set(_version_key(event_id), _new_version(), timeout=None)
+
+    transaction.on_commit(bump)
+
+
+def _copy_native_prices(native_prices, variation_map):
+    """Original prices recorded by the native pricing mode, for the copies of the variations"""
+    if not native_prices:
+        return {}
+    return dict(native_prices, variations={
+        str(getattr(variation_map[int(variation_id)], 'pk', variation_map[int(variation_id)])): prices
+        for variation_id, prices in native_prices.get('variations', {}).items()
+        if int(variation_id) in variation_map
+    })
+
+
+def _copy_item_configs(event_id, item_map, variation_map):
+    configs = [
+        PWYCItemConfig(
+            event_id=event_id,
+            item_id=getattr(item_map[item_id], 'pk', item_map[item_id]),
+            enabled=True,
+            min_amount=min_amount,
+            suggested_amount=suggested_amount,
+            explanation=explanation,
+            native_prices=_copy_native_prices(native_prices, variation_map),
+        )
+        for item_id, min_amount, suggested_amount, explanation, native_prices in PWYCItemConfig.objects.filter(
+            item_id__in=list(item_map), enabled=True
+        ).values_list('item_id', 'min_amount', 'suggested_amount', 'explanation', 'native_prices')
+    ]
+    if configs:
+        PWYCItemConfig.objects.filter(item_id__in=[c.item_id for c in configs]).delete()
+        PWYCItemConfig.objects.bulk_create(configs, batch_size=500)
+    return len(configs)
+
+
+def copy_item_configs(event, item_map, variation_map=None):
+    """
+    Copy the configuration of all PWYC-enabled items in ``item_map`` (source item id to target
+    item) to the corresponding target items of ``event``, replacing their configuration.
+    Original prices recorded by the native pricing mode are kept for the variations in
+    ``variation_map``.
+
+    The source configurations are read with one query and written in one transaction, and
+    the configuration of the target event is invalidated once.
+    """
+    event_id = getattr(event, 'pk', event)
+    with transaction.atomic():
+        copied = _copy_item_configs(event_id, item_map, variation_map or {})
+    if copied:
+        invalidate_config(event_id)
+    return copied
+
+
+def save_item_configs(event, configs):
+    """
+    Store a batch of PWYCItemConfig instances of ``event``: existing ones are updated and new
+    ones created, each with one batched statement, in one transaction. The configuration of
+    the event is invalidated once.
+    """
+    if not configs:
+        return 0
+
+    with transaction.atomic():
+        PWYCItemConfig.objects.bulk_update(
+            [c for c in configs if c.pk],
+            ['enabled', 'min_amount', 'suggested_amount', 'explanation'],
+            batch_size=500,
+        )
+        PWYCItemConfig.objects.bulk_create([c for c in configs if not c.pk], batch_size=500)
+    invalidate_config(event)
+    return len(configs)
+
+
+def save_subevent_configs(event, subevents, overrides):
+    """
+    Replace the overrides of ``subevents`` with ``overrides``, a list of PWYCSubEventConfig
+    instances without subevent. Every subevent gets a copy of each of them, written with one
+    batched insert, and the configuration of the event is invalidated once.
+    """
+    subevents = list(subevents)
+    if not subevents:
+        return 0
+    event_id = getattr(event, 'pk', event)
+    configs = [
+        PWYCSubEventConfig(
+            event_id=event_id,
+            subevent=subevent,
+            item_id=override.item_id,
+            enabled=override.enabled,
+            min_amount=override.min_amount,
+            suggested_amount=override.suggested_amount,
+        )
+        for subevent in subevents
+        for override in overrides
+    ]
+    with transaction.atomic():
+        PWYCSubEventConfig.objects.filter(subevent__in=subevents).delete()
+        PWYCSubEventConfig.objects.bulk_create(configs, batch_size=500)
+    invalidate_config(event_id)
+    return len(configs)
+
+
+def save_variation_configs(event, item, overrides):
+    """
+    Replace the variation overrides of ``item`` with ``overrides``, a list of unsaved
+    PWYCVariationConfig instances, in one transaction and with one batched insert
+    """
+    event_id = getattr(event, 'pk', event)
+    for override in overrides:
+        override.event_id = event_id
+        override.item = item
+    with transaction.atomic():
+        PWYCVariationConfig.objects.filter(item=item).delete()
+        PWYCVariationConfig.objects.bulk_create(overrides, batch_size=500)
+    invalidate_config(event_id)
+    return len(overrides)
+
+
+def _copy_variation_configs(event_id, item_map, variation_map):
+    configs = [
+        PWYCVariationConfig(
+            event_id=event_id,
+            item_id=getattr(item_map[item_id], 'pk', item_map[item_id]),
+            variation_id=getattr(variation_map[variation_id], 'pk', variation_map[variation_id]),
+            enabled=enabled,
+            min_amount=min_amount,
+            suggested_amount=suggested_amount,
+        )
+        for item_id, variation_id, enabled, min_amount, suggested_amount in PWYCVariationConfig.objects.filter(
+            item_id__in=list(item_map)
+        ).values_list('item_id', 'variation_id', 'enabled', 'min_amount', 'suggested_amount')
+        if variation_id in variation_map
+    ]
+    PWYCVariationConfig.objects.bulk_create(configs, batch_size=500)
+    return len(configs)
+
+
+def copy_event_configs(event, item_map, variation_map=None):
+    """
+    Copy the item configurations and variation overrides of the items in ``item_map`` to the
+    corresponding items and variations of ``event``, see copy_item_configs. Both are written
+    in one transaction, so a copy is never left without its variation overrides, and the
+    configuration of the event is invalidated once.
+    """
+    event_id = getattr(event, 'pk', event)
+    variation_map = variation_map or {}
+    with transaction.atomic():
+        copied = _copy_item_configs(event_id, item_map, variation_map)
+        copied += _copy_variation_configs(event_id, item_map, variation_map)
+    if copied:
+        invalidate_config(event_id)
+    return copied
@@ -0,0 +1,164 @@
+import io
+import json
+from collections import OrderedDict
+from decimal import Decimal
+
+from django import forms
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Count, Max, Min, Q, Sum
+from django.utils.translation import gettext_lazy as _, pgettext_lazy
+from pretix.base.decimal import round_decimal
+from pretix.base.exporter import ListExporter
+from pretix.base.models import ItemVariation, Order, OrderPosition
+
+from .models import PWYCItemConfig
+
+#: Positions fetched from the database at a time
+CHUNK_SIZE = 2000
+
+
+def _original_price(meta_info):
+    # The position's meta_info is a JSON-encoded text column
+    if not meta_info or 'pwyc_original_price' not in meta_info:
+        return None
+    try:
+        value = json.loads(meta_info).get('pwyc_original_price')
+        return Decimal(value) if value is not None else None
+    except (ValueError, TypeError, AttributeError, ArithmeticError):
+        return None
+
+
+class PWYCPositionsExporter(ListExporter):
+    """
+    Exports all order positions of PWYC items with their original and paid price.
+
+    Positions are read in chunks and written as they are read, totals are computed by the
+    database, so the memory needed does not depend on the size of the event.
+    """
+    identifier = 'pwyc_positions'
+    verbose_name = _('Pay What You Can prices')
+    category = pgettext_lazy('export_category', 'Order data')
+    description = _('Download the original and paid price of all order positions of Pay What You Can products.')
+    repeatable_read = False
+
+    @property
+    def export_form_fields(self):
+        form_fields = super().export_form_fields
+        format_field = form_fields['_format']
+        format_field.choices = list(format_field.choices) + [('json', _('JSON'))]
+        form_fields['status'] = forms.MultipleChoiceField(
+            label=_('Order status'),
+            choices=Order.STATUS_CHOICE,
+            initial=[Order.STATUS_PAID, Order.STATUS_PENDING],
+            widget=forms.CheckboxSelectMultiple,
+            required=False,
+            help_text=_('Leave empty to export orders of any status.'),
+        )
+        return OrderedDict(form_fields)
+
+    def get_filename(self):
+        return f'{self.event.slug}_pwyc_prices'
+
+    def get_queryset(self, form_data):
+        pwyc_items = PWYCItemConfig.objects.filter(event=self.event).values('item_id')
+        qs = OrderPosition.objects.filter(order__event=self.event).filter(
+            Q(item_id__in=pwyc_items) | Q(meta_info__contains='pwyc_original_price')
+        )
+        if form_data.get('status'):
+            qs = qs.filter(order__status__in=form_data['status'])
+        return qs
+
+    def get_totals(self, qs):
+        totals = qs.aggregate(
+            count=Count('id'),
+            paid_sum=Sum('price'),
+            paid_min=Min('price'),
+            paid_max=Max('price'),
+        )
+        totals['paid_sum'] = totals['paid_sum'] or Decimal('0.00')
+        for key in ('paid_sum', 'paid_min', 'paid_max'):
+            if totals[key] is not None:
+                # Some databases return aggregates of decimal columns without their scale
+                totals[key] = round_decimal(totals[key], self.event.currency)
+        return totals
+
+    def iterate_rows(self, qs):
+        """Yield one dictionary per position, reading them from the database in chunks"""
+        items = {item.pk: str(item.name) for item in self.event.items.all()}
+        variations = {
+            v.pk: str(v.value) for v in ItemVariation.objects.filter(item__event=self.event)
+        }
+        statuses = dict(Order.STATUS_CHOICE)
+        rows = qs.order_by('order__datetime', 'order_id', 'positionid').values_list(
+            'order__code', 'order__status', 'order__datetime', 'positionid', 'item_id', 'variation_id',
+            'price', 'meta_info', 'variation__default_price', 'item__default_price',
+        ).iterator(chunk_size=CHUNK_SIZE)
+        for code, status, datetime, positionid, item_id, variation_id, price, meta_info, variation_price, item_price in rows:
+            original_price = _original_price(meta_info)
+            if original_price is None:
+                original_price = variation_price if variation_price is not None else item_price
+            yield {
+                'order': code,
+                'position': positionid,
+                'status': str(statuses.get(status, status)),
+                'datetime': datetime.astimezone(self.timezone),
+                'item_id': item_id,
+                'item': items.get(item_id, ''),
+                'variation_id': variation_id,
+                'variation': variations.get(variation_id, ''),
+                'original_price': original_price,
+                'price': price,
+            }
+
+    def iterate_list(self, form_data):
+        qs = self.get_queryset(form_data)
+        totals = self.get_totals(qs)
+        yield self.ProgressSetTotal(total=totals['count'])
+        yield [
+            _('Order code'), _('Position ID'), _('Order status'), _('Order date'), _('Product'),
+            _('Variation'), _('Original price'), _('Paid price'), _('Difference'),
+        ]
+        for row in self.iterate_rows(qs):
+            yield [
+                row['order'], row['position'], row['status'], row['datetime'].strftime('%Y-%m-%d %H:%M:%S'),
+                row['item'], row['variation'], row['original_price'], row['price'],
+                row['price'] - row['original_price'] if row['original_price'] is not None else None,
+            ]
+        yield []
+        yield [_('Positions'), totals['count']]
+        yield [_('Total paid'), totals['paid_sum']]
+        yield [_('Lowest price paid'), totals['paid_min']]
+        yield [_('Highest price paid'), totals['paid_max']]
+
+    def _render_json(self, form_data, output_file=None):
+        if output_file and 'b' in getattr(output_file, 'mode', ''):
+            output = io.TextIOWrapper(output_file, encoding='utf-8', newline='')
+        else:
+            output = output_file or io.StringIO()
+
+        qs = self.get_queryset(form_data)
+        totals = self.get_totals(qs)
+        encoder = DjangoJSONEncoder()
+        output.write('{"event": %s, "currency": %s, "positions": [' % (
+            encoder.encode(self.event.slug), encoder.encode(self.event.currency)
+        ))
+        for i, row in enumerate(self.iterate_rows(qs)):
+            if i:
+                output.write(',')
+            output.write(encoder.encode(row))
+            if totals['count'] and (i + 1) % max(10, totals['count'] // 100) == 0:
+                self.progress_callback((i + 1) / totals['count'] * 100)
+        output.write('], "totals": %s}' % encoder.encode(totals))
+
+        if output_file:
+            output.flush()
+            if output is not output_file:
+                # Do not let the wrapper close the file it was given
+                output.detach()
+            return self.get_filename() + '.json', 'application/json', None
+        return self.get_filename() + '.json', 'application/json', output.getvalue().encode('utf-8')
+
+    def render(self, form_data, output_file=None):
+        if form_data.get('_format') == 'json':
+            return self._render_json(form_data, output_file=output_file)
+        return super().render(form_data, output_file=output_file)
@@ -1,8 +1,51 @@
 from django import forms
 from django.core.validators import MinValueValidator
+from django.db import transaction
 from django.utils.translation import gettext_lazy as _
 from pretix.base.forms import SettingsForm
 
+from .bridge import native_pricing, schedule_sync
+from .config import (
+    get_item_config, invalidate_config, save_item_configs, save_subevent_configs, save_variation_configs,
+)
+from .logentry import item_transition_entries, write_at_commit
+from .models import PWYCItemConfig, PWYCSubEventConfig, PWYCVariationConfig
+
+
+def config_initial(event, item):
+    """Initial form values for the PWYC configuration of an item"""
+    config = get_item_config(event, item)
+    if not config:
+        return {
+            'pwyc_enabled': False,
+            'pwyc_min_amount': None,
+            'pwyc_suggested_amount': None,
+            'pwyc_explanation': event.settings.get('pwyc_explanation_default', ''),
+        }
+    return {
+        'pwyc_enabled': config.enabled,
+        'pwyc_min_amount': config.min_amount,
+        'pwyc_suggested_amount': config.suggested_amount,
+        'pwyc_explanation': config.explanation,
+    }
+
+
+def save_config(event, item, cleaned_data):
+    """Store cleaned form values as the PWYC configuration of an item"""
+    config = PWYCItemConfig.objects.update_or_create(
+        item=item,
+        defaults={
+            'event': event,
+            'enabled': bool(cleaned_data.get('pwyc_enabled', False)),
+            'min_amount': cleaned_data.get('pwyc_min_amount'),
+            'suggested_amount': cleaned_data.get('pwyc_suggested_amount'),
+            'explanation': cleaned_data.get('pwyc_explanation') or '',
+        }
+    )[0]
+    invalidate_config(event)
+    schedule_sync(event, [item.pk])
+    return config
+
 
 class PWYCSettingsForm(SettingsForm):
     """
@@ -14,6 +57,21 @@ class PWYCSettingsForm(SettingsForm):
         widget=forms.Textarea,
         help_text=_('Default text explaining the PWYC option to customers.'),
     )
+    pwyc_native_pricing = forms.BooleanField(
+        label=_("Use pretix' free price input"),
+        required=False,
+        help_text=_(
+            "The minimum and suggested amount of PWYC products are set as their price and suggested price, and "
+            "customers enter their price in pretix' own price field. The original prices are restored when this "
+            "is turned off again. Minimums per date are not applied in this mode, and variations cannot be "
+            "excluded from PWYC, they keep their original price as the minimum."
+        ),
+    )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Settings without a registered default are read back as strings
+        self.initial['pwyc_native_pricing'] = native_pricing(self.obj)
 
 
 class PWYCItemForm(forms.Form):
@@ -55,22 +113,13 @@ class PWYCItemForm(forms.Form):
         super().__init__(*args, **kwargs)
 
         if self.item and self.item.pk:
-            self.initial['pwyc_enabled'] = self.event.settings.get(f'pwyc_enabled_{self.item.pk}', False)
-            self.initial['pwyc_min_amount'] = self.event.settings.get(f'pwyc_min_amount_{self.item.pk}')
-            self.initial['pwyc_suggested_amount'] = self.event.settings.get(f'pwyc_suggested_amount_{self.item.pk}')
-            self.initial['pwyc_explanation'] = self.event.settings.get(
-                f'pwyc_explanation_{self.item.pk}',
-                self.event.settings.get('pwyc_explanation_default', '')
-            )
+            self.initial.update(config_initial(self.event, self.item))
 
     def save(self):
         if not self.item or not self.item.pk:
             return
 
-        self.event.settings.set(f'pwyc_enabled_{self.item.pk}', self.cleaned_data.get('pwyc_enabled', False))
-        self.event.settings.set(f'pwyc_min_amount_{self.item.pk}', self.cleaned_data.get('pwyc_min_amount'))
-        self.event.settings.set(f'pwyc_suggested_amount_{self.item.pk}', self.cleaned_data.get('pwyc_suggested_amount'))
-        self.event.settings.set(f'pwyc_explanation_{self.item.pk}', self.cleaned_data.get('pwyc_explanation'))
+        save_config(self.event, self.item, self.cleaned_data)
 
 
 class PWYCItemSettingsForm(forms.Form):
@@ -115,33 +164,272 @@ class PWYCItemSettingsForm(forms.Form):
         # Load existing values
         if self.event and self.item and self.item.pk:
             if not self.data:  # Only set initial values if no form data
-                self.initial['pwyc_enabled'] = self.event.settings.get(f'pwyc_enabled_{self.item.pk}', False)
-                self.initial['pwyc_min_amount'] = self.event.settings.get(f'pwyc_min_amount_{self.item.pk}')
-                self.initial['pwyc_suggested_amount'] = self.event.settings.get(f'pwyc_suggested_amount_{self.item.pk}')
-                self.initial['pwyc_explanation'] = self.event.settings.get(
-                    f'pwyc_explanation_{self.item.pk}',
-                    self.event.settings.get('pwyc_explanation_default', '')
-                )
+                self.initial.update(config_initial(self.event, self.item))
 
     def save(self):
-        """Save form data to event settings"""
+        """Save form data to the item's PWYC configuration"""
         if not self.event or not self.item or not self.item.pk:
             return
 
-        # Convert boolean to string to avoid pretix settings issues
-        pwyc_enabled = self.cleaned_data.get('pwyc_enabled', False)
+        save_config(self.event, self.item, self.cleaned_data)
+
+
+class PWYCBulkItemForm(PWYCItemSettingsForm):
+    """
+    One row of the bulk editor on the PWYC settings page
+    """
+    item_id = forms.IntegerField(widget=forms.HiddenInput)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['pwyc_explanation'].widget = forms.TextInput()
+        for field in self.fields.values():
+            field.help_text = ''
+
+
+def _item_config(item):
+    try:
+        return item.pwyc_config
+    except PWYCItemConfig.DoesNotExist:
+        return None
+
+
+class PWYCBulkFormSet(forms.BaseFormSet):
+    """
+    Edits the PWYC configuration of all items of an event at once. The items and their
+    configuration are read with one query, only changed rows are written.
+    """
+
+    def __init__(self, *args, event, **kwargs):
+        self.event = event
+        self.items = list(
+            event.items.select_related('pwyc_config', 'category').order_by(
+                'category__position', 'category_id', 'position', 'pk'
+            )
+        )
+        default_explanation = event.settings.get('pwyc_explanation_default', '')
+        initial = []
+        for item in self.items:
+            config = _item_config(item)
+            initial.append({
+                'item_id': item.pk,
+                'pwyc_enabled': config.enabled if config else False,
+                'pwyc_min_amount': config.min_amount if config else None,
+                'pwyc_suggested_amount': config.suggested_amount if config else None,
+                'pwyc_explanation': config.explanation if config else default_explanation,
+            })
+        kwargs.setdefault('prefix', 'items')
+        super().__init__(*args, initial=initial, **kwargs)
+
+    def clean(self):
+        if any(self.errors):
+            return
+        if len(self.forms) != len(self.items) or any(
+            form.cleaned_data.get('item_id') != item.pk for form, item in zip(self.forms, self.items)
+        ):
+            raise forms.ValidationError(_('The products of this event have changed, please reload the page.'))
+
+    def rows(self):
+        return list(zip(self.forms, self.items))
+
+    def save(self, user=None):
+        """
+        Write all changed rows with one batch, log items PWYC was turned on or off for and
+        return the changed configurations
+        """
+        configs = []
+        transitions = []
+        for form, item in zip(self.forms, self.items):
+            if not form.has_changed():
+                continue
+            config = _item_config(item) or PWYCItemConfig(event=self.event, item=item)
+            enabled = bool(form.cleaned_data.get('pwyc_enabled', False))
+            if enabled != config.enabled:
+                transitions.append((item, enabled))
+            config.enabled = enabled
+            config.min_amount = form.cleaned_data.get('pwyc_min_amount')
+            config.suggested_amount = form.cleaned_data.get('pwyc_suggested_amount')
+            config.explanation = form.cleaned_data.get('pwyc_explanation') or ''
+            configs.append(config)
+        save_item_configs(self.event, configs)
+        if configs:
+            schedule_sync(self.event, [config.item_id for config in configs])
+        write_at_commit(item_transition_entries(user, transitions))
+        return configs
+
+
+PWYCBulkItemFormSet = forms.formset_factory(
+    PWYCBulkItemForm, formset=PWYCBulkFormSet, extra=0, max_num=10000, validate_max=True
+)
+
+
+ENABLED_CHOICES = (
+    ('', _('Like the product')),
+    ('on', _('Enabled')),
+    ('off', _('Disabled')),
+)
+
+
+def _enabled_choice(enabled):
+    return {True: 'on', False: 'off'}.get(enabled, '')
+
+
+def _enabled_value(choice):
+    return {'on': True, 'off': False}.get(choice)
+
+
+class PWYCVariationForm(forms.Form):
+    """
+    PWYC override of one variation of an item
+    """
+    variation_id = forms.IntegerField(widget=forms.HiddenInput)
+    enabled = forms.ChoiceField(label=_('Enable Pay What You Can'), choices=ENABLED_CHOICES, required=False)
+    min_amount = forms.DecimalField(label=_('Minimum amount'), required=False, min_value=0)
+    suggested_amount = forms.DecimalField(label=_('Suggested amount'), required=False, min_value=0)
+
 
-        # Store as string instead of boolean to avoid the startswith error
-        self.event.settings.set(f'pwyc_enabled_{self.item.pk}', 'true' if pwyc_enabled else 'false')
+class PWYCVariationFormSet(forms.BaseFormSet):
+    """
+    Overrides of the PWYC configuration of the item for each of its variations, read with
+    one query and written with one batch. Empty fields use the configuration of the item.
+    """
 
-        # Convert None values to empty strings to avoid serialization errors
-        min_amount = self.cleaned_data.get('pwyc_min_amount')
-        suggested_amount = self.cleaned_data.get('pwyc_suggested_amount')
-        explanation = self.cleaned_data.get('pwyc_explanation')
+    def __init__(self, *args, event, item, **kwargs):
+        self.event = event
+        self.item = item
+        self.template = 'pretix_pwyc/item_variations_pwyc.html'
+        self.title = _('Pay What You Can per variation')
+        self.variations = list(item.variations.select_related('pwyc_config').order_by('position', 'pk'))
+        initial = []
+        for variation in self.variations:
+            config = getattr(variation, 'pwyc_config', None)
+            initial.append({
+                'variation_id': variation.pk,
+                'enabled': _enabled_choice(config.enabled) if config else '',
+                'min_amount': config.min_amount if config else None,
+                'suggested_amount': config.suggested_amount if config else None,
+            })
+        kwargs.setdefault('prefix', 'pwycvariations')
+        super().__init__(*args, initial=initial, **kwargs)
+
+    def clean(self):
+        if any(self.errors):
+            return
+        if len(self.forms) != len(self.variations) or any(
+            form.cleaned_data.get('variation_id') != variation.pk for form, variation in zip(self.forms, self.variations)
+        ):
+            raise forms.ValidationError(_('The variations of this product have changed, please reload the page.'))
 
-        self.event.settings.set(f'pwyc_min_amount_{self.item.pk}', str(min_amount) if min_amount is not None else '')
-        self.event.settings.set(f'pwyc_suggested_amount_{self.item.pk}', str(suggested_amount) if suggested_amount is not None else '')
-        self.event.settings.set(f'pwyc_explanation_{self.item.pk}', str(explanation) if explanation is not None else '')
+    def rows(self):
+        return list(zip(self.forms, self.variations))
+
+    def save(self):
+        if not any(form.has_changed() for form in self.forms):
+            return
+        # Variations may have been deleted on the same page, before this formset is saved
+        existing = set(self.item.variations.values_list('pk', flat=True))
+        overrides = []
+        for form, variation in zip(self.forms, self.variations):
+            if variation.pk not in existing:
+                continue
+            enabled = _enabled_value(form.cleaned_data.get('enabled'))
+            min_amount = form.cleaned_data.get('min_amount')
+            suggested_amount = form.cleaned_data.get('suggested_amount')
+            if enabled is None and min_amount is None and suggested_amount is None:
+                continue
+            overrides.append(PWYCVariationConfig(
+                variation=variation, enabled=enabled, min_amount=min_amount, suggested_amount=suggested_amount,
+            ))
+        save_variation_configs(self.event, self.item, overrides)
+        schedule_sync(self.event, [self.item.pk])
+
+
+PWYCVariationConfigFormSet = forms.formset_factory(
+    PWYCVariationForm, formset=PWYCVariationFormSet, extra=0, max_num=10000, validate_max=True
+)
+
+
+class PWYCSubEventForm(forms.Form):
+    """
+    Overrides of the PWYC configuration of all configured items for one date of an event
+    series. Empty fields use the configuration of the item.
+    """
+    def __init__(self, *args, event, subevent=None, copy_from=None, **kwargs):
+        self.event = event
+        self.subevent = subevent
+        self._pending_subevents = []
+        self.template = 'pretix_pwyc/subevent_form.html'
+        self.title = _('Pay What You Can')
+        self.items = list(
+            event.items.filter(pwyc_config__isnull=False).select_related('pwyc_config').order_by(
+                'category__position', 'category_id', 'position', 'pk'
+            )
+        )
+        source = subevent if subevent is not None and subevent.pk else copy_from
+        overrides = {
+            o.item_id: o for o in PWYCSubEventConfig.objects.filter(subevent=source)
+        } if source is not None else {}
+        initial = kwargs.pop('initial', None) or {}
+        for item in self.items:
+            override = overrides.get(item.pk)
+            if override is not None:
+                initial.setdefault(f'enabled_{item.pk}', _enabled_choice(override.enabled))
+                initial.setdefault(f'min_amount_{item.pk}', override.min_amount)
+                initial.setdefault(f'suggested_amount_{item.pk}', override.suggested_amount)
+        super().__init__(*args, initial=initial, **kwargs)
+
+        for item in self.items:
+            config = item.pwyc_config
+            self.fields[f'enabled_{item.pk}'] = forms.ChoiceField(
+                label=_('Enable Pay What You Can'), choices=ENABLED_CHOICES, required=False,
+            )
+            self.fields[f'min_amount_{item.pk}'] = forms.DecimalField(
+                label=_('Minimum amount'), required=False, min_value=0,
+                widget=forms.NumberInput(attrs={'placeholder': config.min_amount if config.min_amount is not None else ''}),
+            )
+            self.fields[f'suggested_amount_{item.pk}'] = forms.DecimalField(
+                label=_('Suggested amount'), required=False, min_value=0,
+                widget=forms.NumberInput(attrs={
+                    'placeholder': config.suggested_amount if config.suggested_amount is not None else ''
+                }),
+            )
+
+    def rows(self):
+        return [
+            (item, self[f'enabled_{item.pk}'], self[f'min_amount_{item.pk}'], self[f'suggested_amount_{item.pk}'])
+            for item in self.items
+        ]
+
+    def overrides(self):
+        """The overrides entered in the form, as unsaved PWYCSubEventConfig instances"""
+        overrides = []
+        for item in self.items:
+            enabled = _enabled_value(self.cleaned_data.get(f'enabled_{item.pk}'))
+            min_amount = self.cleaned_data.get(f'min_amount_{item.pk}')
+            suggested_amount = self.cleaned_data.get(f'suggested_amount_{item.pk}')
+            if enabled is None and min_amount is None and suggested_amount is None:
+                continue
+            overrides.append(PWYCSubEventConfig(
+                item=item, enabled=enabled, min_amount=min_amount, suggested_amount=suggested_amount,
+            ))
+        return overrides
+
+    def save(self):
+        """
+        Replace the overrides of ``self.subevent`` once the current transaction commits. When
+        dates are created in bulk, this is called once per new date with the same data, all
+        dates are written with one batch and one invalidation.
+        """
+        if not hasattr(self, '_overrides'):
+            self._overrides = self.overrides()
+        self._pending_subevents.append(self.subevent)
+        if len(self._pending_subevents) == 1:
+            # Outside of a transaction, this runs at once
+            transaction.on_commit(self._save_pending)
+
+    def _save_pending(self):
+        subevents, self._pending_subevents = self._pending_subevents, []
+        save_subevent_configs(self.event, subevents, self._overrides)
 
 
 class PWYCPriceForm(forms.Form):
@@ -0,0 +1,200 @@
+import threading
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.templatetags.static import static
+from django.urls import reverse
+from django.utils import translation
+from django.utils.html import format_html, json_script
+from pretix.multidomain.urlreverse import eventreverse
+
+from .config import get_config_snapshot
+from .log import get_logger
+
+logger = get_logger(__name__, 'storefront')
+
+#: Process-wide counts of fragment lookups: ``hits`` in process, ``shared_hits`` in the
+#: shared cache and ``misses`` that had to be rendered
+fragment_stats = Counter()
+_fragment_stats_lock = threading.Lock()
+
+SHARED_CACHE_TIMEOUT = 24 * 3600
+
+
+def _count(result):
+    with _fragment_stats_lock:
+        fragment_stats[result] += 1
+
+
+def _shared_key(snapshot, name, locale, currency, subevent_id=None):
+    return (
+        f'pretix_pwyc:fragment:{snapshot.event_id}:{snapshot.version}:{name}:{subevent_id or ""}:{locale}:{currency}'
+    )
+
+
+def _date_key(snapshot, subevent_id):
+    """Date fragments are cached for, all dates without overrides have the same configuration"""
+    if subevent_id is None or snapshot.has_date_overrides(subevent_id):
+        return subevent_id
+    return 'dates'
+
+
+def _render_item(item_id, variation_id=None):
+    if variation_id is not None:
+        return format_html('<div class="pwyc-data pwyc-item-{} pwyc-variation-{}"></div>', item_id, variation_id)
+    return format_html('<div class="pwyc-data pwyc-item-{}"></div>', item_id)
+
+
+def _render_explanation(config):
+    if not config.explanation:
+        return ''
+    return format_html('<div class="pwyc-explanation">{}</div>', config.explanation)
+
+
+def _config_data(config):
+    if config is None:
+        # Items that are only configured per variation
+        return {'min_amount': '', 'suggested_amount': '', 'explanation': ''}
+    return {
+        'min_amount': str(config.min_amount) if config.min_amount is not None else '',
+        'suggested_amount': str(config.suggested_amount) if config.suggested_amount is not None else '',
+        'explanation': config.explanation,
+    }
+
+
+def set_price_endpoint(event):
+    """
+    URL the price widget sends prices to. With ``async_set_price=on`` in the ``[pretix_pwyc]``
+    section of pretix.cfg, the async view is used for events on the main domain, which is the
+    only domain it is mounted on.
+    """
+    endpoint = eventreverse(event, 'plugins:pretix_pwyc:event.set_price')
+    if endpoint.startswith('/') and settings.CONFIG_FILE.getboolean('pretix_pwyc', 'async_set_price', fallback=False):
+        endpoint = reverse('plugins:pretix_pwyc:event.async_set_price', kwargs={
+            'organizer': event.organizer.slug,
+            'event': event.slug,
+        })
+    return endpoint
+
+
+def _render_head(event, snapshot, subevent_id=None):
+    items = {}
+    for item_id in snapshot.enabled_item_ids(subevent_id):
+        items[item_id] = data = _config_data(snapshot.get(item_id, subevent_id))
+        variations = {
+            variation_id: _config_data(snapshot.get(item_id, subevent_id, variation_id))
+            for variation_id in snapshot.variation_ids(item_id)
+            if snapshot.is_enabled(item_id, subevent_id, variation_id)
+        }
+        if variations:
+            data['variations'] = variations
+    if not items:
+        return ''
+
+    data = {
+        'endpoint': set_price_endpoint(event),
+        'currency': event.currency,
+        'items': items,
+    }
+    return json_script(data, 'pwyc-config') + format_html(
+        '<script type="text/javascript" src="{}" defer></script>',
+        static('pretix_pwyc/js/pwyc.min.js')
+    )
+
+
+def item_fragment(event, item_id, snapshot=None, subevent_id=None, variation_id=None):
+    """
+    Return the marker the price widget replaces for a PWYC item or variation, or an empty
+    string. Items with configured variations only get markers for their variations, all
+    other items only one for the item.
+
+    Fragments are cached per (event, item, variation, configuration version), the event and
+    version being implied by the snapshot that holds them. The marker is the same on every
+    date and in every locale.
+
+    In the native pricing mode, pretix shows its own price input and the fragment of an item
+    is its explanation text.
+    """
+    snapshot = snapshot or get_config_snapshot(event)
+    if snapshot.native:
+        config = snapshot.get(item_id)
+        if variation_id is not None or config is None or not config.enabled:
+            return ''
+        key = ('explanation', item_id, translation.get_language())
+        html = snapshot.fragments.get(key)
+        if html is None:
+            html = snapshot.fragments[key] = _render_explanation(config)
+        return html
+    if snapshot.has_variation_configs(item_id) != (variation_id is not None):
+        return ''
+    if not snapshot.is_enabled(item_id, subevent_id, variation_id):
+        return ''
+    key = ('item', item_id, variation_id)
+    html = snapshot.fragments.get(key)
+    if html is not None:
+        _count('hits')
+        return html
+    _count('misses')
+    html = snapshot.fragments[key] = _render_item(item_id, variation_id)
+    return html
+
+
+def head_fragment(event, snapshot=None, subevent_id=None):
+    """
+    Return the configuration block and script tag of the price widget for the page head,
+    with the configuration effective on the date ``subevent_id`` if given.
+
+    The block is cached in process next to the snapshot, and in the shared cache so other
+    workers can use a block pre-rendered elsewhere. Dates without overrides of their own
+    share one block. There is no price widget in the native pricing mode.
+    """
+    snapshot = snapshot or get_config_snapshot(event)
+    if snapshot.native:
+        return ''
+    locale = translation.get_language()
+    date = _date_key(snapshot, subevent_id)
+    key = ('head', date, locale, event.currency)
+    html = snapshot.fragments.get(key)
+    if html is not None:
+        _count('hits')
+        return html
+
+    shared_key = _shared_key(snapshot, 'head', locale, event.currency, date)
+    html = cache.get(shared_key)
+    if html is not None:
+        _count('shared_hits')
+    else:
+        _count('misses')
+        html = _render_head(event, snapshot, subevent_id)
+        cache.set(shared_key, html, timeout=SHARED_CACHE_TIMEOUT)
+    snapshot.fragments[key] = html
+    return html
+
+
+def prewarm_fragments(event):
+    """
+    Render the fragments of all PWYC items of an event in all of its locales. Fragments of
+    single dates of an event series are rendered on first use.
+    """
+    snapshot = get_config_snapshot(event, refresh=True)
+    for locale in event.settings.locales:
+        with translation.override(locale):
+            head_fragment(event, snapshot)
+            for item_id in snapshot.enabled_item_ids():
+                item_fragment(event, item_id, snapshot)
+                for variation_id in snapshot.variation_ids(item_id):
+                    item_fragment(event, item_id, snapshot, variation_id=variation_id)
+    return snapshot
+
+
+def schedule_prewarm(event):
+    """Pre-warm the fragments once the current transaction, and the invalidation in it, is committed"""
+    def prewarm():
+        try:
+            prewarm_fragments(event)
+        except Exception:
+            logger.exception("PWYC: Error pre-warming fragments of event %s", event.pk)
+
+    transaction.on_commit(prewarm)
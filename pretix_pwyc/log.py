@@ -0,0 +1,82 @@
+import logging
+import random
+
+from django.conf import settings
+
+_sample_rates = {}
+
+
+def sample_rate(path):
+    """
+    Return the share of INFO/DEBUG messages logged for a code path, configured in pretix.cfg:
+
+        [pretix_pwyc]
+        log_sample_rate=1.0
+        log_sample_rate_fee_calculation=0.01
+    """
+    if path not in _sample_rates:
+        default = settings.CONFIG_FILE.getfloat('pretix_pwyc', 'log_sample_rate', fallback=1.0)
+        _sample_rates[path] = settings.CONFIG_FILE.getfloat(
+            'pretix_pwyc', f'log_sample_rate_{path}', fallback=default
+        )
+    return _sample_rates[path]
+
+
+def detail_enabled():
+    """Whether the DEBUG-only detail messages (full form data, per-position prices, …) are logged"""
+    if 'detail' not in _sample_rates:
+        _sample_rates['detail'] = settings.CONFIG_FILE.getboolean('pretix_pwyc', 'log_detail', fallback=False)
+    return _sample_rates['detail']
+
+
+class PWYCLogger:
+    """
+    Logger for the plugin's hot paths.
+
+    Messages take lazy %-style arguments and are only formatted if they are emitted. INFO
+    and DEBUG messages are sampled per code path, warnings and errors are always logged.
+    Every record carries the code path as ``pwyc_path``.
+    """
+
+    def __init__(self, name, path):
+        self.logger = logging.getLogger(name)
+        self.path = path
+        self.extra = {'pwyc_path': path}
+
+    def _sampled(self):
+        rate = sample_rate(self.path)
+        return rate >= 1 or (rate > 0 and random.random() < rate)
+
+    def is_enabled(self, level):
+        """Guard for building expensive log arguments"""
+        return self.logger.isEnabledFor(level) and (level >= logging.WARNING or self._sampled())
+
+    def debug(self, msg, *args):
+        if self.is_enabled(logging.DEBUG):
+            self.logger.debug(msg, *args, extra=self.extra)
+
+    def info(self, msg, *args):
+        if self.is_enabled(logging.INFO):
+            self.logger.info(msg, *args, extra=self.extra)
+
+    def detail(self, msg, *args):
+        """Log a DEBUG message that is only wanted while investigating a problem"""
+        if detail_enabled() and self.is_enabled(logging.DEBUG):
+            self.logger.debug(msg, *args, extra=self.extra)
+
+    def warning(self, msg, *args):
+        if self.logger.isEnabledFor(logging.WARNING):
+            self.logger.warning(msg, *args, extra=self.extra)
+
+    def error(self, msg, *args):
+        if self.logger.isEnabledFor(logging.ERROR):
+            self.logger.error(msg, *args, extra=self.extra)
+
+    def exception(self, msg, *args):
+        """Log an error with the current traceback, which is only formatted if the record is emitted"""
+        if self.logger.isEnabledFor(logging.ERROR):
+            self.logger.error(msg, *args, exc_info=True, extra=self.extra)
+
+
+def get_logger(name, path):
+    return PWYCLogger(name, path)
@@ -1,45 +1,71 @@
-from django.utils.translation import gettext_lazy as _
+from django.db import transaction
 from pretix.base.models import LogEntry
 
 
+def write_at_commit(entries):
+    """
+    Write unsaved log entries with one bulk insert once the current transaction commits.
+    Entries of a transaction that is rolled back are dropped with it.
+    """
+    entries = list(entries)
+    if entries:
+        transaction.on_commit(lambda: LogEntry.bulk_create_and_postprocess(entries))
+    return entries
+
+
+def _item_entry(action_type, user, item):
+    return item.log_action(action_type, user=user, data={'id': item.pk, 'name': str(item)}, save=False)
+
+
+def item_transition_entries(user, transitions):
+    """Unsaved log entries for ``(item, enabled)`` pairs of items PWYC was turned on or off for"""
+    return [
+        _item_entry('pretix_pwyc.item.enabled' if enabled else 'pretix_pwyc.item.disabled', user, item)
+        for item, enabled in transitions
+    ]
+
+
 def log_item_pwyc_enabled(event, user, item):
     """Log when PWYC is enabled for an item"""
-    return LogEntry.objects.create(
-        event=event,
-        action_type='pretix_pwyc.item.enabled',
-        user=user,
-        content_object=item,
-        data={
-            'id': item.pk,
-            'name': str(item)
-        }
-    )
+    return write_at_commit(item_transition_entries(user, [(item, True)]))[0]
 
 
 def log_item_pwyc_disabled(event, user, item):
     """Log when PWYC is disabled for an item"""
-    return LogEntry.objects.create(
-        event=event,
-        action_type='pretix_pwyc.item.disabled',
-        user=user,
-        content_object=item,
-        data={
-            'id': item.pk,
-            'name': str(item)
-        }
-    )
+    return write_at_commit(item_transition_entries(user, [(item, False)]))[0]
+
+
+def price_changed_entry(order, position, original_price, custom_price):
+    """Unsaved log entry of the order for a position that got a custom price"""
+    return order.log_action('pretix_pwyc.order.price_changed', data={
+        'position': position.pk,
+        'positionid': position.positionid,
+        'item': str(position.item),
+        'original_price': str(original_price) if original_price is not None else None,
+        'price': str(custom_price),
+    }, save=False)
 
 
 def log_price_changed(event, position, original_price, custom_price):
     """Log when a custom price is used"""
-    return LogEntry.objects.create(
-        event=event,
-        action_type='pretix_pwyc.order.price_changed',
-        content_object=position,
-        data={
-            'position': position.pk,
-            'item': str(position.item),
-            'original_price': str(original_price),
-            'price': str(custom_price)
-        }
+    return write_at_commit([price_changed_entry(position.order, position, original_price, custom_price)])[0]
+
+
+def log_order_prices(order):
+    """
+    Log the custom prices of all positions of a newly placed order, with one bulk insert at
+    commit. Original prices are taken from the ``pwyc`` order metadata.
+    """
+    meta = (order.meta_info_data or {}).get('pwyc') or {}
+    originals = {
+        (p['item_id'], p.get('variation_id')): p.get('original_price')
+        for p in meta.get('positions', [])
+    }
+    if not originals:
+        return []
+    positions = order.positions.select_related('item').filter(item_id__in={item_id for item_id, _ in originals})
+    return write_at_commit(
+        price_changed_entry(order, position, originals.get((position.item_id, position.variation_id)), position.price)
+        for position in positions
+        if (position.item_id, position.variation_id) in originals
     )
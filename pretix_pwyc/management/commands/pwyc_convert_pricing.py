@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+from django_scopes import scopes_disabled
+from pretix.base.models import Event
+
+from pretix_pwyc.bridge import convert_event
+
+
+class Command(BaseCommand):
+    help = "Convert events between the plugin's price widget and pretix' own free price input"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--to",
+            dest="to",
+            choices=("native", "plugin"),
+            required=True,
+            help="Map PWYC products onto pretix' free price input (native) or restore their prices (plugin)",
+        )
+        parser.add_argument(
+            "--event",
+            dest="event",
+            help="Only convert this event, given as organizer/event",
+        )
+
+    @scopes_disabled()
+    def handle(self, *args, **options):
+        events = Event.objects.filter(plugins__contains='pretix_pwyc').select_related('organizer')
+        if options['event']:
+            try:
+                organizer, event = options['event'].split('/')
+            except ValueError:
+                raise CommandError('Events are given as organizer/event')
+            events = events.filter(organizer__slug=organizer, slug=event)
+            if not events:
+                raise CommandError(f'No event {options["event"]} with the plugin enabled')
+
+        native = options['to'] == 'native'
+        for event in events.order_by('pk'):
+            count = convert_event(event, native)
+            self.stdout.write(f'{event.organizer.slug}/{event.slug}: {count} products converted to {options["to"]} pricing')
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+from django_scopes import scopes_disabled
+from pretix.base.models import Event
+
+from pretix_pwyc.stats import rebuild_stats
+
+
+class Command(BaseCommand):
+    help = "Rebuild the Pay What You Can price statistics from all paid orders"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--event",
+            dest="event",
+            help="Only rebuild the statistics of this event, given as organizer/event",
+        )
+
+    @scopes_disabled()
+    def handle(self, *args, **options):
+        events = Event.objects.filter(plugins__contains='pretix_pwyc').select_related('organizer')
+        if options['event']:
+            try:
+                organizer, event = options['event'].split('/')
+            except ValueError:
+                raise CommandError('Events are given as organizer/event')
+            events = events.filter(organizer__slug=organizer, slug=event)
+            if not events:
+                raise CommandError(f'No event {options["event"]} with the plugin enabled')
+
+        for event in events.order_by('pk'):
+            stats = rebuild_stats(event)
+            self.stdout.write(
+                f'{event.organizer.slug}/{event.slug}: {sum(s.count for s in stats)} positions of {len(stats)} products'
+            )
@@ -0,0 +1,251 @@
+import bisect
+import inspect
+import threading
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+
+#: Upper bounds of the latency histogram buckets in seconds, +Inf is implied
+BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5)
+
+#: Code paths that are measured
+METRIC_NAMES = ('apply_pwyc_price', 'add_pwyc_price_form', 'pwyc_order_meta', 'pwyc_formset', 'set_price')
+
+
+class MetricValues:
+    __slots__ = ('calls', 'errors', 'sum', 'buckets')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.sum = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+
+class InMemoryMetrics:
+    """
+    Aggregates metrics in the memory of the current process.
+    """
+    identifier = 'memory'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {name: MetricValues() for name in METRIC_NAMES}
+
+    def observe(self, name, duration):
+        bucket = bisect.bisect_left(BUCKETS, duration)
+        with self.lock:
+            values = self.values[name]
+            values.calls += 1
+            values.sum += duration
+            values.buckets[bucket] += 1
+
+    def error(self, name):
+        with self.lock:
+            self.values[name].errors += 1
+
+    def collect(self):
+        """Return a dictionary mapping every metric name to its MetricValues"""
+        with self.lock:
+            result = {}
+            for name, values in self.values.items():
+                copy = result[name] = MetricValues()
+                copy.calls, copy.errors, copy.sum = values.calls, values.errors, values.sum
+                copy.buckets = list(values.buckets)
+            return result
+
+    def reset(self):
+        with self.lock:
+            self.values = {name: MetricValues() for name in METRIC_NAMES}
+
+
+class CacheMetrics(InMemoryMetrics):
+    """
+    Aggregates metrics in process and periodically adds them to counters in the shared
+    cache, so the metrics of all workers are exported together.
+    """
+    identifier = 'cache'
+    prefix = 'pretix_pwyc:metrics'
+
+    def __init__(self, flush_interval=10):
+        super().__init__()
+        self.flush_interval = flush_interval
+        self.last_flush = time.monotonic()
+
+    def _keys(self, name):
+        keys = [f'{self.prefix}:{name}:calls', f'{self.prefix}:{name}:errors', f'{self.prefix}:{name}:sum_us']
+        return keys + [f'{self.prefix}:{name}:bucket:{i}' for i in range(len(BUCKETS) + 1)]
+
+    def _incr(self, key, delta):
+        if not delta:
+            return
+        if not cache.add(key, delta, timeout=None):
+            try:
+                cache.incr(key, delta)
+            except ValueError:
+                # Evicted between add() and incr()
+                cache.set(key, delta, timeout=None)
+
+    def observe(self, name, duration):
+        super().observe(name, duration)
+        if time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            values, self.values = self.values, {name: MetricValues() for name in METRIC_NAMES}
+            self.last_flush = time.monotonic()
+        for name, v in values.items():
+            deltas = [v.calls, v.errors, round(v.sum * 1_000_000)] + v.buckets
+            for key, delta in zip(self._keys(name), deltas):
+                self._incr(key, delta)
+
+    def collect(self):
+        self.flush()
+        keys = {name: self._keys(name) for name in METRIC_NAMES}
+        stored = cache.get_many([k for name_keys in keys.values() for k in name_keys])
+        result = {}
+        for name, name_keys in keys.items():
+            counts = [stored.get(k, 0) for k in name_keys]
+            values = result[name] = MetricValues()
+            values.calls, values.errors = counts[0], counts[1]
+            values.sum = counts[2] / 1_000_000
+            values.buckets = counts[3:]
+        return result
+
+    def reset(self):
+        super().reset()
+        cache.delete_many([k for name in METRIC_NAMES for k in self._keys(name)])
+
+
+METRIC_BACKENDS = {
+    backend.identifier: backend
+    for backend in (InMemoryMetrics, CacheMetrics)
+}
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_metrics():
+    """
+    Return the metrics backend configured in the ``[pretix_pwyc]`` section of pretix.cfg,
+    or None if metrics are disabled:
+
+        [pretix_pwyc]
+        metrics=memory
+
+    ``memory`` aggregates per process, ``cache`` additionally adds the numbers of all
+    workers up in the shared cache every ``metrics_flush_interval`` seconds.
+    """
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                identifier = settings.CONFIG_FILE.get('pretix_pwyc', 'metrics', fallback='off')
+                if identifier == 'cache':
+                    _backend = CacheMetrics(
+                        settings.CONFIG_FILE.getint('pretix_pwyc', 'metrics_flush_interval', fallback=10)
+                    )
+                elif identifier in METRIC_BACKENDS:
+                    _backend = METRIC_BACKENDS[identifier]()
+                else:
+                    _backend = False
+    return _backend or None
+
+
+def set_metrics(backend):
+    """Replace the metrics backend, ``None`` disables metrics. Meant for tests."""
+    global _backend
+    _backend = backend or False
+
+
+def timed(name):
+    """
+    Measure the duration of every call of the decorated function or coroutine function.
+    Exceptions that leave it are counted as errors.
+    """
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                metrics = _backend if _backend is not None else get_metrics()
+                if not metrics:
+                    return await func(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                except Exception:
+                    metrics.error(name)
+                    raise
+                finally:
+                    metrics.observe(name, time.perf_counter() - start)
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            metrics = _backend if _backend is not None else get_metrics()
+            if not metrics:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                metrics.error(name)
+                raise
+            finally:
+                metrics.observe(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def count_error(name):
+    """Count a handled error of a measured code path"""
+    metrics = _backend if _backend is not None else get_metrics()
+    if metrics:
+        metrics.error(name)
+
+
+def _format_float(value):
+    return repr(float(value))
+
+
+def render_prometheus(values, fragment_stats=None):
+    """
+    Render the output of a backend's collect() in the Prometheus text format, optionally
+    with the fragment cache counters of this process
+    """
+    lines = [
+        '# HELP pretix_pwyc_duration_seconds Time spent in PWYC receivers and views',
+        '# TYPE pretix_pwyc_duration_seconds histogram',
+    ]
+    for name, v in values.items():
+        cumulative = 0
+        for bound, count in zip(BUCKETS + (float('inf'),), v.buckets):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else _format_float(bound)
+            lines.append(f'pretix_pwyc_duration_seconds_bucket{{name="{name}",le="{le}"}} {cumulative}')
+        lines.append(f'pretix_pwyc_duration_seconds_sum{{name="{name}"}} {_format_float(v.sum)}')
+        lines.append(f'pretix_pwyc_duration_seconds_count{{name="{name}"}} {v.calls}')
+    lines += [
+        '# HELP pretix_pwyc_calls_total Calls of PWYC receivers and views',
+        '# TYPE pretix_pwyc_calls_total counter',
+    ]
+    lines += [f'pretix_pwyc_calls_total{{name="{name}"}} {v.calls}' for name, v in values.items()]
+    lines += [
+        '# HELP pretix_pwyc_errors_total Failed calls of PWYC receivers and views',
+        '# TYPE pretix_pwyc_errors_total counter',
+    ]
+    lines += [f'pretix_pwyc_errors_total{{name="{name}"}} {v.errors}' for name, v in values.items()]
+    if fragment_stats is not None:
+        lines += [
+            '# HELP pretix_pwyc_fragment_cache_total Lookups of rendered PWYC fragments in this process',
+            '# TYPE pretix_pwyc_fragment_cache_total counter',
+        ]
+        lines += [
+            f'pretix_pwyc_fragment_cache_total{{result="{result}"}} {fragment_stats[result]}'
+            for result in ('hits', 'shared_hits', 'misses')
+        ]
+    return '\n'.join(lines) + '\n'
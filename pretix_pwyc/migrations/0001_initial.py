@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:58
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('pretixbase', '0174_merge_20201222_1031'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PWYCItemConfig',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False)),
+                ('enabled', models.BooleanField(default=False)),
+                ('min_amount', models.DecimalField(decimal_places=2, max_digits=13, null=True)),
+                ('suggested_amount', models.DecimalField(decimal_places=2, max_digits=13, null=True)),
+                ('explanation', models.TextField(default='')),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pwyc_item_configs', to='pretixbase.event')),
+                ('item', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='pwyc_config', to='pretixbase.item')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['event', 'enabled'], name='pretix_pwyc_event_i_44a676_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,87 @@
+from decimal import Decimal, InvalidOperation
+
+from django.db import migrations
+
+SETTINGS_PREFIXES = {
+    'pwyc_enabled_': 'enabled',
+    'pwyc_min_amount_': 'min_amount',
+    'pwyc_suggested_amount_': 'suggested_amount',
+    'pwyc_explanation_': 'explanation',
+}
+
+
+def _parse_decimal(value):
+    if value in (None, '', 'None'):
+        return None
+    try:
+        return Decimal(value)
+    except (InvalidOperation, TypeError, ValueError):
+        return None
+
+
+def settings_to_configs(apps, schema_editor):
+    # PWYC used to store four loose keys per item in the event settings.
+    # Move them to PWYCItemConfig and remove them from the settings store.
+    Event_SettingsStore = apps.get_model('pretixbase', 'Event_SettingsStore')
+    Item = apps.get_model('pretixbase', 'Item')
+    PWYCItemConfig = apps.get_model('pretix_pwyc', 'PWYCItemConfig')
+
+    values = {}
+    setting_ids = []
+    for setting in Event_SettingsStore.objects.filter(key__startswith='pwyc_').exclude(
+        key='pwyc_explanation_default'
+    ).iterator():
+        for prefix, field in SETTINGS_PREFIXES.items():
+            if setting.key.startswith(prefix) and setting.key[len(prefix):].isdigit():
+                item_id = int(setting.key[len(prefix):])
+                values.setdefault((setting.object_id, item_id), {})[field] = setting.value
+                setting_ids.append(setting.pk)
+                break
+
+    item_events = dict(
+        Item.objects.filter(pk__in={item_id for _, item_id in values}).values_list('pk', 'event_id')
+    )
+    configs = []
+    for (event_id, item_id), data in values.items():
+        if item_events.get(item_id) != event_id:
+            continue
+        configs.append(PWYCItemConfig(
+            event_id=event_id,
+            item_id=item_id,
+            enabled=str(data.get('enabled', '')).lower() == 'true',
+            min_amount=_parse_decimal(data.get('min_amount')),
+            suggested_amount=_parse_decimal(data.get('suggested_amount')),
+            explanation=data.get('explanation') or '',
+        ))
+    PWYCItemConfig.objects.bulk_create(configs, batch_size=1000)
+
+    for i in range(0, len(setting_ids), 1000):
+        Event_SettingsStore.objects.filter(pk__in=setting_ids[i:i + 1000]).delete()
+
+
+def configs_to_settings(apps, schema_editor):
+    Event_SettingsStore = apps.get_model('pretixbase', 'Event_SettingsStore')
+    PWYCItemConfig = apps.get_model('pretix_pwyc', 'PWYCItemConfig')
+
+    settings = []
+    for config in PWYCItemConfig.objects.iterator():
+        for key, value in (
+            (f'pwyc_enabled_{config.item_id}', 'true' if config.enabled else 'false'),
+            (f'pwyc_min_amount_{config.item_id}', str(config.min_amount) if config.min_amount is not None else ''),
+            (f'pwyc_suggested_amount_{config.item_id}',
+             str(config.suggested_amount) if config.suggested_amount is not None else ''),
+            (f'pwyc_explanation_{config.item_id}', config.explanation),
+        ):
+            settings.append(Event_SettingsStore(object_id=config.event_id, key=key, value=value))
+    Event_SettingsStore.objects.bulk_create(settings, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretix_pwyc', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(settings_to_configs, configs_to_settings),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-17 02:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretix_pwyc', '0002_migrate_settings'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PWYCCartPrice',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False)),
+                ('cart_id', models.CharField(db_index=True, max_length=255)),
+                ('price', models.DecimalField(decimal_places=2, max_digits=13)),
+                ('datetime', models.DateTimeField(auto_now=True, db_index=True)),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pwyc_cart_prices', to='pretixbase.event')),
+                ('item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pwyc_cart_prices', to='pretixbase.item')),
+                ('variation', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='pwyc_cart_prices', to='pretixbase.itemvariation')),
+            ],
+            options={
+                'unique_together': {('event', 'cart_id', 'item', 'variation')},
+            },
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-17 02:35
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretix_pwyc', '0003_cartprice'),
+        ('pretixbase', '0312_alter_customer_locale_alter_devicelastseen_device_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PWYCCountedOrder',
+            fields=[
+                ('order', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='pwyc_counted', serialize=False, to='pretixbase.order')),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pwyc_counted_orders', to='pretixbase.event')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PWYCPriceStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False)),
+                ('count', models.IntegerField(default=0)),
+                ('total', models.DecimalField(decimal_places=2, default=0, max_digits=20)),
+                ('total_squares', models.DecimalField(decimal_places=4, default=0, max_digits=30)),
+                ('min_price', models.DecimalField(decimal_places=2, max_digits=13, null=True)),
+                ('max_price', models.DecimalField(decimal_places=2, max_digits=13, null=True)),
+                ('histogram', models.JSONField(default=list)),
+                ('below_suggested', models.IntegerField(default=0)),
+                ('at_suggested', models.IntegerField(default=0)),
+                ('above_suggested', models.IntegerField(default=0)),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pwyc_price_stats', to='pretixbase.event')),
+                ('item', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='pwyc_price_stats', to='pretixbase.item')),
+            ],
+        ),
+    ]
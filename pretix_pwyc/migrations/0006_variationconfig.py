@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-17 02:44
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretix_pwyc', '0005_subeventconfig'),
+        ('pretixbase', '0312_alter_customer_locale_alter_devicelastseen_device_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PWYCVariationConfig',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False)),
+                ('enabled', models.BooleanField(null=True)),
+                ('min_amount', models.DecimalField(decimal_places=2, max_digits=13, null=True)),
+                ('suggested_amount', models.DecimalField(decimal_places=2, max_digits=13, null=True)),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pwyc_variation_configs', to='pretixbase.event')),
+                ('item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pwyc_variation_configs', to='pretixbase.item')),
+                ('variation', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='pwyc_config', to='pretixbase.itemvariation')),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 02:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretix_pwyc', '0006_variationconfig'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pwycitemconfig',
+            name='native_prices',
+            field=models.JSONField(default=dict),
+        ),
+    ]
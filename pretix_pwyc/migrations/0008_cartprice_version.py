@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-17 02:58
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def remove_duplicate_prices(apps, schema_editor):
+    # The unique constraint did not cover prices without variation, concurrent requests could
+    # store the same price twice. Keep the newest one.
+    PWYCCartPrice = apps.get_model('pretix_pwyc', 'PWYCCartPrice')
+    keep = PWYCCartPrice.objects.filter(variation__isnull=True).values(
+        'event_id', 'cart_id', 'item_id'
+    ).order_by().annotate(keep=Max('pk')).values_list('keep', flat=True)
+    PWYCCartPrice.objects.filter(variation__isnull=True).exclude(pk__in=list(keep)).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretix_pwyc', '0007_native_prices'),
+        ('pretixbase', '0312_alter_customer_locale_alter_devicelastseen_device_and_more'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_prices, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='pwyccartprice',
+            unique_together=set(),
+        ),
+        migrations.AddField(
+            model_name='pwyccartprice',
+            name='version',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddConstraint(
+            model_name='pwyccartprice',
+            constraint=models.UniqueConstraint(condition=models.Q(('variation__isnull', False)), fields=('event', 'cart_id', 'item', 'variation'), name='pretix_pwyc_cartprice_variation'),
+        ),
+        migrations.AddConstraint(
+            model_name='pwyccartprice',
+            constraint=models.UniqueConstraint(condition=models.Q(('variation__isnull', True)), fields=('event', 'cart_id', 'item'), name='pretix_pwyc_cartprice_item'),
+        ),
+    ]
@@ -0,0 +1,231 @@
+from django.db import models
+from django.utils.translation import gettext_lazy as _
+
+
+class PWYCItemConfig(models.Model):
+    """
+    Pay What You Can configuration of a single item
+    """
+    event = models.ForeignKey(
+        'pretixbase.Event',
+        on_delete=models.CASCADE,
+        related_name='pwyc_item_configs'
+    )
+    item = models.OneToOneField(
+        'pretixbase.Item',
+        on_delete=models.CASCADE,
+        related_name='pwyc_config'
+    )
+    enabled = models.BooleanField(
+        default=False,
+        verbose_name=_('Enable Pay What You Can')
+    )
+    min_amount = models.DecimalField(
+        max_digits=13, decimal_places=2,
+        null=True, blank=True,
+        verbose_name=_('Minimum amount')
+    )
+    suggested_amount = models.DecimalField(
+        max_digits=13, decimal_places=2,
+        null=True, blank=True,
+        verbose_name=_('Suggested amount')
+    )
+    explanation = models.TextField(
+        blank=True, default='',
+        verbose_name=_('Explanation text')
+    )
+    #: Prices of the item and its variations before they were taken over by the native
+    #: pricing mode, to restore them when it is turned off again (see bridge.py)
+    native_prices = models.JSONField(default=dict, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['event', 'enabled']),
+        ]
+
+    def __str__(self):
+        return f'PWYC config for item {self.item_id}'
+
+
+class PWYCVariationConfig(models.Model):
+    """
+    Override of the Pay What You Can configuration of an item for one of its variations.
+    Empty fields fall back to the configuration of the item.
+    """
+    event = models.ForeignKey(
+        'pretixbase.Event',
+        on_delete=models.CASCADE,
+        related_name='pwyc_variation_configs'
+    )
+    item = models.ForeignKey(
+        'pretixbase.Item',
+        on_delete=models.CASCADE,
+        related_name='pwyc_variation_configs'
+    )
+    variation = models.OneToOneField(
+        'pretixbase.ItemVariation',
+        on_delete=models.CASCADE,
+        related_name='pwyc_config'
+    )
+    enabled = models.BooleanField(
+        null=True, blank=True,
+        verbose_name=_('Enable Pay What You Can')
+    )
+    min_amount = models.DecimalField(
+        max_digits=13, decimal_places=2,
+        null=True, blank=True,
+        verbose_name=_('Minimum amount')
+    )
+    suggested_amount = models.DecimalField(
+        max_digits=13, decimal_places=2,
+        null=True, blank=True,
+        verbose_name=_('Suggested amount')
+    )
+
+    def __str__(self):
+        return f'PWYC config for variation {self.variation_id} of item {self.item_id}'
+
+
+class PWYCSubEventConfig(models.Model):
+    """
+    Override of the Pay What You Can configuration of an item for one date of an event
+    series. Empty fields fall back to the configuration of the item.
+    """
+    event = models.ForeignKey(
+        'pretixbase.Event',
+        on_delete=models.CASCADE,
+        related_name='pwyc_subevent_configs'
+    )
+    subevent = models.ForeignKey(
+        'pretixbase.SubEvent',
+        on_delete=models.CASCADE,
+        related_name='pwyc_configs'
+    )
+    item = models.ForeignKey(
+        'pretixbase.Item',
+        on_delete=models.CASCADE,
+        related_name='pwyc_subevent_configs'
+    )
+    enabled = models.BooleanField(
+        null=True, blank=True,
+        verbose_name=_('Enable Pay What You Can')
+    )
+    min_amount = models.DecimalField(
+        max_digits=13, decimal_places=2,
+        null=True, blank=True,
+        verbose_name=_('Minimum amount')
+    )
+    suggested_amount = models.DecimalField(
+        max_digits=13, decimal_places=2,
+        null=True, blank=True,
+        verbose_name=_('Suggested amount')
+    )
+
+    class Meta:
+        unique_together = (('subevent', 'item'),)
+
+    def __str__(self):
+        return f'PWYC config for item {self.item_id} on date {self.subevent_id}'
+
+
+class PWYCCartPrice(models.Model):
+    """
+    Price chosen by a customer for an item (and variation) in a cart
+    """
+    event = models.ForeignKey(
+        'pretixbase.Event',
+        on_delete=models.CASCADE,
+        related_name='pwyc_cart_prices'
+    )
+    cart_id = models.CharField(max_length=255, db_index=True)
+    item = models.ForeignKey(
+        'pretixbase.Item',
+        on_delete=models.CASCADE,
+        related_name='pwyc_cart_prices'
+    )
+    variation = models.ForeignKey(
+        'pretixbase.ItemVariation',
+        on_delete=models.CASCADE,
+        null=True, blank=True,
+        related_name='pwyc_cart_prices'
+    )
+    price = models.DecimalField(max_digits=13, decimal_places=2)
+    #: Time in milliseconds the price was chosen at, a price is only replaced by a newer one
+    version = models.BigIntegerField(default=0)
+    datetime = models.DateTimeField(auto_now=True, db_index=True)
+
+    class Meta:
+        # Prices without variation need a constraint of their own, as NULLs are never equal
+        constraints = [
+            models.UniqueConstraint(
+                fields=['event', 'cart_id', 'item', 'variation'],
+                condition=models.Q(variation__isnull=False),
+                name='pretix_pwyc_cartprice_variation',
+            ),
+            models.UniqueConstraint(
+                fields=['event', 'cart_id', 'item'],
+                condition=models.Q(variation__isnull=True),
+                name='pretix_pwyc_cartprice_item',
+            ),
+        ]
+
+    def __str__(self):
+        return f'PWYC price {self.price} for item {self.item_id} in cart {self.cart_id}'
+
+
+class PWYCPriceStats(models.Model):
+    """
+    Running aggregates of the prices paid for a PWYC item, maintained by ``stats.py``
+    """
+    event = models.ForeignKey(
+        'pretixbase.Event',
+        on_delete=models.CASCADE,
+        related_name='pwyc_price_stats'
+    )
+    item = models.OneToOneField(
+        'pretixbase.Item',
+        on_delete=models.CASCADE,
+        related_name='pwyc_price_stats'
+    )
+    count = models.IntegerField(default=0)
+    total = models.DecimalField(max_digits=20, decimal_places=2, default=0)
+    total_squares = models.DecimalField(max_digits=30, decimal_places=4, default=0)
+    min_price = models.DecimalField(max_digits=13, decimal_places=2, null=True, blank=True)
+    max_price = models.DecimalField(max_digits=13, decimal_places=2, null=True, blank=True)
+    #: Number of prices per bucket of ``stats.HISTOGRAM_BOUNDS``
+    histogram = models.JSONField(default=list)
+    below_suggested = models.IntegerField(default=0)
+    at_suggested = models.IntegerField(default=0)
+    above_suggested = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f'PWYC price statistics for item {self.item_id}'
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    @property
+    def stddev(self):
+        if not self.count:
+            return None
+        variance = self.total_squares / self.count - self.mean ** 2
+        return max(variance, 0).sqrt()
+
+
+class PWYCCountedOrder(models.Model):
+    """
+    Marks a paid order whose PWYC positions are included in PWYCPriceStats, so that
+    repeated signals for the same order do not count it twice
+    """
+    order = models.OneToOneField(
+        'pretixbase.Order',
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='pwyc_counted'
+    )
+    event = models.ForeignKey(
+        'pretixbase.Event',
+        on_delete=models.CASCADE,
+        related_name='pwyc_counted_orders'
+    )
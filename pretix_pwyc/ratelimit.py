@@ -0,0 +1,177 @@
+import math
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+from pretix.helpers.http import get_client_ip
+
+#: Tokens added per second and bucket capacity
+Limit = namedtuple('Limit', ('rate', 'burst'))
+
+DEFAULT_LIMITS = {
+    'session': Limit(2, 20),
+    'ip': Limit(10, 100),
+    'event': Limit(200, 2000),
+}
+
+
+def _refill(tokens, updated, limit, now):
+    return min(limit.burst, tokens + (now - updated) * limit.rate)
+
+
+class InMemoryRateLimiter:
+    """
+    Token buckets in the memory of the current process. Limits apply per worker.
+    """
+    identifier = 'memory'
+    max_buckets = 100000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()
+
+    def consume(self, key, limit, now=None):
+        """Take a token from a bucket, return 0 or the number of seconds until one is available"""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (limit.burst, now))
+            tokens = _refill(tokens, updated, limit, now)
+            retry_after = 0 if tokens >= 1 else (1 - tokens) / limit.rate
+            self.buckets[key] = (tokens - 1 if not retry_after else tokens, now)
+            while len(self.buckets) > self.max_buckets:
+                self.buckets.popitem(last=False)
+        return retry_after
+
+    async def aconsume(self, key, limit, now=None):
+        return self.consume(key, limit, now)
+
+
+class CacheRateLimiter:
+    """
+    Token buckets in the shared cache, so limits apply across all workers.
+
+    Buckets are read and written without locking, concurrent requests for the same key can
+    therefore overdraw a bucket slightly.
+    """
+    identifier = 'cache'
+    prefix = 'pretix_pwyc:ratelimit'
+
+    def consume(self, key, limit, now=None):
+        now = time.time() if now is None else now
+        cache_key = f'{self.prefix}:{key}'
+        bucket, retry_after = self._take(cache.get(cache_key), limit, now)
+        cache.set(cache_key, bucket, timeout=self._timeout(limit))
+        return retry_after
+
+    async def aconsume(self, key, limit, now=None):
+        now = time.time() if now is None else now
+        cache_key = f'{self.prefix}:{key}'
+        bucket, retry_after = self._take(await cache.aget(cache_key), limit, now)
+        await cache.aset(cache_key, bucket, timeout=self._timeout(limit))
+        return retry_after
+
+    def _take(self, bucket, limit, now):
+        tokens, updated = bucket or (limit.burst, now)
+        tokens = _refill(tokens, updated, limit, now)
+        retry_after = 0 if tokens >= 1 else (1 - tokens) / limit.rate
+        return (tokens - 1 if not retry_after else tokens, now), retry_after
+
+    def _timeout(self, limit):
+        # A bucket that is not touched for this long is full again and can be forgotten
+        return math.ceil(limit.burst / limit.rate) + 1
+
+
+RATE_LIMITERS = {
+    limiter.identifier: limiter
+    for limiter in (InMemoryRateLimiter, CacheRateLimiter)
+}
+
+_limiter = None
+_limits = None
+
+
+def get_rate_limiter():
+    """
+    Return the rate limiter configured in the ``[pretix_pwyc]`` section of pretix.cfg, or None
+    if rate limiting is turned off:
+
+        [pretix_pwyc]
+        ratelimit=memory
+        ratelimit_session=2,20
+        ratelimit_ip=10,100
+        ratelimit_event=200,2000
+
+    ``memory`` (default) limits per worker, ``cache`` across all workers sharing the cache.
+    Every limit is given as tokens per second and bucket size.
+    """
+    global _limiter
+    if _limiter is None:
+        identifier = settings.CONFIG_FILE.get('pretix_pwyc', 'ratelimit', fallback='memory')
+        _limiter = RATE_LIMITERS[identifier]() if identifier in RATE_LIMITERS else False
+    return _limiter or None
+
+
+def set_rate_limiter(limiter, limits=None):
+    """Replace the rate limiter and its limits, ``None`` turns rate limiting off. Meant for tests."""
+    global _limiter, _limits
+    _limiter = limiter or False
+    _limits = limits
+
+
+def get_limits():
+    global _limits
+    if _limits is None:
+        limits = {}
+        for scope, default in DEFAULT_LIMITS.items():
+            value = settings.CONFIG_FILE.get('pretix_pwyc', f'ratelimit_{scope}', fallback=None)
+            if value:
+                rate, burst = value.split(',')
+                limits[scope] = Limit(float(rate), float(burst))
+            else:
+                limits[scope] = default
+        _limits = limits
+    return _limits
+
+
+def _bucket_keys(request):
+    event = getattr(request, 'event', None)
+    session_key = getattr(getattr(request, 'session', None), 'session_key', None)
+    keys = (
+        ('session', session_key),
+        ('ip', get_client_ip(request)),
+        ('event', event.pk if event else 'none'),
+    )
+    return [(f'{scope}:{value}', scope) for scope, value in keys if value is not None]
+
+
+def check_rate_limit(request):
+    """
+    Take a token from the session, IP address and event buckets of a request. Return 0 if the
+    request may proceed, otherwise the number of seconds after which it may be retried.
+    """
+    limiter = get_rate_limiter()
+    if not limiter:
+        return 0
+
+    limits = get_limits()
+    for key, scope in _bucket_keys(request):
+        retry_after = limiter.consume(key, limits[scope])
+        if retry_after:
+            return retry_after
+    return 0
+
+
+async def acheck_rate_limit(request):
+    """Async variant of check_rate_limit"""
+    limiter = get_rate_limiter()
+    if not limiter:
+        return 0
+
+    limits = get_limits()
+    for key, scope in _bucket_keys(request):
+        retry_after = await limiter.aconsume(key, limits[scope])
+        if retry_after:
+            return retry_after
+    return 0
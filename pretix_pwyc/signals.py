@@ -1,25 +1,40 @@
-from decimal import Decimal
+from django.core.signals import request_finished, request_started
+from django.db.models.signals import post_save
 from django.dispatch import receiver
-from django.utils.translation import gettext_lazy as _
-from django.utils.safestring import mark_safe
 from django import forms
 from django.forms import formset_factory
-import logging
-
 # Import only the signals we know exist in pretix core
 from pretix.base.signals import (
     register_global_settings, event_copy_data, item_copy_data,
-    logentry_display
+    logentry_display, periodic_task, register_data_exporters,
+    order_placed, order_paid, order_canceled
 )
 from pretix.presale.signals import (
-    fee_calculation_for_cart, order_meta_from_request, item_description
+    fee_calculation_for_cart, order_meta_from_request, item_description, html_head
 )
-from pretix.control.signals import nav_event_settings, item_formsets
+from pretix.control.signals import nav_event_settings, item_formsets, event_dashboard_widgets, subevent_forms
 
 from pretix.base.models import LogEntry
-from .forms import PWYCSettingsForm, PWYCItemForm, PWYCPriceForm, PWYCItemSettingsForm
+from .bridge import native_pricing
+from .cart import is_stamped, stamp_positions
+from .config import (
+    begin_request_cache, copy_event_configs, copy_item_configs, end_request_cache, get_config_snapshot,
+    get_item_config,
+)
+from .forms import (
+    PWYCSettingsForm, PWYCItemForm, PWYCPriceForm, PWYCItemSettingsForm, PWYCSubEventForm, PWYCVariationConfigFormSet,
+)
+from .fragments import head_fragment, item_fragment, schedule_prewarm
+from .log import get_logger
+from .logentry import item_transition_entries, log_order_prices, write_at_commit
+from .metrics import count_error, timed
+from .models import PWYCCartPrice
+from .storage import get_price_store, lookup_price, serialize_prices
 
-logger = logging.getLogger(__name__)
+logger = get_logger(__name__, 'general')
+formset_logger = get_logger(__name__, 'item_formset')
+fee_logger = get_logger(__name__, 'fee_calculation')
+storefront_logger = get_logger(__name__, 'storefront')
 
 
 # Create the formset class
@@ -45,16 +60,22 @@ PWYCFormSetClass = formset_factory(PWYCItemSettingsForm, formset=PWYCFormSet, ex
 def is_pwyc_item(event, item):
     """Helper to check if an item is PWYC-enabled"""
     try:
-        enabled_setting = event.settings.get(f'pwyc_enabled_{item.pk}', 'false')
-        # Handle both string and boolean values
-        if isinstance(enabled_setting, str):
-            return enabled_setting.lower() == 'true'
-        else:
-            return bool(enabled_setting)
+        return get_config_snapshot(event).is_enabled(item.pk)
     except:
         return False
 
 
+@receiver(request_started, dispatch_uid="pretix_pwyc_request_started")
+def request_started_receiver(sender, **kwargs):
+    """Give every request a fresh PWYC configuration memo"""
+    begin_request_cache()
+
+
+@receiver(request_finished, dispatch_uid="pretix_pwyc_request_finished")
+def request_finished_receiver(sender, **kwargs):
+    end_request_cache()
+
+
 @receiver(register_global_settings, dispatch_uid="pretix_pwyc_global_settings")
 def register_global_settings_receiver(sender, **kwargs):
     return {
@@ -63,6 +84,7 @@ def register_global_settings_receiver(sender, **kwargs):
 
 
 @receiver(item_formsets, dispatch_uid="pretix_pwyc_item_formset")
+@timed('pwyc_formset')
 def pwyc_formset(sender, request, item, **kwargs):
     """Add PWYC form to item edit page"""
     try:
@@ -71,81 +93,19 @@ def pwyc_formset(sender, request, item, **kwargs):
 
         if item and hasattr(item, 'pk') and item.pk:
             try:
-                # Safely get settings values and convert them to proper types
-                # The error suggests that one of these settings calls is problematic
-                logger.info(f"PWYC: Attempting to load settings for item {item.pk}")
-
-                # Try each setting individually to isolate the problematic one
-                try:
-                    # Instead of clearing the setting, let's try to read it safely
-                    # and only clear it if there's actually an error
-
-                    pwyc_enabled = False  # Default value
-
-                    try:
-                        # Try to get the setting value
-                        enabled_value = sender.settings.get(f'pwyc_enabled_{item.pk}', 'false')
-                        logger.info(f"PWYC: Got raw pwyc_enabled value: {enabled_value} (type: {type(enabled_value)})")
-
-                        # Handle both string and boolean values safely
-                        if isinstance(enabled_value, str):
-                            pwyc_enabled = enabled_value.lower() == 'true'
-                        elif isinstance(enabled_value, bool):
-                            pwyc_enabled = enabled_value
-                        else:
-                            logger.warning(f"PWYC: Unexpected pwyc_enabled type: {type(enabled_value)}, using False")
-                            pwyc_enabled = False
-
-                        logger.info(f"PWYC: Processed pwyc_enabled: {pwyc_enabled}")
-
-                    except Exception as e:
-                        logger.error(f"PWYC: Error getting pwyc_enabled, will clear problematic value: {e}")
-                        # Only clear if there's actually an error
-                        try:
-                            if hasattr(sender.settings, 'delete'):
-                                sender.settings.delete(f'pwyc_enabled_{item.pk}')
-                            logger.info(f"PWYC: Cleared problematic setting pwyc_enabled_{item.pk}")
-                        except:
-                            pass
-                        pwyc_enabled = False
-
-                except Exception as e:
-                    logger.error(f"PWYC: Error processing pwyc_enabled: {e}")
-                    pwyc_enabled = False
-
-                try:
-                    pwyc_min_amount = sender.settings.get(f'pwyc_min_amount_{item.pk}', None)
-                    logger.info(f"PWYC: Got pwyc_min_amount: {pwyc_min_amount} (type: {type(pwyc_min_amount)})")
-                except Exception as e:
-                    logger.error(f"PWYC: Error getting pwyc_min_amount: {e}")
-                    pwyc_min_amount = None
-
-                try:
-                    pwyc_suggested_amount = sender.settings.get(f'pwyc_suggested_amount_{item.pk}', None)
-                    logger.info(f"PWYC: Got pwyc_suggested_amount: {pwyc_suggested_amount} (type: {type(pwyc_suggested_amount)})")
-                except Exception as e:
-                    logger.error(f"PWYC: Error getting pwyc_suggested_amount: {e}")
-                    pwyc_suggested_amount = None
-
-                try:
-                    pwyc_explanation = sender.settings.get(f'pwyc_explanation_{item.pk}', '')
-                    logger.info(f"PWYC: Got pwyc_explanation: {pwyc_explanation} (type: {type(pwyc_explanation)})")
-                except Exception as e:
-                    logger.error(f"PWYC: Error getting pwyc_explanation: {e}")
-                    pwyc_explanation = ''
-
-                # Convert to safe values
+                config = get_item_config(sender, item)
+
                 initial_data = {
-                    'pwyc_enabled': bool(pwyc_enabled) if pwyc_enabled is not None else False,
-                    'pwyc_min_amount': str(pwyc_min_amount) if pwyc_min_amount not in [None, ''] else '',
-                    'pwyc_suggested_amount': str(pwyc_suggested_amount) if pwyc_suggested_amount not in [None, ''] else '',
-                    'pwyc_explanation': str(pwyc_explanation) if pwyc_explanation is not None else '',
+                    'pwyc_enabled': config.enabled if config else False,
+                    'pwyc_min_amount': str(config.min_amount) if config and config.min_amount is not None else '',
+                    'pwyc_suggested_amount': (
+                        str(config.suggested_amount) if config and config.suggested_amount is not None else ''
+                    ),
+                    'pwyc_explanation': config.explanation if config else '',
                 }
-                logger.info(f"PWYC: Loaded initial data: {initial_data}")
-            except Exception as e:
-                logger.error(f"PWYC: Error loading initial data: {e}")
-                import traceback
-                logger.error(f"PWYC: Initial data traceback: {traceback.format_exc()}")
+                formset_logger.detail("PWYC: Loaded initial data for item %s: %s", item.pk, initial_data)
+            except Exception:
+                formset_logger.exception("PWYC: Error loading initial data for item %s", item.pk)
                 initial_data = {
                     'pwyc_enabled': False,
                     'pwyc_min_amount': '',
@@ -161,9 +121,8 @@ def pwyc_formset(sender, request, item, **kwargs):
                 # Check for any pwyc form fields in POST data
                 has_pwyc_data = any(str(key).startswith('pwyc-') for key in request.POST.keys())
                 is_post = method_str == 'POST' and has_pwyc_data
-                logger.info(f"PWYC: POST check - method: {method_str}, has_pwyc_data: {has_pwyc_data}, is_post: {is_post}")
         except Exception as e:
-            logger.error(f"PWYC: Error checking request method: {e}")
+            formset_logger.error("PWYC: Error checking request method: %s", e)
             is_post = False
 
         # Create the formset
@@ -171,19 +130,13 @@ def pwyc_formset(sender, request, item, **kwargs):
             formset_data = request.POST if is_post else None
             formset_initial = [initial_data] if not is_post else None
 
-            logger.info(f"PWYC: Creating formset with data={formset_data is not None}, initial={formset_initial}")
-
             formset = PWYCFormSetClass(
                 data=formset_data,
                 initial=formset_initial,
                 prefix='pwyc'
             )
-
-            logger.info(f"PWYC: Formset created successfully, forms count: {len(formset.forms)}")
-        except Exception as e:
-            logger.error(f"PWYC: Error creating formset: {e}")
-            import traceback
-            logger.error(f"PWYC: Formset creation traceback: {traceback.format_exc()}")
+        except Exception:
+            formset_logger.exception("PWYC: Error creating formset for item %s", item.pk)
             # Create minimal formset
             formset = PWYCFormSetClass(prefix='pwyc', initial=[{
                 'pwyc_enabled': False,
@@ -197,9 +150,8 @@ def pwyc_formset(sender, request, item, **kwargs):
             for form in formset.forms:
                 form.event = sender
                 form.item = item
-            logger.info(f"PWYC: Set event and item on {len(formset.forms)} forms")
         except Exception as e:
-            logger.error(f"PWYC: Error setting form properties: {e}")
+            formset_logger.error("PWYC: Error setting form properties: %s", e)
 
         # Set formset properties
         formset.template = 'pretix_pwyc/item_edit_pwyc.html'
@@ -208,38 +160,35 @@ def pwyc_formset(sender, request, item, **kwargs):
         # Save if valid POST
         if is_post:
             try:
-                logger.info(f"PWYC: Processing POST data")
-                logger.info(f"PWYC: Formset is_valid: {formset.is_valid()}")
-
                 if formset.is_valid():
-                    logger.info(f"PWYC: Formset is valid, attempting to save")
+                    was_enabled = is_pwyc_item(sender, item)
+                    transitions = []
                     for i, form in enumerate(formset.forms):
-                        logger.info(f"PWYC: Form {i} cleaned_data: {form.cleaned_data}")
+                        formset_logger.detail("PWYC: Form %s cleaned_data: %s", i, form.cleaned_data)
                         if hasattr(form, 'save') and form.cleaned_data:
                             form.save()
-                            logger.info(f"PWYC: Form {i} saved successfully")
-                    logger.info(f"PWYC: Settings saved for item {item.pk}")
+                            enabled = bool(form.cleaned_data.get('pwyc_enabled', False))
+                            if enabled != was_enabled:
+                                transitions.append((item, enabled))
+                    write_at_commit(item_transition_entries(getattr(request, 'user', None), transitions))
+                    schedule_prewarm(sender)
+                    formset_logger.info("PWYC: Settings saved for item %s", item.pk)
                     formset.title = 'Pay What You Can (Saved)'
                 else:
-                    logger.error(f"PWYC: Formset validation failed")
-                    logger.error(f"PWYC: Formset errors: {formset.errors}")
-                    logger.error(f"PWYC: Formset non_form_errors: {formset.non_form_errors()}")
-                    for i, form in enumerate(formset.forms):
-                        logger.error(f"PWYC: Form {i} errors: {form.errors}")
+                    formset_logger.warning(
+                        "PWYC: Formset validation failed for item %s: %s %s",
+                        item.pk, formset.errors, formset.non_form_errors()
+                    )
                     formset.title = 'Pay What You Can (Validation Error)'
-            except Exception as e:
-                logger.error(f"PWYC: Error saving formset: {e}")
-                import traceback
-                logger.error(f"PWYC: Save traceback: {traceback.format_exc()}")
+            except Exception:
+                formset_logger.exception("PWYC: Error saving formset for item %s", item.pk)
                 formset.title = 'Pay What You Can (Save Error)'
 
-        logger.info(f"PWYC: Returning formset with title: {formset.title}")
         return formset
 
-    except Exception as e:
-        logger.error(f"PWYC: Error in item formset: {e}")
-        import traceback
-        logger.error(f"PWYC: Full traceback: {traceback.format_exc()}")
+    except Exception:
+        count_error('pwyc_formset')
+        formset_logger.exception("PWYC: Error in item formset")
 
         # Return minimal formset on error
         try:
@@ -253,11 +202,24 @@ def pwyc_formset(sender, request, item, **kwargs):
             formset.title = 'Pay What You Can (Error)'
             return formset
         except Exception as inner_e:
-            logger.error(f"PWYC: Error creating fallback formset: {inner_e}")
+            formset_logger.error("PWYC: Error creating fallback formset: %s", inner_e)
             # Return None to disable this formset completely if everything fails
             return None
 
 
+@receiver(item_formsets, dispatch_uid="pretix_pwyc_variation_formset")
+def pwyc_variation_formset(sender, request, item, **kwargs):
+    """Add the PWYC overrides of the variations to the edit page of items with variations"""
+    if not item or not item.pk:
+        return None
+    formset = PWYCVariationConfigFormSet(
+        data=request.POST if request.method == 'POST' else None,
+        event=sender,
+        item=item,
+    )
+    return formset if formset.variations else None
+
+
 @receiver(nav_event_settings, dispatch_uid='pretix_pwyc_nav_settings')
 def add_settings_tab(sender, request, **kwargs):
     """Add PWYC settings tab to event settings"""
@@ -269,79 +231,188 @@ def add_settings_tab(sender, request, **kwargs):
             'active': False,  # Simplified - just always false for now
         }]
     except Exception as e:
-        logger.error(f"PWYC: Error in nav settings: {e}")
+        logger.error("PWYC: Error in nav settings: %s", e)
         return []
 
 
 @receiver(fee_calculation_for_cart, dispatch_uid="pretix_pwyc_fee_calculation")
+@timed('apply_pwyc_price')
 def apply_pwyc_price(sender, positions, invoice_address, request, **kwargs):
     """
     Apply custom prices to cart positions
 
+    Prices are written onto the cart positions, where pretix' own price computations keep
+    them, the first time a position is seen and whenever the customer changes the price (see
+    ``cart.py``). Positions that already carry their price need no lookup here.
+
     Note: Using **kwargs to handle different pretix versions that may pass different arguments
     """
     try:
-        # Extract additional arguments that may be passed
-        meta_info = kwargs.get('meta_info', {})
-        total = kwargs.get('total', None)
-        payment_requests = kwargs.get('payment_requests', [])
-
-        logger.info(f"PWYC: Processing {len(positions)} positions for fee calculation")
-
-        for pos in positions:
-            if is_pwyc_item(sender, pos.item):
-                session_key = f'pwyc_price_{pos.item.pk}'
-                logger.info(f"PWYC: Checking for custom price for item {pos.item.pk}, session key: {session_key}")
-
-                if request and hasattr(request, 'session') and session_key in request.session:
-                    try:
-                        custom_price = Decimal(str(request.session[session_key]))
-                        original_price = pos.price
-
-                        logger.info(f"PWYC: Found custom price {custom_price} for item {pos.item.pk} (original: {original_price})")
-
-                        # Store original price in meta_info for reference
-                        if not hasattr(pos, 'meta_info') or pos.meta_info is None:
-                            pos.meta_info = {}
-                        pos.meta_info['pwyc_original_price'] = str(original_price)
-
-                        # Set the new price
-                        pos.price = custom_price
-                        logger.info(f"PWYC: Applied custom price {custom_price} to item {pos.item.pk}")
-                    except Exception as e:
-                        logger.error(f"PWYC: Error applying price for item {pos.item.pk}: {e}")
-                else:
-                    logger.info(f"PWYC: No custom price found for PWYC item {pos.item.pk}")
-
+        snapshot = get_config_snapshot(sender)
+        if snapshot.native:
+            # pretix prices the positions itself
+            return []
+        fee_logger.debug("PWYC: Processing %s positions for fee calculation", len(positions))
+
+        pending = [
+            pos for pos in positions
+            if not is_stamped(pos) and snapshot.is_enabled(pos.item_id, pos.subevent_id, pos.variation_id)
+        ]
+        if not pending:
+            return []
+
+        # Load the prices of all carts involved with a single lookup
+        prices = get_price_store(sender).get_prices(
+            request, {getattr(pos, 'cart_id', None) for pos in pending}
+        )
+        applied = stamp_positions(pending, prices, snapshot)
+
+        fee_logger.info("PWYC: Applied custom prices to %d of %d positions", len(applied), len(positions))
         return []  # No additional fees
-    except Exception as e:
-        logger.error(f"PWYC: Error in fee calculation: {e}")
-        import traceback
-        logger.error(f"PWYC: Fee calculation traceback: {traceback.format_exc()}")
+    except Exception:
+        count_error('apply_pwyc_price')
+        fee_logger.exception("PWYC: Error in fee calculation")
         return []
 
 
 @receiver(order_meta_from_request, dispatch_uid="pretix_pwyc_order_meta")
+@timed('pwyc_order_meta')
 def pwyc_order_meta(sender, request, **kwargs):
     """
     Store PWYC information in order metadata
+
+    The prices are stored as one unit under ``pwyc``, together with the item, variation,
+    original and chosen price of every cart position a custom price applies to. Prices are
+    read from the cart positions they were written onto, the price store is only consulted
+    for positions that have not been priced yet.
     """
     try:
-        meta = {}
-
-        # Find all pwyc session keys
-        if request and hasattr(request, 'session'):
-            for key in request.session.keys():
-                key_str = str(key)
-                if key_str.startswith('pwyc_price_'):
-                    meta[key] = request.session[key]
-
-        return meta
+        from pretix.base.models import CartPosition
+        from pretix.presale.views.cart import get_or_create_cart_id
+
+        snapshot = get_config_snapshot(sender)
+        if snapshot.native:
+            return {}
+        cart_id = get_or_create_cart_id(request, create=False)
+        if not cart_id:
+            return {}
+
+        cart_positions = [
+            row for row in CartPosition.objects.filter(
+                event=sender, cart_id=cart_id, item_id__in=snapshot.enabled_item_ids()
+            ).order_by('pk').values_list(
+                'item_id', 'variation_id', 'subevent_id', 'listed_price', 'custom_price_input', 'price_after_voucher'
+            )
+            if snapshot.is_enabled(row[0], row[2], row[1])
+        ]
+        stored = None
+        prices = {}
+        positions = []
+        for item_id, variation_id, subevent_id, listed_price, custom_price, price_after_voucher in cart_positions:
+            if custom_price is None or custom_price != price_after_voucher:
+                if stored is None:
+                    stored = get_price_store(sender).get_prices(request, [cart_id])
+                custom_price = lookup_price(stored, item_id, variation_id)
+            if custom_price is None:
+                continue
+            prices[(item_id, variation_id)] = custom_price
+            positions.append({
+                'item_id': item_id,
+                'variation_id': variation_id,
+                'original_price': str(listed_price) if listed_price is not None else None,
+                'price': str(custom_price),
+            })
+        if not positions:
+            return {}
+
+        return {'pwyc': {'prices': serialize_prices(prices), 'positions': positions}}
     except Exception as e:
-        logger.error(f"PWYC: Error in order meta: {e}")
+        count_error('pwyc_order_meta')
+        logger.error("PWYC: Error in order meta: %s", e)
         return {}
 
 
+@receiver(order_placed, dispatch_uid="pretix_pwyc_stats_order_placed")
+@receiver(order_paid, dispatch_uid="pretix_pwyc_stats_order_paid")
+def update_stats_on_payment(sender, order, **kwargs):
+    """Add orders that are paid, or placed as paid, to the price statistics"""
+    from .stats import count_order
+    try:
+        count_order(order)
+    except Exception:
+        logger.exception("PWYC: Error updating price statistics of order %s", order.code)
+
+
+@receiver(order_placed, dispatch_uid="pretix_pwyc_log_order_prices")
+def log_pwyc_prices(sender, order, **kwargs):
+    """Log the custom prices of a new order, written with one insert when the order is committed"""
+    try:
+        log_order_prices(order)
+    except Exception:
+        logger.exception("PWYC: Error logging custom prices of order %s", order.code)
+
+
+@receiver(order_canceled, dispatch_uid="pretix_pwyc_stats_order_canceled")
+def update_stats_on_cancel(sender, order, **kwargs):
+    """Remove canceled orders from the price statistics"""
+    from .stats import uncount_order
+    try:
+        uncount_order(order)
+    except Exception:
+        logger.exception("PWYC: Error updating price statistics of order %s", order.code)
+
+
+@receiver(event_dashboard_widgets, dispatch_uid="pretix_pwyc_dashboard_widget")
+def pwyc_dashboard_widget(sender, **kwargs):
+    """Show the price statistics on the event dashboard"""
+    from django.template.loader import get_template
+    from .models import PWYCPriceStats
+    from .stats import histogram_labels
+
+    stats = list(
+        PWYCPriceStats.objects.filter(event=sender, count__gt=0).select_related('item').order_by('item__position', 'item_id')
+    )
+    if not stats:
+        return []
+    labels = histogram_labels()
+    for s in stats:
+        peak = max(s.histogram) or 1
+        s.buckets = [
+            (label, count, round(count / peak * 100))
+            for label, count in zip(labels, s.histogram)
+        ]
+    return [{
+        'content': get_template('pretix_pwyc/dashboard_widget.html').render({
+            'event': sender,
+            'stats': stats,
+        }),
+        'display_size': 'big',
+        'priority': 50,
+    }]
+
+
+@receiver(register_data_exporters, dispatch_uid="pretix_pwyc_exporter_positions")
+def register_positions_exporter(sender, **kwargs):
+    from .exporters import PWYCPositionsExporter
+    return PWYCPositionsExporter
+
+
+@receiver(periodic_task, dispatch_uid="pretix_pwyc_periodic_cleanup")
+def cleanup_cart_prices(sender, **kwargs):
+    """Remove stored prices of carts that no longer exist"""
+    from datetime import timedelta
+    from django.utils.timezone import now
+    from django_scopes import scopes_disabled
+    from pretix.base.models import CartPosition
+
+    with scopes_disabled():
+        PWYCCartPrice.objects.filter(
+            datetime__lt=now() - timedelta(days=2)
+        ).exclude(
+            cart_id__in=CartPosition.objects.values('cart_id')
+        ).delete()
+
+
 @receiver(logentry_display, dispatch_uid="pretix_pwyc_logentry_display")
 def pwyc_logentry_display(sender, logentry, **kwargs):
     """
@@ -361,7 +432,7 @@ def pwyc_logentry_display(sender, logentry, **kwargs):
 
         return None
     except Exception as e:
-        logger.error(f"PWYC: Error in log display: {e}")
+        logger.error("PWYC: Error in log display: %s", e)
         return None
 
 
@@ -371,25 +442,29 @@ def event_copy_data_receiver(sender, other, item_map, **kwargs):
     Copy PWYC settings when copying an event
     """
     try:
-        for old_item_id, new_item in item_map.items():
-            if other.settings.get(f'pwyc_enabled_{old_item_id}'):
-                sender.settings.set(f'pwyc_enabled_{new_item.pk}', True)
-                sender.settings.set(
-                    f'pwyc_min_amount_{new_item.pk}',
-                    other.settings.get(f'pwyc_min_amount_{old_item_id}')
-                )
-                sender.settings.set(
-                    f'pwyc_suggested_amount_{new_item.pk}',
-                    other.settings.get(f'pwyc_suggested_amount_{old_item_id}')
-                )
-                sender.settings.set(
-                    f'pwyc_explanation_{new_item.pk}',
-                    other.settings.get(f'pwyc_explanation_{old_item_id}')
-                )
+        copy_event_configs(sender, item_map, kwargs.get('variation_map'))
 
         sender.settings.set('pwyc_explanation_default', other.settings.get('pwyc_explanation_default', ''))
-    except Exception as e:
-        logger.error(f"PWYC: Error in event copy: {e}")
+        sender.settings.set('pwyc_native_pricing', native_pricing(other))
+    except Exception:
+        logger.exception("PWYC: Error in event copy")
+
+
+@receiver(subevent_forms, dispatch_uid='pretix_pwyc_subevent_forms')
+def pwyc_subevent_form(sender, request, subevent, copy_from=None, **kwargs):
+    """
+    Add the PWYC overrides to the date editor. When a date is cloned, or dates are created
+    in bulk, the overrides of the source date are copied to every new date in one batch.
+    """
+    if not sender.pwyc_item_configs.exists():
+        return None
+    return PWYCSubEventForm(
+        data=request.POST if request.method == 'POST' else None,
+        event=sender,
+        subevent=subevent,
+        copy_from=copy_from,
+        prefix='pwyc',
+    )
 
 
 @receiver(item_copy_data, dispatch_uid='pretix_pwyc_copy_item_data')
@@ -398,184 +473,61 @@ def item_copy_data_receiver(sender, source, target, **kwargs):
     Copy PWYC settings when copying an item
     """
     try:
-        if sender.settings.get(f'pwyc_enabled_{source.pk}'):
-            sender.settings.set(f'pwyc_enabled_{target.pk}', True)
-            sender.settings.set(
-                f'pwyc_min_amount_{target.pk}',
-                sender.settings.get(f'pwyc_min_amount_{source.pk}')
-            )
-            sender.settings.set(
-                f'pwyc_suggested_amount_{target.pk}',
-                sender.settings.get(f'pwyc_suggested_amount_{source.pk}')
-            )
-            sender.settings.set(
-                f'pwyc_explanation_{target.pk}',
-                sender.settings.get(f'pwyc_explanation_{source.pk}')
-            )
-    except Exception as e:
-        logger.error(f"PWYC: Error in item copy: {e}")
+        copy_item_configs(target.event_id, {source.pk: target})
+    except Exception:
+        logger.exception("PWYC: Error in item copy")
 
 
-@receiver(item_description, dispatch_uid="pretix_pwyc_item_description")
-def add_pwyc_price_form(sender, item, variation, **kwargs):
-    """Add Pay What You Can marker for JavaScript to pick up"""
+@receiver(post_save, sender=LogEntry, dispatch_uid="pretix_pwyc_shop_live")
+def prewarm_on_shop_live(sender, instance, created, **kwargs):
+    """Render the PWYC fragments of an event before the first customers arrive"""
+    if created and instance.action_type == 'pretix.event.live.activated' and instance.event_id:
+        try:
+            if 'pretix_pwyc' in instance.event.get_plugins():
+                schedule_prewarm(instance.event)
+        except Exception:
+            storefront_logger.exception("PWYC: Error pre-warming fragments of event %s", instance.event_id)
+
+
+def _request_subevent_id(request):
+    """Id of the date of an event series the page is shown for, or None"""
+    match = getattr(request, 'resolver_match', None)
+    subevent = match.kwargs.get('subevent') if match is not None else None
+    return int(subevent) if subevent else None
+
+
+@receiver(html_head, dispatch_uid="pretix_pwyc_html_head")
+def add_pwyc_script(sender, request, **kwargs):
+    """Include the PWYC configuration and the price widget bundle once per page"""
     try:
-        if not is_pwyc_item(sender, item):
+        if getattr(request, 'pci_dss_payment_page', False):
             return ""
 
-        # Get PWYC settings for this item
-        min_amount = sender.settings.get(f'pwyc_min_amount_{item.pk}', '')
-        suggested_amount = sender.settings.get(f'pwyc_suggested_amount_{item.pk}', '')
-        explanation = sender.settings.get(f'pwyc_explanation_{item.pk}', '')
-
-        logger.info(f"PWYC: Adding JavaScript PWYC form for item {item.pk}")
-
-        # Return a simple data container that JavaScript can read
-        from django.utils.safestring import mark_safe
-        from django.utils.html import escape
-        import json
-
-        data = {
-            'item_id': item.pk,
-            'min_amount': min_amount,
-            'suggested_amount': suggested_amount,
-            'explanation': explanation,
-            'currency': sender.currency,
-        }
-
-        # Create safe JSON string
-        json_data = escape(json.dumps(data))
-
-        html = f'''
-        <div class="pwyc-container-{item.pk}">
-            <div class="pwyc-data" style="display: none;" data-pwyc='{json_data}'></div>
-            <div id="pwyc-form-{item.pk}"></div>
-        </div>
-        <script>
-        (function() {{
-            // Wait for DOM to be ready
-            function initPWYC() {{
-                var container = document.querySelector('.pwyc-container-{item.pk}');
-                if (!container) return;
-
-                var dataEl = container.querySelector('.pwyc-data[data-pwyc]');
-                var formContainer = container.querySelector('#pwyc-form-{item.pk}');
-
-                if (dataEl && formContainer && !formContainer.innerHTML) {{
-                    try {{
-                        var data = JSON.parse(dataEl.getAttribute('data-pwyc'));
-                        var formHtml = [
-                            '<div class="alert alert-info" style="margin-top: 15px;">',
-                            '<h4><i class="fa fa-heart"></i> Pay What You Can</h4>'
-                        ];
-
-                        if (data.explanation) {{
-                            formHtml.push('<p>' + data.explanation + '</p>');
-                        }}
-
-                        formHtml = formHtml.concat([
-                            '<div class="form-group">',
-                            '<label>Choose your price:</label>',
-                            '<div class="input-group">',
-                            '<input type="number" class="form-control pwyc-price-input" step="0.01"',
-                            ' min="' + (data.min_amount || '0') + '"',
-                            ' value="' + (data.suggested_amount || '') + '"',
-                            ' data-item-id="' + data.item_id + '"',
-                            ' placeholder="Enter amount">',
-                            '<span class="input-group-addon">' + data.currency + '</span>',
-                            '</div>'
-                        ]);
-
-                        if (data.min_amount) {{
-                            formHtml.push('<small class="help-block">Minimum: ' + data.min_amount + ' ' + data.currency + '</small>');
-                        }}
-
-                        if (data.suggested_amount) {{
-                            formHtml.push('<small class="help-block">Suggested: ' + data.suggested_amount + ' ' + data.currency + '</small>');
-                        }}
-
-                        formHtml.push('</div></div>');
-
-                        formContainer.innerHTML = formHtml.join('');
-
-                        // Add event listener for price changes
-                        var priceInput = formContainer.querySelector('.pwyc-price-input');
-                        if (priceInput) {{
-                            priceInput.addEventListener('change', function() {{
-                                var price = parseFloat(this.value);
-                                var itemId = this.getAttribute('data-item-id');
-                                var minPrice = parseFloat(this.getAttribute('min')) || 0;
-
-                                if (isNaN(price) || price < 0) {{
-                                    alert('Please enter a valid price.');
-                                    this.value = data.suggested_amount || minPrice;
-                                    return;
-                                }}
-
-                                if (price < minPrice) {{
-                                    alert('Price must be at least ' + minPrice + ' ' + data.currency);
-                                    this.value = minPrice;
-                                    price = minPrice;
-                                }}
-
-                                // Store the custom price in session via AJAX
-                                fetch('/pwyc/set-price/', {{
-                                    method: 'POST',
-                                    headers: {{
-                                        'Content-Type': 'application/json',
-                                        'X-CSRFToken': document.querySelector('[name=csrfmiddlewaretoken]')?.value || ''
-                                    }},
-                                    body: JSON.stringify({{
-                                        'item_id': itemId,
-                                        'price': price
-                                    }})
-                                }}).then(function(response) {{
-                                    if (response.ok) {{
-                                        console.log('PWYC price set:', price);
-                                        // Show success feedback
-                                        var feedback = formContainer.querySelector('.pwyc-feedback');
-                                        if (!feedback) {{
-                                            feedback = document.createElement('div');
-                                            feedback.className = 'pwyc-feedback alert alert-success';
-                                            feedback.style.marginTop = '10px';
-                                            formContainer.appendChild(feedback);
-                                        }}
-                                        feedback.textContent = 'Custom price saved: ' + price + ' ' + data.currency;
-                                        setTimeout(function() {{
-                                            if (feedback.parentNode) {{
-                                                feedback.parentNode.removeChild(feedback);
-                                            }}
-                                        }}, 3000);
-                                    }} else {{
-                                        console.error('Failed to set PWYC price');
-                                        alert('Failed to save price. Please try again.');
-                                    }}
-                                }}).catch(function(error) {{
-                                    console.error('Error setting PWYC price:', error);
-                                    alert('Failed to save price. Please try again.');
-                                }});
-                            }});
-                        }}
-                    }} catch (e) {{
-                        console.error('PWYC: Error parsing data or creating form:', e);
-                    }}
-                }}
-            }}
-
-            // Try to initialize immediately
-            if (document.readyState === 'loading') {{
-                document.addEventListener('DOMContentLoaded', initPWYC);
-            }} else {{
-                initPWYC();
-            }}
-        }})();
-        </script>
-        '''
-
-        return mark_safe(html)
+        return head_fragment(sender, subevent_id=_request_subevent_id(request))
+    except Exception:
+        storefront_logger.exception("PWYC: Error adding price widget script")
+        return ""
 
-    except Exception as e:
-        logger.error(f"PWYC: Error adding price form for item {item.pk}: {e}")
-        import traceback
-        logger.error(f"PWYC: Traceback: {traceback.format_exc()}")
+
+@receiver(item_description, dispatch_uid="pretix_pwyc_item_description")
+@timed('add_pwyc_price_form')
+def add_pwyc_price_form(sender, item, variation, **kwargs):
+    """
+    Add Pay What You Can marker for JavaScript to pick up
+
+    The description is run through pretix' HTML sanitizer, which only keeps the class
+    attribute of a div, so the item and variation are identified by class and their
+    configuration is served once per page by add_pwyc_script. Items with configured
+    variations get a marker per variation, all others one for the item.
+    """
+    try:
+        subevent = kwargs.get('subevent')
+        return item_fragment(
+            sender, item.pk,
+            subevent_id=subevent.pk if subevent is not None else None,
+            variation_id=variation.pk if variation is not None else None,
+        )
+    except Exception:
+        count_error('add_pwyc_price_form')
+        storefront_logger.exception("PWYC: Error adding price form for item %s", item.pk)
         return ""
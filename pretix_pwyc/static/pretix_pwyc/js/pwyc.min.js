@@ -0,0 +1,34 @@
+(function(){'use strict';var DEBOUNCE_MS=400;var config=null;var forms={};var pending={};var inFlight=null;var timer=null;function loadConfig(){var el=document.getElementById('pwyc-config');if(!el){return null;}
+try{return JSON.parse(el.textContent);}catch(e){console.error('PWYC: Error parsing configuration:',e);return null;}}
+function csrfToken(){var input=document.querySelector('[name=csrfmiddlewaretoken]');return input?input.value:'';}
+function element(tag,className,text){var el=document.createElement(tag);if(className){el.className=className;}
+if(text){el.textContent=text;}
+return el;}
+function itemId(container){var match=/(?:^|\s)pwyc-item-(\d+)(?:\s|$)/.exec(container.className);return match?match[1]:null;}
+function variationId(container){var match=/(?:^|\s)pwyc-variation-(\d+)(?:\s|$)/.exec(container.className);return match?match[1]:null;}
+function priceKey(id,variation){return variation?id+'_'+variation:id;}
+function showFeedback(form,text){var feedback=form.querySelector('.pwyc-feedback');if(!feedback){feedback=element('div','pwyc-feedback alert alert-success');feedback.style.marginTop='10px';form.appendChild(feedback);}
+feedback.textContent=text;setTimeout(function(){if(feedback.parentNode){feedback.parentNode.removeChild(feedback);}},3000);}
+function merge(target,source){for(var id in source){if(source.hasOwnProperty(id)&&!target.hasOwnProperty(id)){target[id]=source[id];}}
+return target;}
+function flush(keepalive){clearTimeout(timer);timer=null;var prices=pending;pending={};if(inFlight){merge(prices,inFlight.prices);if(inFlight.controller){inFlight.controller.abort();}}
+var entries=[];for(var key in prices){if(prices.hasOwnProperty(key)){var ids=key.split('_');entries.push({'item_id':ids[0],'variation_id':ids[1]||null,'price':prices[key].price,'version':prices[key].version});}}
+if(!entries.length){inFlight=null;return;}
+var request={prices:prices,controller:window.AbortController?new AbortController():null};inFlight=request;fetch(config.endpoint,{method:'POST',credentials:'same-origin',keepalive:!!keepalive,signal:request.controller?request.controller.signal:undefined,headers:{'Content-Type':'application/json','X-CSRFToken':csrfToken()},body:JSON.stringify({'prices':entries})}).then(function(response){if(inFlight===request){inFlight=null;}
+if(response.ok){return response.json().then(function(data){var saved=data.prices||{};for(var id in saved){if(saved.hasOwnProperty(id)&&forms[id]){showFeedback(forms[id],'Custom price saved: '+saved[id]+' '+config.currency);}}
+(data.rejected||[]).forEach(function(id){if(forms[id]){showFeedback(forms[id],'A price you chose more recently is already saved.');}});});}else{return response.json().then(function(data){console.error('Failed to set PWYC price:',data);alert(data&&data.error?data.error:'Failed to save price. Please try again.');},function(){alert('Failed to save price. Please try again.');});}}).catch(function(error){if(error&&error.name==='AbortError'){return;}
+if(inFlight===request){inFlight=null;}
+console.error('Error setting PWYC price:',error);alert('Failed to save price. Please try again.');});}
+function queuePrice(key,data,input){var price=parseFloat(input.value);var minPrice=parseFloat(data.min_amount)||0;if(isNaN(price)||price<0){alert('Please enter a valid price.');input.value=data.suggested_amount||minPrice;return;}
+if(price<minPrice){alert('Price must be at least '+minPrice+' '+config.currency);input.value=minPrice;price=minPrice;}
+pending[key]={price:price,version:Date.now()};clearTimeout(timer);timer=setTimeout(function(){flush(false);},DEBOUNCE_MS);}
+function render(container){var id=itemId(container);var variation=variationId(container);var data=id&&config.items[id];if(data&&variation&&data.variations&&data.variations[variation]){data=data.variations[variation];}
+if(!data||container.getAttribute('data-pwyc-rendered')){return;}
+var key=priceKey(id,variation);container.setAttribute('data-pwyc-rendered','true');var form=element('div','alert alert-info pwyc-form');form.style.marginTop='15px';var title=element('h4');title.appendChild(element('i','fa fa-heart'));title.appendChild(document.createTextNode(' Pay What You Can'));form.appendChild(title);if(data.explanation){form.appendChild(element('p','pwyc-explanation',data.explanation));}
+var group=element('div','form-group');group.appendChild(element('label',null,'Choose your price:'));var inputGroup=element('div','input-group');var input=element('input','form-control pwyc-price-input');input.type='number';input.step='0.01';input.min=data.min_amount||'0';input.value=data.suggested_amount||'';input.placeholder='Enter amount';input.setAttribute('data-item-id',id);if(variation){input.setAttribute('data-variation-id',variation);}
+inputGroup.appendChild(input);inputGroup.appendChild(element('span','input-group-addon',config.currency));group.appendChild(inputGroup);if(data.min_amount){group.appendChild(element('small','help-block','Minimum: '+data.min_amount+' '+config.currency));}
+if(data.suggested_amount){group.appendChild(element('small','help-block','Suggested: '+data.suggested_amount+' '+config.currency));}
+form.appendChild(group);input.addEventListener('change',function(){queuePrice(key,data,input);});forms[key]=form;container.appendChild(form);}
+function init(){config=config||loadConfig();if(!config){return;}
+var containers=document.querySelectorAll('.pwyc-data');for(var i=0;i<containers.length;i++){render(containers[i]);}}
+document.addEventListener('submit',function(){if(timer){flush(true);}},true);window.addEventListener('pagehide',function(){if(timer){flush(true);}});window.PWYC={init:init,flush:flush};if(document.readyState==='loading'){document.addEventListener('DOMContentLoaded',init);}else{init();}}());
\ No newline at end of file
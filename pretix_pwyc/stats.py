@@ -0,0 +1,145 @@
+import bisect
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Count
+from pretix.base.models import Order, OrderPosition
+
+from .config import get_config_snapshot
+from .models import PWYCCountedOrder, PWYCPriceStats
+
+#: Lower bounds of the buckets of the price histogram, the last bucket is open-ended
+HISTOGRAM_BOUNDS = (0, 5, 10, 15, 20, 25, 30, 40, 50, 75, 100, 150, 200)
+
+
+def histogram_labels():
+    labels = [f'{lower}–{upper}' for lower, upper in zip(HISTOGRAM_BOUNDS, HISTOGRAM_BOUNDS[1:])]
+    return labels + [f'≥ {HISTOGRAM_BOUNDS[-1]}']
+
+
+def _bucket(price):
+    return max(bisect.bisect_right(HISTOGRAM_BOUNDS, price) - 1, 0)
+
+
+def _apply(stats, prices, sign):
+    """
+    Add (``sign=1``) or remove (``sign=-1``) ``(price, suggested amount, count)`` entries from
+    the aggregates of one item
+    """
+    histogram = stats.histogram or [0] * len(HISTOGRAM_BOUNDS)
+    for price, suggested, count in prices:
+        n = sign * count
+        stats.count += n
+        stats.total += n * price
+        stats.total_squares += n * price * price
+        histogram[_bucket(price)] += n
+        if suggested is not None:
+            if price < suggested:
+                stats.below_suggested += n
+            elif price == suggested:
+                stats.at_suggested += n
+            else:
+                stats.above_suggested += n
+        if sign > 0:
+            stats.min_price = price if stats.min_price is None else min(stats.min_price, price)
+            stats.max_price = price if stats.max_price is None else max(stats.max_price, price)
+    if stats.count <= 0:
+        # Nothing left, start over
+        stats.count, stats.total, stats.total_squares = 0, Decimal('0.00'), Decimal('0')
+        stats.min_price = stats.max_price = None
+        histogram = [0] * len(HISTOGRAM_BOUNDS)
+        stats.below_suggested = stats.at_suggested = stats.above_suggested = 0
+    stats.histogram = histogram
+
+
+def _pwyc_prices(snapshot, positions):
+    """
+    ``(price, suggested amount, count)`` entries per item of the ``positions`` PWYC applies to,
+    with the suggested amount of their variation and date. Counting, uncounting and rebuilding
+    all select positions with this, so they agree on what is counted.
+    """
+    rows = positions.filter(item_id__in=snapshot.enabled_item_ids()).order_by().values_list(
+        'item_id', 'variation_id', 'subevent_id', 'price'
+    ).annotate(count=Count('id'))
+    item_prices = defaultdict(list)
+    for item_id, variation_id, subevent_id, price, count in rows:
+        config = snapshot.get(item_id, subevent_id, variation_id)
+        if config is not None and config.enabled:
+            item_prices[item_id].append((price, config.suggested_amount, count))
+    return item_prices
+
+
+def _update(event, item_prices, sign):
+    if sign > 0:
+        for item_id in item_prices:
+            PWYCPriceStats.objects.get_or_create(item_id=item_id, defaults={'event': event})
+    # Concurrent updates of the same item wait for each other here
+    existing = PWYCPriceStats.objects.select_for_update().filter(item_id__in=item_prices)
+    for stats in existing:
+        _apply(stats, item_prices[stats.item_id], sign)
+        stats.save()
+
+
+def count_order(order):
+    """
+    Add the PWYC positions of a paid order to the statistics. Does nothing if the order is
+    not paid or already counted.
+
+    The cost depends on the size of the order only, not on the number of orders of the event.
+    """
+    if order.status != Order.STATUS_PAID:
+        return
+    item_prices = _pwyc_prices(get_config_snapshot(order.event), order.positions.all())
+    if not item_prices:
+        return
+    with transaction.atomic():
+        _, created = PWYCCountedOrder.objects.get_or_create(order=order, defaults={'event': order.event})
+        if created:
+            _update(order.event, item_prices, 1)
+
+
+def uncount_order(order):
+    """
+    Remove the PWYC positions of a counted order from the statistics, selected like they were
+    counted, including positions canceled together with the order.
+
+    Minimum and maximum are not recomputed, neither are positions whose PWYC configuration
+    or suggested amount changed in the meantime, until the statistics are rebuilt.
+    """
+    with transaction.atomic():
+        deleted, _ = PWYCCountedOrder.objects.filter(order=order).delete()
+        if not deleted:
+            return
+        item_prices = _pwyc_prices(get_config_snapshot(order.event), OrderPosition.all.filter(order=order))
+        _update(order.event, item_prices, -1)
+
+
+def rebuild_stats(event):
+    """
+    Recompute the statistics of an event from all of its paid orders. Positions are grouped
+    by the database, so the rows read depend on the number of distinct prices, not positions.
+    """
+    snapshot = get_config_snapshot(event)
+    positions = OrderPosition.objects.filter(order__event=event, order__status=Order.STATUS_PAID)
+    stats = []
+    for item_id, prices in _pwyc_prices(snapshot, positions).items():
+        item_stats = PWYCPriceStats(event=event, item_id=item_id)
+        _apply(item_stats, prices, 1)
+        stats.append(item_stats)
+    order_ids = {
+        order_id
+        for order_id, item_id, variation_id, subevent_id in positions.filter(
+            item_id__in=snapshot.enabled_item_ids()
+        ).order_by().values_list('order_id', 'item_id', 'variation_id', 'subevent_id').distinct()
+        if snapshot.is_enabled(item_id, subevent_id, variation_id)
+    }
+    with transaction.atomic():
+        PWYCPriceStats.objects.filter(event=event).delete()
+        PWYCCountedOrder.objects.filter(event=event).delete()
+        PWYCPriceStats.objects.bulk_create(stats, batch_size=500)
+        PWYCCountedOrder.objects.bulk_create(
+            [PWYCCountedOrder(order_id=order_id, event=event) for order_id in order_ids],
+            batch_size=1000,
+        )
+    return stats
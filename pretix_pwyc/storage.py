@@ -0,0 +1,282 @@
+import time
+from decimal import Decimal, InvalidOperation
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core import signing
+from django.db import transaction
+from django.utils.timezone import now
+from pretix.helpers.cookies import set_cookie_without_samesite
+
+from .models import PWYCCartPrice
+
+
+def serialize_price_key(item_id, variation_id):
+    """Key of a price in JSON, like the price widget uses: ``item_id`` or ``item_id_variation_id``"""
+    return f'{item_id}_{variation_id}' if variation_id else str(item_id)
+
+
+def _to_decimal(value):
+    # Prices are stored as strings of already validated and quantized Decimals
+    try:
+        return Decimal(value if isinstance(value, str) else str(value))
+    except (InvalidOperation, TypeError, ValueError):
+        return None
+
+
+def _parse_prices(data):
+    """Convert a dictionary of prices keyed by ``serialize_price_key()`` to the format of the price stores"""
+    prices = {}
+    for key, value in data.items():
+        ids = str(key).split('_')
+        price = _to_decimal(value)
+        if price is None or not all(i.isdigit() for i in ids) or len(ids) > 2:
+            continue
+        prices[(int(ids[0]), int(ids[1]) if len(ids) > 1 else None)] = price
+    return prices
+
+
+def new_price_version():
+    """Version of a price chosen now, in the milliseconds the price widget stamps prices with"""
+    return time.time_ns() // 1_000_000
+
+
+def serialize_prices(prices):
+    """Convert prices of a price store to a JSON-serializable dictionary keyed by ``serialize_price_key()``"""
+    return {serialize_price_key(item_id, variation_id): str(price) for (item_id, variation_id), price in prices.items()}
+
+
+class BasePriceStore:
+    """
+    Storage for the prices customers chose for PWYC items.
+
+    Prices are passed around as dictionaries mapping ``(item_id, variation_id)`` to a
+    ``Decimal``, with ``variation_id`` being ``None`` for prices that apply to all
+    variations of an item.
+
+    ``versions`` maps the same keys to the time in milliseconds a price was chosen at. Stores
+    that support it keep a stored price if it is newer than the one being set, so prices sent
+    from several tabs or retried requests cannot replace a price chosen later.
+    """
+    identifier = None
+
+    def __init__(self, event):
+        self.event = event
+
+    def get_prices(self, request, cart_ids=None):
+        """Return all prices stored for the given request and carts"""
+        raise NotImplementedError()
+
+    def set_prices(self, request, response, prices, versions=None):
+        """
+        Store the given prices, ``response`` is the response that will be sent for ``request``.
+        Returns the prices that were stored.
+        """
+        raise NotImplementedError()
+
+    async def aset_prices(self, request, response, prices, versions=None):
+        """Async variant of set_prices, runs set_prices in a thread unless overridden"""
+        return await sync_to_async(self.set_prices)(request, response, prices, versions)
+
+
+class SessionPriceStore(BasePriceStore):
+    """
+    Stores prices in the customer's session. Every change causes a session write.
+
+    All prices of an event are kept in a single session entry that is read and written as a
+    whole. The ``pwyc_prices`` entry of prices set through the retired URL without an event
+    is ignored, these prices were never validated against an event.
+
+    Sessions from before this layout store every price in a ``pwyc_price_<item>[_<variation>]``
+    key of its own. These are moved into the entry of the event the first time the session is
+    read, which requires looking at all keys of sessions that have no entry yet. Once all such
+    sessions have expired, this can be turned off in pretix.cfg:
+
+        [pretix_pwyc]
+        session_legacy_keys=off
+
+    The session is saved as a whole at the end of the request, so concurrent requests of the
+    same customer, e.g. from two tabs, can overwrite each other's prices. Versions are ignored.
+    """
+    identifier = 'session'
+    legacy_prefix = 'pwyc_price_'
+
+    @property
+    def session_key(self):
+        return f'pwyc_prices_{self.event.pk}'
+
+    def _migrate_legacy_keys(self, items):
+        """Return the prices and keys of a session that uses the layout from before the entry per event"""
+        data, legacy_keys = {}, []
+        for key, value in items:
+            if isinstance(key, str) and key.startswith(self.legacy_prefix):
+                legacy_keys.append(key)
+                data[key[len(self.legacy_prefix):]] = value
+        return data, legacy_keys
+
+    def _migrate_legacy_keys_enabled(self):
+        return settings.CONFIG_FILE.getboolean('pretix_pwyc', 'session_legacy_keys', fallback=True)
+
+    def _load(self, session):
+        data = session.get(self.session_key)
+        if data is None and self._migrate_legacy_keys_enabled():
+            data, legacy_keys = self._migrate_legacy_keys(list(session.items()))
+            if legacy_keys:
+                for key in legacy_keys:
+                    del session[key]
+                session[self.session_key] = data
+        return data or {}
+
+    def get_prices(self, request, cart_ids=None):
+        if not request or not hasattr(request, 'session'):
+            return {}
+        return _parse_prices(self._load(request.session))
+
+    def set_prices(self, request, response, prices, versions=None):
+        data = dict(self._load(request.session))
+        data.update(serialize_prices(prices))
+        request.session[self.session_key] = data
+        return prices
+
+    async def aset_prices(self, request, response, prices, versions=None):
+        session = request.session
+        if not hasattr(session, 'aset'):
+            # Django < 5.0 has no async session API
+            return await super().aset_prices(request, response, prices, versions)
+        data = await session.aget(self.session_key)
+        if data is None and self._migrate_legacy_keys_enabled():
+            data, legacy_keys = self._migrate_legacy_keys(await session.aitems())
+            for key in legacy_keys:
+                await session.apop(key)
+        data = dict(data or {})
+        data.update(serialize_prices(prices))
+        await session.aset(self.session_key, data)
+        return prices
+
+
+class CartPriceStore(BasePriceStore):
+    """
+    Stores prices in the database next to the pretix cart they belong to, independent of the session.
+
+    Every price is a row of its own and is written with atomic statements: a new row is
+    inserted unless it exists, an existing one is only updated if its version is older. Requests
+    that set different prices of the same cart do not affect each other, and of concurrent
+    requests setting the same price the one chosen last wins, in whatever order they arrive.
+    """
+    identifier = 'cart'
+
+    def _cart_id(self, request, create):
+        from pretix.presale.views.cart import get_or_create_cart_id
+
+        if not request or not hasattr(request, 'session'):
+            return None
+        return get_or_create_cart_id(request, create=create)
+
+    def get_prices(self, request, cart_ids=None):
+        if cart_ids is None:
+            cart_id = self._cart_id(request, create=False)
+            cart_ids = [cart_id] if cart_id else []
+        cart_ids = [c for c in cart_ids if c]
+        if not cart_ids:
+            return {}
+        return {
+            (item_id, variation_id): price
+            for item_id, variation_id, price in PWYCCartPrice.objects.filter(
+                event=self.event, cart_id__in=cart_ids
+            ).values_list('item_id', 'variation_id', 'price')
+        }
+
+    def set_prices(self, request, response, prices, versions=None):
+        cart_id = self._cart_id(request, create=True)
+        version = new_price_version()
+        versions = {key: (versions or {}).get(key) or version for key in prices}
+        rows = PWYCCartPrice.objects.filter(event=self.event, cart_id=cart_id)
+        with transaction.atomic():
+            PWYCCartPrice.objects.bulk_create([
+                PWYCCartPrice(
+                    event=self.event, cart_id=cart_id, item_id=item_id, variation_id=variation_id,
+                    price=price, version=versions[(item_id, variation_id)],
+                )
+                for (item_id, variation_id), price in prices.items()
+            ], ignore_conflicts=True)
+            for (item_id, variation_id), price in prices.items():
+                # Compare and set, prices inserted above already have this version
+                rows.filter(
+                    item_id=item_id, variation_id=variation_id, version__lt=versions[(item_id, variation_id)]
+                ).update(price=price, version=versions[(item_id, variation_id)], datetime=now())
+            # Rows written by this request stay locked until it commits
+            stored = {
+                (item_id, variation_id): (price, version)
+                for item_id, variation_id, price, version in rows.filter(
+                    item_id__in={item_id for item_id, _ in prices}
+                ).values_list('item_id', 'variation_id', 'price', 'version')
+            }
+        return {key: price for key, price in prices.items() if stored.get(key) == (price, versions[key])}
+
+
+class SignedCookiePriceStore(BasePriceStore):
+    """
+    Stores prices in a signed cookie, which requires no server-side writes at all.
+
+    The cookie of the response answered last wins, versions are ignored.
+    """
+    identifier = 'cookie'
+    salt = 'pretix_pwyc.prices'
+    max_age = 7 * 24 * 3600
+
+    @property
+    def cookie_name(self):
+        return f'pwyc_prices_{self.event.pk}'
+
+    def _load(self, request):
+        if not request or self.cookie_name not in getattr(request, 'COOKIES', {}):
+            return {}
+        try:
+            data = signing.loads(request.COOKIES[self.cookie_name], salt=self.salt, max_age=self.max_age)
+        except signing.BadSignature:
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def get_prices(self, request, cart_ids=None):
+        return _parse_prices(self._load(request))
+
+    def set_prices(self, request, response, prices, versions=None):
+        data = self._load(request)
+        data.update(serialize_prices(prices))
+        set_cookie_without_samesite(
+            request, response, self.cookie_name,
+            signing.dumps(data, salt=self.salt, compress=True),
+            max_age=self.max_age,
+            httponly=True,
+        )
+        return prices
+
+    async def aset_prices(self, request, response, prices, versions=None):
+        # Only touches the request and response
+        return self.set_prices(request, response, prices, versions)
+
+
+PRICE_STORES = {
+    store.identifier: store
+    for store in (SessionPriceStore, CartPriceStore, SignedCookiePriceStore)
+}
+
+
+def get_price_store(event):
+    """
+    Return the price store configured in the ``[pretix_pwyc]`` section of pretix.cfg:
+
+        [pretix_pwyc]
+        price_store=cart
+
+    ``cart`` (default), ``cookie`` and ``session`` are available.
+    """
+    identifier = settings.CONFIG_FILE.get('pretix_pwyc', 'price_store', fallback='cart')
+    return PRICE_STORES.get(identifier, CartPriceStore)(event)
+
+
+def lookup_price(prices, item_id, variation_id):
+    """Return the stored price of an item, preferring a variation-specific price"""
+    if variation_id and (item_id, variation_id) in prices:
+        return prices[(item_id, variation_id)]
+    return prices.get((item_id, None))
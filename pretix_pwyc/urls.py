@@ -4,7 +4,18 @@ from . import views
 urlpatterns = [
     path('control/event/<str:organizer>/<str:event>/settings/pwyc/',
          views.PWYCSettingsView.as_view(), name='settings'),
+    path('control/event/<str:organizer>/<str:event>/settings/pwyc/metrics/',
+         views.PWYCMetricsView.as_view(), name='metrics'),
 
-    # AJAX endpoint for setting custom prices (no organizer/event in path for simplicity)
+    # Retired AJAX endpoint without organizer/event in path, answers 410
     path('pwyc/set-price/', views.PWYCSetPriceView.as_view(), name='set_price'),
+
+    # Async variant of event.set_price, which resolves the event itself
+    path('<str:organizer>/<str:event>/pwyc/async/set-price/',
+         views.AsyncPWYCSetPriceView.as_view(), name='event.async_set_price'),
+]
+
+event_patterns = [
+    # AJAX endpoint for setting custom prices in the configured price store
+    path('pwyc/set-price/', views.PWYCSetPriceView.as_view(), name='event.set_price'),
 ]
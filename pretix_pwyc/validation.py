@@ -0,0 +1,103 @@
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from pretix.base.decimal import round_decimal
+
+#: Largest value that fits the price columns of pretix and the plugin
+PRICE_LIMIT = Decimal('99999999999.99')
+
+
+class PriceError(ValueError):
+    """
+    A price that cannot be accepted. ``code`` identifies the problem for clients, the
+    message is meant for humans.
+    """
+
+    def __init__(self, code, message, item_id=None, variation_id=None):
+        super().__init__(message)
+        self.code = code
+        self.item_id = item_id
+        self.variation_id = variation_id
+
+    def as_dict(self):
+        data = {'code': self.code, 'message': str(self)}
+        if self.item_id is not None:
+            data['item_id'] = self.item_id
+        if self.variation_id is not None:
+            data['variation_id'] = self.variation_id
+        return data
+
+
+def parse_price(value):
+    """Convert a price from a request to a finite Decimal, without going through float"""
+    if isinstance(value, bool) or not isinstance(value, (str, int, Decimal)):
+        raise PriceError('invalid_format', 'Invalid price format')
+    try:
+        price = Decimal(value.strip() if isinstance(value, str) else value)
+    except InvalidOperation:
+        raise PriceError('invalid_format', 'Invalid price format')
+    if not price.is_finite():
+        raise PriceError('invalid_format', 'Invalid price format')
+    if price < 0:
+        raise PriceError('negative', 'Price cannot be negative')
+    return price
+
+
+def max_price():
+    """
+    Upper bound for custom prices, configurable in pretix.cfg:
+
+        [pretix_pwyc]
+        max_price=100000
+    """
+    value = settings.CONFIG_FILE.get('pretix_pwyc', 'max_price', fallback=None)
+    return min(Decimal(value), PRICE_LIMIT) if value else PRICE_LIMIT
+
+
+def validate_price(snapshot, currency, item_id, variation_id, price):
+    """
+    Check a parsed price against the configuration snapshot of the event and return it
+    quantized to the currency. Raises PriceError.
+
+    The date the price is meant for is not known here, so the loosest configuration of the
+    item across all dates applies. The limits of the actual date are enforced when the
+    price is applied to the cart.
+    """
+    config = snapshot.get_permissive(item_id, variation_id) if snapshot is not None else None
+    if snapshot is not None and (config is None or not config.enabled):
+        raise PriceError('item_unavailable', 'This product does not allow choosing a price', item_id, variation_id)
+
+    quantized = round_decimal(price, currency)
+    if quantized != price:
+        raise PriceError('invalid_precision', 'Price has too many decimal places', item_id, variation_id)
+
+    minimum = config.min_amount if config is not None and config.min_amount is not None else Decimal('0')
+    if quantized < minimum:
+        raise PriceError('below_minimum', f'Price must be at least {minimum}', item_id, variation_id)
+    maximum = max_price()
+    if quantized > maximum:
+        raise PriceError('above_maximum', f'Price must not exceed {maximum}', item_id, variation_id)
+    return quantized
+
+
+def validate_prices(snapshot, currency, prices):
+    """
+    Validate a dictionary of parsed prices keyed by ``(item_id, variation_id)``. Return the
+    quantized prices, or raise PriceValidationError with the problems of all prices.
+    """
+    validated = {}
+    errors = []
+    for (item_id, variation_id), price in prices.items():
+        try:
+            validated[(item_id, variation_id)] = validate_price(snapshot, currency, item_id, variation_id, price)
+        except PriceError as e:
+            errors.append(e)
+    if errors:
+        raise PriceValidationError(errors)
+    return validated
+
+
+class PriceValidationError(ValueError):
+    def __init__(self, errors):
+        super().__init__(str(errors[0]))
+        self.errors = errors
@@ -1,19 +1,35 @@
 from django.contrib import messages
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
 from django.shortcuts import redirect
 from django.urls import reverse
 from django.utils.translation import gettext_lazy as _
 from django.views.generic import FormView
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.utils.decorators import method_decorator
 from django.views import View
+from django_scopes import scope, scopes_disabled
+from asgiref.sync import sync_to_async
 import json
-import logging
+import math
+from decimal import Decimal
+from pretix.base.models import Event
+from pretix.control.permissions import AdministratorPermissionRequiredMixin
 from pretix.control.views.event import EventSettingsViewMixin
-from .forms import PWYCSettingsForm
+from .bridge import convert_event
+from .cart import stamp_cart
+from .config import get_config_snapshot, invalidate_config
+from .forms import PWYCBulkItemFormSet, PWYCSettingsForm
+from .fragments import fragment_stats, schedule_prewarm
+from .log import get_logger
+from .metrics import count_error, get_metrics, render_prometheus, timed
+from .ratelimit import acheck_rate_limit, check_rate_limit
+from .storage import BasePriceStore, get_price_store, new_price_version, serialize_price_key
+from .validation import PriceError, PriceValidationError, parse_price, validate_prices
 
-logger = logging.getLogger(__name__)
+logger = get_logger(__name__, 'set_price')
 
 
 class PWYCSettingsView(EventSettingsViewMixin, FormView):
@@ -33,44 +49,313 @@ class PWYCSettingsView(EventSettingsViewMixin, FormView):
             'event': self.request.event.slug,
         })
 
-    def form_valid(self, form):
-        form.save()
+    def get_items_formset(self):
+        return PWYCBulkItemFormSet(
+            data=self.request.POST if self.request.method == 'POST' else None,
+            event=self.request.event,
+        )
+
+    def get_context_data(self, **kwargs):
+        if 'items_formset' not in kwargs:
+            kwargs['items_formset'] = self.get_items_formset()
+        return super().get_context_data(**kwargs)
+
+    def post(self, request, *args, **kwargs):
+        form = self.get_form()
+        items_formset = self.get_items_formset()
+        if form.is_valid() and items_formset.is_valid():
+            return self.form_valid(form, items_formset)
+        messages.error(self.request, _('We could not save your changes. See below for details.'))
+        return self.render_to_response(self.get_context_data(form=form, items_formset=items_formset))
+
+    def form_valid(self, form, items_formset):
+        with transaction.atomic():
+            form.save()
+            changed = items_formset.save(user=self.request.user)
+            if 'pwyc_native_pricing' in form.changed_data:
+                convert_event(self.request.event, form.cleaned_data['pwyc_native_pricing'])
+        if not changed:
+            # Saving changed item configurations already invalidated the configuration
+            invalidate_config(self.request.event)
+        schedule_prewarm(self.request.event)
         messages.success(self.request, _('Your settings have been saved.'))
-        return super().form_valid(form)
+        return redirect(self.get_success_url())
+
+
+class SetPriceMixin:
+    """
+    Request parsing, validation and responses of the set-price endpoints
+
+    Accepts either a single ``{"item_id": ..., "price": ...}`` object or a batch
+    ``{"prices": [{"item_id": ..., "variation_id": ..., "price": ...}, ...]}``, which
+    is applied with a single write to the price store. Entries may carry the time in
+    milliseconds the price was chosen at as ``version``, see BasePriceStore. Client clocks
+    cannot be trusted, so versions are moved into ``max_version_skew`` around the server time:
+    a clock that runs behind cannot lose newer prices, and one ahead cannot pin a price.
+
+    Prices a store kept a newer price for are listed as ``"rejected"`` in the response.
+
+    Prices are validated as Decimals against the PWYC configuration of the event. Invalid
+    requests are answered with ``{"error": ..., "errors": [{"code": ..., "message": ...,
+    "item_id": ...}, ...]}`` and nothing is stored.
+    """
+    max_batch_size = 100
+    #: Versions are milliseconds, they must fit the database column and a JavaScript number
+    max_version = 2 ** 53
+    #: Milliseconds a version may differ from the server time
+    max_version_skew = 60 * 1000
+
+    def _parse_version(self, version):
+        if version is None:
+            return None
+        if isinstance(version, bool) or not isinstance(version, (int, str)) or not str(version).isdigit():
+            raise PriceError('invalid_version', 'Invalid version')
+        version = int(version)
+        if not 0 < version < self.max_version:
+            raise PriceError('invalid_version', 'Invalid version')
+        return version
+
+    def _parse_entry(self, entry):
+        if not isinstance(entry, dict):
+            raise PriceError('invalid_entry', 'Invalid price entry')
+
+        item_id = entry.get('item_id')
+        variation_id = entry.get('variation_id')
+        price = entry.get('price')
+
+        if not item_id or price is None:
+            raise PriceError('missing_field', 'Missing item_id or price')
+
+        try:
+            item_id = int(item_id)
+            variation_id = int(variation_id) if variation_id else None
+        except (ValueError, TypeError):
+            raise PriceError('invalid_item', 'Invalid item_id')
+
+        try:
+            price = parse_price(price)
+            version = self._parse_version(entry.get('version'))
+        except PriceError as e:
+            e.item_id, e.variation_id = item_id, variation_id
+            raise
+        return item_id, variation_id, price, version
+
+    def _reject_constant(self, value):
+        raise PriceError('invalid_format', 'Invalid price format')
+
+    def parse_prices(self, body):
+        """
+        Return the prices of a request body, their versions and whether it was a batch, raise
+        PriceError if invalid
+        """
+        try:
+            data = json.loads(body, parse_float=Decimal, parse_constant=self._reject_constant)
+        except ValueError as e:
+            if isinstance(e, PriceError):
+                raise
+            raise PriceError('invalid_json', 'Invalid JSON')
+        batch = isinstance(data, dict) and 'prices' in data
+        entries = data['prices'] if batch else [data]
+
+        if not isinstance(entries, list) or not entries:
+            raise PriceError('missing_prices', 'Missing prices')
+        if len(entries) > self.max_batch_size:
+            raise PriceError('too_many_prices', 'Too many prices')
+
+        prices, versions = {}, {}
+        server_version = new_price_version()
+        for entry in entries:
+            item_id, variation_id, price, version = self._parse_entry(entry)
+            prices[(item_id, variation_id)] = price
+            if version is not None:
+                versions[(item_id, variation_id)] = min(
+                    max(version, server_version - self.max_version_skew), server_version + self.max_version_skew
+                )
+        return prices, versions, batch
+
+    def validate(self, request, snapshot, prices):
+        """Return the prices quantized to the event currency, raise PriceValidationError if invalid"""
+        event = getattr(request, 'event', None)
+        return validate_prices(snapshot, event.currency if event else None, prices)
+
+    def success_response(self, response, prices, stored, batch):
+        """Write the prices that were stored, and the ones that were not, into ``response``"""
+        rejected = [serialize_price_key(*key) for key in prices if key not in stored]
+        if batch:
+            data = {'success': True, 'prices': {
+                serialize_price_key(item_id, variation_id): float(price)
+                for (item_id, variation_id), price in stored.items()
+            }}
+        elif stored:
+            data = {'success': True, 'price': float(next(iter(stored.values())))}
+        else:
+            data = {'error': 'A more recent price was already saved'}
+            response.status_code = 409
+        if rejected:
+            data['rejected'] = rejected
+        response.content = json.dumps(data, cls=DjangoJSONEncoder)
+        return response
+
+    def error_response(self, errors):
+        return JsonResponse({
+            'error': str(errors[0]),
+            'errors': [e.as_dict() for e in errors],
+        }, status=400)
+
+    def rate_limited_response(self, retry_after):
+        logger.info("PWYC: Rate limited set-price request, retry after %.1fs", retry_after)
+        response = JsonResponse({'error': 'Too many requests'}, status=429)
+        response['Retry-After'] = str(math.ceil(retry_after))
+        return response
+
+    def get_store(self, request):
+        return get_price_store(request.event)
+
+    def update_cart(self, request, snapshot, prices):
+        """Write the new prices onto the positions already in the customer's cart"""
+        from pretix.presale.views.cart import get_or_create_cart_id
+
+        if not hasattr(request, 'session'):
+            return []
+        # The async view runs outside of pretix' event middleware and its scope
+        with scope(organizer=request.event.organizer):
+            return stamp_cart(request.event, get_or_create_cart_id(request, create=False), prices, snapshot)
+
+    def save_prices(self, request, response, store, snapshot, prices, versions):
+        """
+        Store the prices and write the ones that were stored onto the cart in one transaction,
+        so a request that stored a newer price writes it onto the cart after this one
+        """
+        with transaction.atomic():
+            stored = store.set_prices(request, response, prices, versions)
+            self.update_cart(request, snapshot, stored)
+        return stored
+
+    async def asave_prices(self, request, response, store, snapshot, prices, versions):
+        if type(store).aset_prices is BasePriceStore.aset_prices:
+            # Stores without an async API write in a thread anyway, together with the cart
+            return await sync_to_async(self.save_prices)(request, response, store, snapshot, prices, versions)
+        stored = await store.aset_prices(request, response, prices, versions)
+        await sync_to_async(self.update_cart)(request, snapshot, stored)
+        return stored
 
 
 @method_decorator(csrf_exempt, name='dispatch')
-class PWYCSetPriceView(View):
-    """AJAX view to set custom price in session"""
+class PWYCSetPriceView(SetPriceMixin, View):
+    """
+    AJAX view to set custom prices, see SetPriceMixin for the request format
+
+    Mounted below an event, prices go to the configured price store. The legacy URL
+    without an event is retired: prices could not be validated there, and were applied to
+    every event. It answers 410 so pages cached from before get an error they can show.
+
+    Requests are throttled per session, IP address and event, see ``ratelimit.py``.
+    """
 
+    @timed('set_price')
     def post(self, request, *args, **kwargs):
+        retry_after = check_rate_limit(request)
+        if retry_after:
+            return self.rate_limited_response(retry_after)
+
+        if not getattr(request, 'event', None):
+            response = self.error_response([PriceError('no_event', 'Prices can only be set for an event')])
+            response.status_code = 410
+            return response
+
         try:
-            data = json.loads(request.body)
-            item_id = data.get('item_id')
-            price = data.get('price')
-
-            if not item_id or price is None:
-                return JsonResponse({'error': 'Missing item_id or price'}, status=400)
-
-            # Validate price
-            try:
-                price = float(price)
-                if price < 0:
-                    return JsonResponse({'error': 'Price cannot be negative'}, status=400)
-            except (ValueError, TypeError):
-                return JsonResponse({'error': 'Invalid price format'}, status=400)
-
-            # Store in session
-            session_key = f'pwyc_price_{item_id}'
-            request.session[session_key] = str(price)
-            request.session.modified = True
-
-            logger.info(f"PWYC: Set custom price {price} for item {item_id} in session")
-
-            return JsonResponse({'success': True, 'price': price})
-
-        except json.JSONDecodeError:
-            return JsonResponse({'error': 'Invalid JSON'}, status=400)
-        except Exception as e:
-            logger.error(f"PWYC: Error setting price: {e}")
+            prices, versions, batch = self.parse_prices(request.body)
+            snapshot = get_config_snapshot(request.event)
+            prices = self.validate(request, snapshot, prices)
+
+            # All prices of the batch are stored with one write, the store may set cookies
+            response = JsonResponse({})
+            store = self.get_store(request)
+            stored = self.save_prices(request, response, store, snapshot, prices, versions)
+
+            logger.detail("PWYC: Set custom prices %s in %s store", stored, store.identifier)
+
+            return self.success_response(response, prices, stored, batch)
+
+        except PriceValidationError as e:
+            return self.error_response(e.errors)
+        except PriceError as e:
+            return self.error_response([e])
+        except Exception:
+            count_error('set_price')
+            logger.exception("PWYC: Error setting price")
             return JsonResponse({'error': 'Internal error'}, status=500)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncPWYCSetPriceView(SetPriceMixin, View):
+    """
+    Async variant of PWYCSetPriceView with the same request format and responses
+
+    pretix wraps the views in ``event_patterns`` into synchronous event handling, so this view
+    is mounted in ``urlpatterns`` and looks the event up itself. The rate limiter, session and
+    price store are accessed through their async APIs where the backend offers them. Under
+    WSGI, Django runs the view in an event loop of its own.
+    """
+
+    @classmethod
+    async def get_event(cls, organizer, event):
+        """Return the live event with the plugin enabled, or None"""
+        try:
+            with scopes_disabled():
+                event = await Event.objects.select_related('organizer').aget(
+                    organizer__slug=organizer, slug=event, live=True
+                )
+        except Event.DoesNotExist:
+            return None
+        return event if 'pretix_pwyc' in event.get_plugins() else None
+
+    @timed('set_price')
+    async def post(self, request, *args, **kwargs):
+        request.event = await self.get_event(kwargs['organizer'], kwargs['event'])
+        if request.event is None:
+            return JsonResponse({'error': 'Unknown event'}, status=404)
+
+        retry_after = await acheck_rate_limit(request)
+        if retry_after:
+            return self.rate_limited_response(retry_after)
+
+        try:
+            prices, versions, batch = self.parse_prices(request.body)
+            snapshot = await sync_to_async(get_config_snapshot)(request.event)
+            prices = self.validate(request, snapshot, prices)
+
+            response = JsonResponse({})
+            store = self.get_store(request)
+            stored = await self.asave_prices(request, response, store, snapshot, prices, versions)
+
+            logger.detail("PWYC: Set custom prices %s in %s store", stored, store.identifier)
+
+            return self.success_response(response, prices, stored, batch)
+
+        except PriceValidationError as e:
+            return self.error_response(e.errors)
+        except PriceError as e:
+            return self.error_response([e])
+        except Exception:
+            count_error('set_price')
+            logger.exception("PWYC: Error setting price")
+            return JsonResponse({'error': 'Internal error'}, status=500)
+
+
+class PWYCMetricsView(AdministratorPermissionRequiredMixin, View):
+    """
+    Latency histograms and call/error counters of the plugin in the Prometheus text format.
+
+    The numbers are not specific to the event in the URL, which only places the view next
+    to the PWYC settings.
+    """
+
+    def get(self, request, *args, **kwargs):
+        metrics = get_metrics()
+        if not metrics:
+            return HttpResponse('Metrics are disabled\n', status=404, content_type='text/plain')
+        return HttpResponse(
+            render_prometheus(metrics.collect(), fragment_stats),
+            content_type='text/plain; version=0.0.4; charset=utf-8'
+        )
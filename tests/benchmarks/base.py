@@ -0,0 +1,82 @@
+"""
+Helpers shared by the benchmarks in this directory.
+
+The benchmarks are plain scripts, not part of the test suite. They set up pretix with its
+test settings and a throw-away SQLite database, e.g.:
+
+    python -m tests.benchmarks.bench_logging
+"""
+import logging
+import os
+import tempfile
+import time
+from decimal import Decimal
+
+
+def setup_django(concurrent=False):
+    """
+    Set up Django and create the throw-away database. With ``concurrent``, a SQLite test
+    database is created as a file instead of in memory, as the in-memory database fails
+    concurrent writes.
+    """
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'pretix.testutils.settings')
+    import django
+
+    django.setup()
+
+    from django.conf import settings
+    from django.db import connection
+    from django.test import override_settings
+
+    if concurrent and connection.vendor == 'sqlite':
+        connection.settings_dict['TEST']['NAME'] = os.path.join(tempfile.mkdtemp(), 'pwyc-benchmark.sqlite3')
+        # Take the write lock when a transaction starts, instead of failing to upgrade a read lock
+        connection.settings_dict['OPTIONS'].update(transaction_mode='IMMEDIATE', timeout=30)
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    if settings.CACHES['default']['BACKEND'].endswith('DummyCache'):
+        # pretix' test settings disable caching, production setups always have a cache
+        override_settings(CACHES={
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+        }).enable()
+    # Measure with the log level of a production setup
+    logging.getLogger('pretix_pwyc').setLevel(logging.WARNING)
+
+
+def create_event(items=1, slug='bench'):
+    """Create an event with the given number of PWYC-enabled items"""
+    from django_scopes import scopes_disabled
+    from pretix.base.models import Event, Item, Organizer
+
+    from pretix_pwyc.models import PWYCItemConfig
+
+    with scopes_disabled():
+        orga = Organizer.objects.create(name='Benchmark', slug=slug)
+        event = Event.objects.create(
+            organizer=orga,
+            name='Benchmark',
+            slug=slug,
+            date_from='2030-01-01 10:00:00Z',
+            plugins='pretix_pwyc',
+        )
+        Item.objects.bulk_create([
+            Item(event=event, name=f'Ticket {i}', default_price=10, admission=True)
+            for i in range(items)
+        ])
+        item_list = list(event.items.order_by('pk'))
+        PWYCItemConfig.objects.bulk_create([
+            PWYCItemConfig(
+                event=event, item=item, enabled=True,
+                min_amount=Decimal('5.00'), suggested_amount=Decimal('15.00'),
+            )
+            for item in item_list
+        ])
+    return event, item_list
+
+
+def timeit(func, repeat):
+    """Return the mean duration of ``func`` in milliseconds"""
+    func()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) * 1000 / repeat
@@ -0,0 +1,87 @@
+"""
+Concurrent price updates against the sync set-price view, called through Django's WSGI
+handler from a thread pool, and the async view, called through Django's ASGI handler.
+
+    python -m tests.benchmarks.bench_async [requests] [concurrency]
+
+Prices are stored in the cookie store, so SQLite write locks do not dominate the result.
+"""
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from tests.benchmarks.base import create_event, setup_django
+
+
+def fire_sync(url, bodies, concurrency):
+    from django.test import Client
+
+    local = threading.local()
+
+    def post(body):
+        if not hasattr(local, 'client'):
+            local.client = Client()
+        return local.client.post(url, data=body, content_type='application/json').status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        statuses = list(executor.map(post, bodies))
+    return time.perf_counter() - start, statuses
+
+
+async def fire_async(url, bodies, concurrency):
+    from django.test import AsyncClient
+
+    client = AsyncClient()
+    semaphore = asyncio.Semaphore(concurrency)
+    statuses = []
+
+    async def post(body):
+        async with semaphore:
+            response = await client.post(url, data=body, content_type='application/json')
+            statuses.append(response.status_code)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(post(body) for body in bodies))
+    return time.perf_counter() - start, statuses
+
+
+def run(requests=2000, concurrency=100):
+    from pretix_pwyc import ratelimit
+
+    # [pretix_pwyc] price_store=cookie
+    os.environ['PRETIX_PRETIX_PWYC_PRICE_STORE'] = 'cookie'
+    ratelimit.set_rate_limiter(ratelimit.InMemoryRateLimiter(), {
+        scope: ratelimit.Limit(1e6, 1e6) for scope in ratelimit.DEFAULT_LIMITS
+    })
+
+    event, items = create_event(items=10, slug='bench-async')
+    event.live = True
+    event.save()
+    bodies = [
+        json.dumps({'item_id': items[i % len(items)].pk, 'price': f'{10 + i % 50}.00'})
+        for i in range(requests)
+    ]
+
+    results = {}
+    for label, fire in (
+        ('sync', lambda: fire_sync(f'/{event.organizer.slug}/{event.slug}/pwyc/set-price/', bodies, concurrency)),
+        ('async', lambda: asyncio.run(
+            fire_async(f'/{event.organizer.slug}/{event.slug}/pwyc/async/set-price/', bodies, concurrency)
+        )),
+    ):
+        duration, statuses = fire()
+        failed = sum(1 for status in statuses if status != 200)
+        results[label] = requests / duration
+        print(f'{label:<6} {requests} requests, {concurrency} concurrent: {duration:7.2f} s, '
+              f'{results[label]:8.1f} requests/s, {failed} failed')
+    return results
+
+
+if __name__ == '__main__':
+    setup_django()
+    run(*[int(a) for a in sys.argv[1:3]])
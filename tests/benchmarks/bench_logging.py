@@ -0,0 +1,58 @@
+"""
+Cost of a cart recalculation (apply_pwyc_price) with the plugin's loggers at WARNING and INFO.
+
+    python -m tests.benchmarks.bench_logging [positions] [repeat]
+"""
+import io
+import logging
+import sys
+from decimal import Decimal
+
+from tests.benchmarks.base import create_event, setup_django, timeit
+
+
+def run(positions=100, repeat=200):
+    from django.test import RequestFactory
+    from django_scopes import scopes_disabled
+    from pretix.base.models import CartPosition
+
+    from pretix_pwyc import log
+    from pretix_pwyc.models import PWYCCartPrice
+    from pretix_pwyc.signals import apply_pwyc_price
+
+    event, items = create_event(items=10)
+    for item in items:
+        PWYCCartPrice.objects.create(event=event, cart_id='bench', item=item, price=Decimal('12.00'))
+    with scopes_disabled():
+        cart = [
+            CartPosition(event=event, cart_id='bench', item=items[i % len(items)], price=Decimal('10.00'))
+            for i in range(positions)
+        ]
+    request = RequestFactory().get('/')
+
+    # Records are formatted by a real handler, but written to memory
+    logger = logging.getLogger('pretix_pwyc')
+    handler = logging.StreamHandler(io.StringIO())
+    logger.addHandler(handler)
+    logger.propagate = False
+
+    results = {}
+    for label, level, detail in (
+        ('WARNING', logging.WARNING, False),
+        ('INFO', logging.INFO, False),
+        ('DEBUG + detail', logging.DEBUG, True),
+    ):
+        logger.setLevel(level)
+        log._sample_rates['detail'] = detail
+        results[label] = timeit(
+            lambda: apply_pwyc_price(event, positions=cart, invoice_address=None, request=request),
+            repeat
+        )
+        print(f'{label:<16} {results[label]:8.3f} ms per recalculation of {positions} positions')
+    logger.removeHandler(handler)
+    return results
+
+
+if __name__ == '__main__':
+    setup_django()
+    run(*[int(a) for a in sys.argv[1:3]])
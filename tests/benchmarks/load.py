@@ -0,0 +1,368 @@
+"""
+Load test of an on-sale: buyers arrive spread over a time window and each one runs through
+the storefront like a browser would.
+
+    python -m tests.benchmarks.load [--buyers 5000] [--window 120] [--concurrency 50]
+                                    [--config /path/to/pretix.cfg] [--output load.json]
+                                    [--baseline old.json] [--threshold 0.25]
+
+Every buyer runs these flows, in order:
+
+- ``product_list``: the event index, with the PWYC price inputs of all items
+- ``set_price``: ``--updates`` price changes posted to ``pwyc/set-price/``, like a buyer moving the slider
+- ``add_to_cart``: the product with the chosen price is added to the cart
+- ``checkout``: the checkout steps up to the placed order, where the cart is priced and the
+  ``pwyc`` order metadata is written
+
+After the checkout, the positions of the placed order are checked against the price the buyer
+chose last; a buyer whose order has another price counts as failed.
+
+Requests go through pretix' WSGI handler in this process, with one client and session per
+buyer, so the database and session writes of every flow can be counted. By default the
+database is a throw-away SQLite file with pretix' test settings. With ``--config``, the
+settings of a local pretix development setup are used instead, and the throw-away database
+is created next to its SQLite or PostgreSQL database. All buyers come from the same address,
+so the rate limits of the set-price endpoint are lifted for the run.
+
+For every flow, the run reports the latency percentiles in milliseconds, the throughput in
+flows per second, and the database and session writes per flow. Results are written as JSON;
+if a baseline file from an earlier run is given, the run fails when the 95th percentile of any
+flow got slower by more than the threshold (0.25 = 25 %).
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from decimal import Decimal
+from urllib.parse import urlparse
+
+from tests.benchmarks.base import create_event, setup_django
+from tests.benchmarks.suite import compare
+
+FLOWS = ('product_list', 'set_price', 'add_to_cart', 'checkout')
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+
+class FlowFailed(Exception):
+    pass
+
+
+class Recorder:
+    """
+    Collects latencies and counts writes per flow. The flow a thread is currently running is
+    kept thread-local, so queries and session saves are attributed to it.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.latencies = defaultdict(list)
+        self.counters = defaultdict(lambda: defaultdict(int))
+
+    @property
+    def flow(self):
+        return getattr(self.local, 'flow', None)
+
+    def count(self, flow, counter, n=1):
+        with self.lock:
+            self.counters[flow][counter] += n
+
+    def run(self, flow, func):
+        self.local.flow = flow
+        start = time.perf_counter()
+        try:
+            func()
+        except Exception:
+            self.count(flow, 'errors')
+            raise
+        else:
+            with self.lock:
+                self.latencies[flow].append((time.perf_counter() - start) * 1000)
+        finally:
+            self.local.flow = None
+
+    def execute_wrapper(self, execute, sql, params, many, context):
+        flow = self.flow
+        if flow:
+            self.count(flow, 'db_queries')
+            if sql.lstrip().upper().startswith(WRITE_STATEMENTS):
+                self.count(flow, 'db_writes')
+        return execute(sql, params, many, context)
+
+    def summary(self, duration):
+        results = {}
+        for flow in FLOWS:
+            latencies = sorted(self.latencies[flow])
+            counters = self.counters[flow]
+            count = len(latencies)
+            if count > 1:
+                cuts = statistics.quantiles(latencies, n=100, method='inclusive')
+                p50, p95, p99 = cuts[49], cuts[94], cuts[98]
+            else:
+                p50 = p95 = p99 = latencies[0] if latencies else None
+            results[flow] = {
+                'count': count,
+                'errors': counters['errors'],
+                'p50': p50,
+                'p95': p95,
+                'p99': p99,
+                'mean': statistics.fmean(latencies) if latencies else None,
+                'max': latencies[-1] if latencies else None,
+                'throughput': count / duration,
+                # Per successful or failed run of the flow
+                'db_queries': counters['db_queries'] / max(count + counters['errors'], 1),
+                'db_writes': counters['db_writes'] / max(count + counters['errors'], 1),
+                'session_writes': counters['session_writes'] / max(count + counters['errors'], 1),
+            }
+        return results
+
+
+def count_session_writes(recorder):
+    """Count the session saves of every flow by wrapping the save of the session engine"""
+    from importlib import import_module
+
+    from django.conf import settings
+
+    store = import_module(settings.SESSION_ENGINE).SessionStore
+    save = store.save
+
+    def counting_save(self, *args, **kwargs):
+        if recorder.flow:
+            recorder.count(recorder.flow, 'session_writes')
+        return save(self, *args, **kwargs)
+
+    store.save = counting_save
+
+
+def expect(response, *statuses):
+    if response.status_code not in statuses:
+        raise FlowFailed(f'{response.request["PATH_INFO"]} returned {response.status_code}')
+    return response
+
+
+class Buyer:
+    def __init__(self, number, base, items, updates, host):
+        from django.test import Client
+
+        self.number = number
+        self.base = base
+        self.item = items[number % len(items)]
+        self.updates = updates
+        self.client = Client(HTTP_HOST=host)
+        self.price = None
+        self.version = 0
+        self.order = None
+
+    def product_list(self):
+        response = expect(self.client.get(self.base), 200)
+        if b'pwyc-item' not in response.content:
+            raise FlowFailed('The product list shows no PWYC price input')
+
+    def set_price(self, price):
+        from pretix_pwyc.storage import new_price_version
+
+        # Like the widget, in milliseconds; changes within the same millisecond still get newer versions
+        self.version = max(new_price_version(), self.version + 1)
+        body = {'prices': [{'item_id': self.item.pk, 'price': f'{price}.00', 'version': self.version}]}
+        expect(self.client.post(f'{self.base}pwyc/set-price/', data=json.dumps(body),
+                                content_type='application/json'), 200)
+        self.price = Decimal(price)
+
+    def add_to_cart(self):
+        expect(self.client.post(f'{self.base}cart/add', data={f'item_{self.item.pk}': '1'}), 302)
+
+    def checkout(self):
+        response = expect(self.client.get(f'{self.base}checkout/start'), 302)
+        response = expect(self.client.get(response['Location']), 200)
+        response = expect(self.client.post(response.request['PATH_INFO'], data={
+            'email': f'buyer{self.number}@example.org',
+        }), 302)
+        response = expect(self.client.get(response['Location']), 200)
+        response = expect(self.client.post(response.request['PATH_INFO'], data={'payment': 'manual'}), 302)
+        response = expect(self.client.get(response['Location']), 200)
+        response = expect(self.client.post(response.request['PATH_INFO']), 302)
+        if '/order/' not in response['Location']:
+            raise FlowFailed(f'Checkout ended at {response["Location"]}')
+        self.order = response['Location'].split('/order/')[1].split('/')[0]
+
+    def verify(self):
+        """Check that the order was placed with the price the buyer chose last"""
+        from django_scopes import scopes_disabled
+        from pretix.base.models import OrderPosition
+
+        if self.price is None:
+            return
+        organizer, event = self.base.strip('/').split('/')
+        with scopes_disabled():
+            prices = list(OrderPosition.objects.filter(
+                order__event__organizer__slug=organizer, order__event__slug=event, order__code=self.order,
+            ).values_list('price', flat=True))
+        if not prices or any(price != self.price for price in prices):
+            raise FlowFailed(f'Order {self.order} was placed with {prices}, the buyer chose {self.price}')
+
+    def run(self, recorder):
+        recorder.run('product_list', self.product_list)
+        for update in range(self.updates):
+            # Prices between the minimum of 5 and twice the suggestion
+            recorder.run('set_price', lambda: self.set_price(5 + (self.number + update * 7) % 26))
+        recorder.run('add_to_cart', self.add_to_cart)
+        recorder.run('checkout', self.checkout)
+        self.verify()
+
+
+def prepare_event(items):
+    from django_scopes import scopes_disabled
+    from pretix.base.models import Quota
+
+    from pretix_pwyc import ratelimit
+
+    ratelimit.set_rate_limiter(ratelimit.InMemoryRateLimiter(), {
+        scope: ratelimit.Limit(1e6, 1e6) for scope in ratelimit.DEFAULT_LIMITS
+    })
+    event, item_list = create_event(items=items, slug='load')
+    with scopes_disabled():
+        event.live = True
+        event.plugins = 'pretix_pwyc,pretix.plugins.manualpayment'
+        event.save()
+        quota = Quota.objects.create(event=event, name='On-sale', size=None)
+        quota.items.set(item_list)
+        event.settings.set('payment_manual__enabled', True)
+    return event, item_list
+
+
+def run(buyers, window, concurrency, updates, items):
+    from django.conf import settings
+    from django.db import connection
+
+    recorder = Recorder()
+    count_session_writes(recorder)
+    event, item_list = prepare_event(items)
+    base = f'/{event.organizer.slug}/{event.slug}/'
+    host = urlparse(settings.SITE_URL).netloc
+
+    def buyer(number, start):
+        # Buyers arrive evenly spread over the window
+        delay = start + number * window / buyers - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        try:
+            Buyer(number, base, item_list, updates, host).run(recorder)
+        except Exception as e:
+            return e
+
+    def count_queries():
+        # Every thread has a connection of its own, the wrapper stays for the lifetime of the thread
+        connection.execute_wrappers.append(recorder.execute_wrapper)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency, initializer=count_queries) as executor:
+        failures = [e for e in executor.map(lambda number: buyer(number, start), range(buyers)) if e]
+    duration = time.perf_counter() - start
+    for e in failures[:5]:
+        print(f'FAILED {e!r}')
+    return event, recorder.summary(duration), duration, len(failures)
+
+
+def count_orders(event):
+    from django_scopes import scopes_disabled
+    from pretix.base.models import Order
+
+    with scopes_disabled():
+        orders = list(Order.objects.filter(event=event).values_list('meta_info', flat=True))
+    return len(orders), sum(1 for meta in orders if meta and '"pwyc"' in meta)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--buyers', type=int, default=5000, help='Number of buyers, default 5000')
+    parser.add_argument('--window', type=float, default=120,
+                        help='Seconds over which the buyers arrive, default 120, 0 for all at once')
+    parser.add_argument('--concurrency', type=int, default=50, help='Buyers served at the same time, default 50')
+    parser.add_argument('--updates', type=int, default=3, help='Price changes per buyer, default 3')
+    parser.add_argument('--items', type=int, default=3, help='PWYC products of the event, default 3')
+    parser.add_argument('--price-store', choices=('cart', 'session', 'cookie'),
+                        help='Price store to use instead of the configured one')
+    parser.add_argument('--config', help='pretix.cfg of a local development setup to take the database from')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', help='Compare with the results of an earlier run')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='Allowed slowdown of the 95th percentile compared to the baseline, default 0.25')
+    args = parser.parse_args(argv)
+
+    if args.config:
+        os.environ['PRETIX_CONFIG_FILE'] = args.config
+        os.environ['DJANGO_SETTINGS_MODULE'] = 'pretix.settings'
+    if args.price_store:
+        # [pretix_pwyc] price_store=...
+        os.environ['PRETIX_PRETIX_PWYC_PRICE_STORE'] = args.price_store
+    setup_django(concurrent=True)
+
+    import django
+    import pretix
+    from django.db import connection
+
+    from pretix_pwyc.storage import get_price_store
+
+    event, results, duration, failed = run(args.buyers, args.window, args.concurrency, args.updates, args.items)
+    orders, pwyc_orders = count_orders(event)
+
+    print(f'{args.buyers} buyers in {duration:.1f} s, {failed} failed, {orders} orders placed, '
+          f'{pwyc_orders} with PWYC metadata')
+    print(f'{"flow":<14} {"count":>6} {"errors":>6} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"per s":>8} '
+          f'{"db writes":>9} {"sessions":>9}')
+    for flow, stats in results.items():
+        if not stats['count']:
+            print(f'{flow:<14} {0:>6} {stats["errors"]:>6}')
+            continue
+        print(f'{flow:<14} {stats["count"]:>6} {stats["errors"]:>6} {stats["p50"]:>9.1f} {stats["p95"]:>9.1f} '
+              f'{stats["p99"]:>9.1f} {stats["throughput"]:>8.1f} {stats["db_writes"]:>9.1f} '
+              f'{stats["session_writes"]:>9.1f}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'meta': {
+                    'date': datetime.now(timezone.utc).isoformat(),
+                    'python': platform.python_version(),
+                    'django': django.get_version(),
+                    'pretix': pretix.__version__,
+                    'database': connection.vendor,
+                    'price_store': get_price_store(event).identifier,
+                    'buyers': args.buyers,
+                    'window': args.window,
+                    'concurrency': args.concurrency,
+                    'updates': args.updates,
+                    'items': args.items,
+                    'duration': duration,
+                    'failed_buyers': failed,
+                    'orders': orders,
+                    'orders_with_pwyc_meta': pwyc_orders,
+                },
+                'flows': results,
+            }, f, indent=2)
+
+    status = 1 if failed else 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['flows']
+        regressions = compare(
+            {flow: stats['p95'] for flow, stats in results.items() if stats['p95'] is not None},
+            {flow: stats['p95'] for flow, stats in baseline.items()},
+            args.threshold,
+        )
+        for flow, before, after in regressions:
+            print(f'REGRESSION {flow} p95: {before:.1f} ms -> {after:.1f} ms (+{(after / before - 1) * 100:.0f} %)')
+        if regressions:
+            status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
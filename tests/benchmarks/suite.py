@@ -0,0 +1,226 @@
+"""
+Benchmarks of the PWYC hot paths at different scales.
+
+    python -m tests.benchmarks.suite [--output results.json] [--baseline old.json] [--threshold 0.25]
+
+Every benchmark reports the mean duration of one operation in milliseconds. Results are
+written as JSON; if a baseline file from an earlier run is given, the run fails when any
+benchmark got slower by more than the threshold (0.25 = 25 %).
+"""
+import argparse
+import json
+import platform
+import sys
+from datetime import datetime, timezone
+from decimal import Decimal
+
+from tests.benchmarks.base import create_event, setup_django, timeit
+
+CART_SIZES = (1, 10, 100, 1000)
+PRODUCT_LIST_SIZES = (10, 100, 500, 2000)
+COPY_SIZES = (100, 1000)
+
+
+def bench_apply_pwyc_price(scale):
+    from django.test import RequestFactory
+    from django_scopes import scopes_disabled
+    from pretix.base.models import CartPosition
+
+    from pretix_pwyc.models import PWYCCartPrice
+    from pretix_pwyc.signals import apply_pwyc_price
+
+    event, items = create_event(items=10, slug='bench-cart')
+    PWYCCartPrice.objects.bulk_create([
+        PWYCCartPrice(event=event, cart_id='bench', item=item, price=Decimal('12.00')) for item in items
+    ])
+    request = RequestFactory().get('/')
+    results = {}
+    for size in CART_SIZES:
+        with scopes_disabled():
+            cart = [
+                CartPosition(event=event, cart_id='bench', item=items[i % len(items)], price=Decimal('10.00'))
+                for i in range(size)
+            ]
+
+        def apply(cart=cart):
+            # Positions carrying their price are skipped, so every run starts with unpriced positions
+            for pos in cart:
+                pos.custom_price_input = None
+                pos.price_after_voucher = pos.price = Decimal('10.00')
+            apply_pwyc_price(event, positions=cart, invoice_address=None, request=request)
+            assert cart[0].price == Decimal('12.00')
+
+        results[f'apply_pwyc_price[{size}]'] = timeit(apply, max(5, 200 // size * scale))
+    return results
+
+
+def bench_add_pwyc_price_form(scale):
+    from pretix_pwyc.config import request_cache
+    from pretix_pwyc.signals import add_pwyc_price_form
+
+    results = {}
+    for size in PRODUCT_LIST_SIZES:
+        event, items = create_event(items=size, slug=f'bench-list-{size}')
+
+        def product_list():
+            with request_cache():
+                for item in items:
+                    add_pwyc_price_form(event, item=item, variation=None)
+
+        results[f'add_pwyc_price_form[{size} items]'] = timeit(product_list, max(3, 2000 // size * scale))
+    return results
+
+
+def bench_set_price(scale):
+    from django.test import Client
+
+    from pretix_pwyc import ratelimit
+
+    # Measure the view including the rate limiter, with limits the benchmark does not reach
+    ratelimit.set_rate_limiter(ratelimit.InMemoryRateLimiter(), {
+        scope: ratelimit.Limit(1e6, 1e6) for scope in ratelimit.DEFAULT_LIMITS
+    })
+    event, items = create_event(items=10, slug='bench-set-price')
+    event.live = True
+    event.save()
+    client = Client()
+    url = f'/{event.organizer.slug}/{event.slug}/pwyc/set-price/'
+    single = json.dumps({'item_id': items[0].pk, 'price': '12.50'})
+    batch = json.dumps({'prices': [{'item_id': item.pk, 'price': '12.50'} for item in items]})
+
+    def post(body):
+        response = client.post(url, data=body, content_type='application/json')
+        assert response.status_code == 200, response.content
+
+    return {
+        'set_price[single]': timeit(lambda: post(single), 100 * scale),
+        'set_price[batch of 10]': timeit(lambda: post(batch), 100 * scale),
+    }
+
+
+def bench_event_copy(scale):
+    from django.db import transaction
+    from django_scopes import scopes_disabled
+    from pretix.base.models import Item
+
+    from pretix_pwyc.signals import event_copy_data_receiver
+
+    results = {}
+    for size in COPY_SIZES:
+        source, items = create_event(items=size, slug=f'bench-copy-{size}')
+        target, _ = create_event(items=0, slug=f'bench-copy-target-{size}')
+        with scopes_disabled():
+            Item.objects.bulk_create([
+                Item(event=target, name=f'Ticket {i}', default_price=10) for i in range(size)
+            ])
+            item_map = dict(zip([item.pk for item in items], target.items.order_by('pk')))
+
+        def copy():
+            # Every run copies into an event without PWYC configuration
+            with transaction.atomic():
+                event_copy_data_receiver(target, other=source, item_map=item_map)
+                transaction.set_rollback(True)
+
+        results[f'event_copy_data_receiver[{size} items]'] = timeit(copy, max(2, 100 // size * scale))
+    return results
+
+
+def bench_pwyc_formset(scale):
+    from django.contrib.sessions.backends.db import SessionStore
+    from django.test import RequestFactory
+
+    from pretix_pwyc.signals import pwyc_formset
+
+    event, items = create_event(items=1, slug='bench-formset')
+    item = items[0]
+    factory = RequestFactory()
+    data = {
+        'pwyc-TOTAL_FORMS': '1',
+        'pwyc-INITIAL_FORMS': '1',
+        'pwyc-MIN_NUM_FORMS': '0',
+        'pwyc-MAX_NUM_FORMS': '1',
+        'pwyc-0-pwyc_enabled': 'on',
+        'pwyc-0-pwyc_min_amount': '5.00',
+        'pwyc-0-pwyc_suggested_amount': '15.00',
+        'pwyc-0-pwyc_explanation': 'Pay what you can',
+    }
+
+    def call(request):
+        request.session = SessionStore()
+        formset = pwyc_formset(event, request=request, item=item)
+        assert formset.title != 'Pay What You Can (Validation Error)'
+
+    return {
+        'pwyc_formset[GET]': timeit(lambda: call(factory.get('/')), 100 * scale),
+        'pwyc_formset[POST]': timeit(lambda: call(factory.post('/', data=data)), 100 * scale),
+    }
+
+
+BENCHMARKS = (
+    bench_apply_pwyc_price,
+    bench_add_pwyc_price_form,
+    bench_set_price,
+    bench_event_copy,
+    bench_pwyc_formset,
+)
+
+
+def compare(results, baseline, threshold):
+    """Return the benchmarks that got slower than the baseline by more than the threshold"""
+    regressions = []
+    for name, duration in results.items():
+        before = baseline.get(name)
+        if before and duration > before * (1 + threshold):
+            regressions.append((name, before, duration))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', help='Compare with the results of an earlier run')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='Allowed slowdown compared to the baseline, default 0.25')
+    parser.add_argument('--scale', type=int, default=1, help='Multiply the number of repetitions')
+    parser.add_argument('-k', dest='only', help='Only run benchmarks whose function name contains this')
+    args = parser.parse_args(argv)
+
+    setup_django()
+
+    import django
+    import pretix
+
+    results = {}
+    for benchmark in BENCHMARKS:
+        if args.only and args.only not in benchmark.__name__:
+            continue
+        for name, duration in benchmark(args.scale).items():
+            results[name] = duration
+            print(f'{name:<45} {duration:10.3f} ms')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'meta': {
+                    'date': datetime.now(timezone.utc).isoformat(),
+                    'python': platform.python_version(),
+                    'django': django.get_version(),
+                    'pretix': pretix.__version__,
+                    'scale': args.scale,
+                },
+                'results': results,
+            }, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        for name, before, after in regressions:
+            print(f'REGRESSION {name}: {before:.3f} ms -> {after:.3f} ms (+{(after / before - 1) * 100:.0f} %)')
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
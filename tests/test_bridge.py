@@ -0,0 +1,113 @@
+import decimal
+from io import StringIO
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase
+from django_scopes import scopes_disabled
+from pretix.base.models import Event, Item, Organizer
+
+from pretix_pwyc.bridge import native_pricing
+from pretix_pwyc.models import PWYCItemConfig, PWYCVariationConfig
+
+
+class NativePricingTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.orga = Organizer.objects.create(name='PWYC Test', slug='pwyc-test')
+        self.event = Event.objects.create(
+            organizer=self.orga,
+            name='PWYC Test Event',
+            slug='pwyc-test-event',
+            date_from='2030-01-01 10:00:00Z',
+            plugins='pretix_pwyc',
+        )
+        self.ticket = Item.objects.create(event=self.event, name='Test Ticket', default_price=10)
+        self.regular = Item.objects.create(event=self.event, name='Regular Ticket', default_price=20)
+        with scopes_disabled():
+            self.supporter = self.ticket.variations.create(value='Supporter', default_price=30)
+            self.closed = self.ticket.variations.create(value='Closed', default_price=12)
+            self.plain = self.ticket.variations.create(value='Plain')
+        self.config = PWYCItemConfig.objects.create(
+            event=self.event, item=self.ticket, enabled=True, min_amount=decimal.Decimal('5.00'),
+            suggested_amount=decimal.Decimal('15.00'), explanation='Pay what you can',
+        )
+        PWYCVariationConfig.objects.bulk_create([
+            PWYCVariationConfig(
+                event=self.event, item=self.ticket, variation=self.supporter, min_amount=decimal.Decimal('20.00'),
+            ),
+            PWYCVariationConfig(event=self.event, item=self.ticket, variation=self.closed, enabled=False),
+        ])
+
+    def _prices(self):
+        with scopes_disabled():
+            self.ticket.refresh_from_db()
+            variations = {
+                v.pk: (v.default_price, v.free_price_suggestion) for v in self.ticket.variations.all()
+            }
+        return (
+            self.ticket.free_price, self.ticket.default_price, self.ticket.free_price_suggestion,
+            variations[self.supporter.pk], variations[self.closed.pk], variations[self.plain.pk],
+        )
+
+    def test_convert(self):
+        """Test that events are converted to free prices and back to their original prices"""
+        original = self._prices()
+        out = StringIO()
+        call_command('pwyc_convert_pricing', to='native', event='pwyc-test/pwyc-test-event', stdout=out)
+        self.assertIn('1 products converted to native pricing', out.getvalue())
+        self.event.settings.flush()
+        self.assertTrue(native_pricing(self.event))
+        self.assertEqual(self._prices(), (
+            True, decimal.Decimal('5.00'), decimal.Decimal('15.00'),
+            (decimal.Decimal('20.00'), decimal.Decimal('15.00')), (decimal.Decimal('12.00'), None), (None, None),
+        ))
+        self.regular.refresh_from_db()
+        self.assertFalse(self.regular.free_price)
+
+        # Converting again keeps the recorded original prices
+        call_command('pwyc_convert_pricing', to='native', stdout=StringIO())
+        call_command('pwyc_convert_pricing', to='plugin', stdout=StringIO())
+        self.event.settings.flush()
+        self.assertFalse(native_pricing(self.event))
+        self.assertEqual(self._prices(), original)
+        self.config.refresh_from_db()
+        self.assertEqual(self.config.native_prices, {})
+
+    def test_item_form_saved_later(self):
+        """Test that the mapping is written after pretix saved the item form of the same request"""
+        from pretix_pwyc.forms import save_config
+        call_command('pwyc_convert_pricing', to='native', stdout=StringIO())
+        self.event.settings.flush()
+
+        with scopes_disabled(), self.captureOnCommitCallbacks(execute=True):
+            save_config(self.event, self.ticket, {
+                'pwyc_enabled': True, 'pwyc_min_amount': decimal.Decimal('7.00'), 'pwyc_suggested_amount': None,
+            })
+            # The item form still holds the price shown when the page was loaded
+            Item.objects.filter(pk=self.ticket.pk).update(default_price=5, free_price=False)
+        self.assertEqual(self._prices()[:3], (True, decimal.Decimal('7.00'), None))
+
+        with scopes_disabled(), self.captureOnCommitCallbacks(execute=True):
+            save_config(self.event, self.ticket, {'pwyc_enabled': False})
+        self.assertEqual(self._prices()[:3], (False, decimal.Decimal('10.00'), None))
+
+    def test_storefront(self):
+        """Test that no plugin code prices carts and only the explanation is shown"""
+        from pretix_pwyc.config import get_config_snapshot, request_cache
+        from pretix_pwyc.fragments import head_fragment, item_fragment
+        from pretix_pwyc.signals import apply_pwyc_price
+        call_command('pwyc_convert_pricing', to='native', stdout=StringIO())
+        self.event.settings.flush()
+
+        with request_cache():
+            snapshot = get_config_snapshot(self.event)
+            self.assertTrue(snapshot.native)
+            with self.assertNumQueries(0):
+                self.assertEqual(head_fragment(self.event), '')
+                self.assertIn('Pay what you can', item_fragment(self.event, self.ticket.pk))
+                self.assertEqual(item_fragment(self.event, self.ticket.pk, variation_id=self.supporter.pk), '')
+                self.assertEqual(item_fragment(self.event, self.regular.pk), '')
+                self.assertEqual(
+                    apply_pwyc_price(self.event, positions=[object()], invoice_address=None, request=None), []
+                )
@@ -0,0 +1,111 @@
+import decimal
+import io
+import json
+from datetime import timedelta
+
+from django.test import TestCase
+from django.utils.timezone import now
+from django_scopes import scope
+from pretix.base.models import Event, Item, Order, OrderPosition, Organizer
+
+from pretix_pwyc.exporters import PWYCPositionsExporter
+from pretix_pwyc.models import PWYCItemConfig
+
+
+class PositionsExporterTest(TestCase):
+    def setUp(self):
+        self.orga = Organizer.objects.create(name='PWYC Test', slug='pwyc-test')
+        self.event = Event.objects.create(
+            organizer=self.orga,
+            name='PWYC Test Event',
+            slug='pwyc-test-event',
+            date_from='2030-01-01 10:00:00Z',
+            plugins='pretix_pwyc',
+        )
+        self.ticket = Item.objects.create(event=self.event, name='Test Ticket', default_price=10)
+        self.regular = Item.objects.create(event=self.event, name='Regular Ticket', default_price=20)
+        PWYCItemConfig.objects.create(event=self.event, item=self.ticket, enabled=True)
+
+        with scope(organizer=self.orga):
+            for i, (status, price) in enumerate([
+                (Order.STATUS_PAID, '7.50'), (Order.STATUS_PAID, '15.00'), (Order.STATUS_CANCELED, '3.00'),
+            ]):
+                order = Order.objects.create(
+                    event=self.event, status=status, email='test@example.org', datetime=now() - timedelta(hours=3 - i),
+                    expires=now() + timedelta(days=10), total=decimal.Decimal(price) + 20,
+                    sales_channel=self.orga.sales_channels.get(identifier='web'),
+                )
+                OrderPosition.objects.create(
+                    order=order, item=self.ticket, price=decimal.Decimal(price), positionid=1,
+                    meta_info=json.dumps({'pwyc_original_price': '12.00'}) if i == 0 else None,
+                )
+                OrderPosition.objects.create(order=order, item=self.regular, price=20, positionid=2)
+
+    def _render(self, form_data):
+        with scope(organizer=self.orga):
+            return PWYCPositionsExporter(self.event, self.orga).render(form_data)
+
+    def test_csv(self):
+        """Test that only PWYC positions are exported, with totals"""
+        filename, content_type, data = self._render({'_format': 'default', 'status': [Order.STATUS_PAID]})
+        self.assertEqual(filename, 'pwyc-test-event_pwyc_prices.csv')
+        lines = data.decode().splitlines()
+        self.assertEqual(len(lines), 1 + 2 + 1 + 4)
+        self.assertIn('"paid"', lines[1])
+        self.assertTrue(lines[1].endswith('"Test Ticket","","12.00","7.50","-4.50"'))
+        self.assertTrue(lines[2].endswith('"Test Ticket","","10.00","15.00","5.00"'))
+        self.assertEqual(lines[4], '"Positions",2')
+        self.assertEqual(lines[5], '"Total paid","22.50"')
+
+    def test_json_streams_to_file(self):
+        """Test that the JSON export is written to the output file and lists every status if none is selected"""
+        output = io.BytesIO()
+        output.mode = 'wb'
+        with scope(organizer=self.orga):
+            filename, content_type, data = PWYCPositionsExporter(self.event, self.orga).render(
+                {'_format': 'json', 'status': []}, output_file=output
+            )
+        self.assertIsNone(data)
+        self.assertEqual(content_type, 'application/json')
+        result = json.loads(output.getvalue())
+        self.assertEqual([p['price'] for p in result['positions']], ['7.50', '15.00', '3.00'])
+        self.assertEqual(result['positions'][2]['status'], 'canceled')
+        self.assertEqual(result['totals']['count'], 3)
+        self.assertEqual(result['totals']['paid_sum'], '25.50')
+
+    def test_xlsx(self):
+        filename, content_type, data = self._render({'_format': 'xlsx', 'status': []})
+        self.assertEqual(filename, 'pwyc-test-event_pwyc_prices.xlsx')
+        self.assertTrue(data)
+
+    def test_placed_order(self):
+        """Test that the original price of an order placed through the checkout is exported"""
+        from pretix.base.models import Quota
+
+        with scope(organizer=self.orga):
+            self.event.live = True
+            self.event.plugins = 'pretix_pwyc,pretix.plugins.manualpayment'
+            self.event.save()
+            quota = Quota.objects.create(event=self.event, name='Tickets', size=None)
+            quota.items.add(self.ticket)
+            self.event.settings.set('payment_manual__enabled', True)
+        base = f'/{self.orga.slug}/{self.event.slug}/'
+
+        response = self.client.post(f'{base}pwyc/set-price/', data=json.dumps({
+            'prices': [{'item_id': self.ticket.pk, 'price': '6.00'}],
+        }), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.client.post(f'{base}cart/add', data={f'item_{self.ticket.pk}': '1'})
+        # A later price edit must not change the original price of the order
+        with scope(organizer=self.orga):
+            Item.objects.filter(pk=self.ticket.pk).update(default_price=25)
+        self.client.get(f'{base}checkout/start')
+        self.client.post(f'{base}checkout/questions/', data={'email': 'buyer@example.org'})
+        self.client.post(f'{base}checkout/payment/', data={'payment': 'manual'})
+        response = self.client.post(f'{base}checkout/confirm/')
+        self.assertIn('/order/', response['Location'])
+
+        filename, content_type, data = self._render({'_format': 'json', 'status': [Order.STATUS_PENDING]})
+        self.assertEqual(
+            [(p['original_price'], p['price']) for p in json.loads(data)['positions']], [('10.00', '6.00')]
+        )
@@ -0,0 +1,82 @@
+import decimal
+
+from django.core.cache import cache
+from django.test import RequestFactory, TestCase, override_settings
+from django_scopes import scope
+from pretix.base.models import CartPosition, Event, Item, Organizer, User
+from pretix.base.models.auth import StaffSession
+
+from pretix_pwyc import metrics
+from pretix_pwyc.models import PWYCItemConfig
+
+
+class MetricsTest(TestCase):
+    def setUp(self):
+        self.orga = Organizer.objects.create(name='PWYC Test', slug='pwyc-test')
+        self.event = Event.objects.create(
+            organizer=self.orga,
+            name='PWYC Test Event',
+            slug='pwyc-test-event',
+            date_from='2030-01-01 10:00:00Z',
+            plugins='pretix_pwyc',
+        )
+        self.ticket = Item.objects.create(event=self.event, name='Test Ticket', default_price=10)
+        PWYCItemConfig.objects.create(event=self.event, item=self.ticket, enabled=True)
+        self.url = f'/control/event/{self.orga.slug}/{self.event.slug}/settings/pwyc/metrics/'
+
+    def tearDown(self):
+        metrics.set_metrics(None)
+
+    def _recalculate(self, times):
+        from pretix_pwyc.signals import apply_pwyc_price
+
+        with scope(organizer=self.orga):
+            positions = [CartPosition(event=self.event, cart_id='a', item=self.ticket, price=decimal.Decimal('10'))]
+        for _ in range(times):
+            apply_pwyc_price(self.event, positions=positions, invoice_address=None, request=RequestFactory().get('/'))
+
+    def test_disabled(self):
+        """Test that nothing is recorded while metrics are disabled"""
+        metrics.set_metrics(None)
+        self._recalculate(1)
+        self.assertIsNone(metrics.get_metrics())
+
+    def test_prometheus_export(self):
+        """Test that calls are exported as histogram and counters to staff members only"""
+        backend = metrics.InMemoryMetrics()
+        metrics.set_metrics(backend)
+        self._recalculate(3)
+        metrics.count_error('apply_pwyc_price')
+
+        user = User.objects.create_user('dummy@dummy.dummy', 'dummy')
+        team = self.orga.teams.create(name='Admins', all_events=True, all_event_permissions=True)
+        team.members.add(user)
+        self.client.login(email='dummy@dummy.dummy', password='dummy')
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
+        user.is_staff = True
+        user.save()
+        StaffSession.objects.create(user=user, session_key=self.client.session.session_key)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        content = response.content.decode()
+        self.assertIn('pretix_pwyc_duration_seconds_bucket{name="apply_pwyc_price",le="+Inf"} 3', content)
+        self.assertIn('pretix_pwyc_duration_seconds_count{name="apply_pwyc_price"} 3', content)
+        self.assertIn('pretix_pwyc_calls_total{name="apply_pwyc_price"} 3', content)
+        self.assertIn('pretix_pwyc_errors_total{name="apply_pwyc_price"} 1', content)
+        self.assertIn('pretix_pwyc_calls_total{name="set_price"} 0', content)
+        self.assertIn('pretix_pwyc_fragment_cache_total{result="misses"}', content)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_cache_backend(self):
+        """Test that the numbers of several workers are added up in the shared cache"""
+        cache.clear()
+        workers = [metrics.CacheMetrics(flush_interval=3600), metrics.CacheMetrics(flush_interval=3600)]
+        for worker in workers:
+            metrics.set_metrics(worker)
+            self._recalculate(2)
+        workers[1].flush()
+        values = workers[0].collect()['apply_pwyc_price']
+        self.assertEqual(values.calls, 4)
+        self.assertEqual(sum(values.buckets), 4)
+        self.assertGreater(values.sum, 0)
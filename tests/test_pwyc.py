@@ -1,10 +1,11 @@
 import decimal
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase, override_settings
 from django.utils.translation import gettext as _
 from pretix.base.models import Event, Organizer, Item, CartPosition
 from pretix.base.models.items import SubEvent
 from pretix.base.services.cart import CartManager
 from pretix.base.settings import GlobalSettingsObject
+from pretix_pwyc.models import PWYCItemConfig
 
 
 class PWYCTest(TestCase):
@@ -25,10 +26,14 @@ class PWYCTest(TestCase):
         )
 
         # Configure PWYC for the item
-        self.event.settings.set(f'pwyc_enabled_{self.ticket.pk}', True)
-        self.event.settings.set(f'pwyc_min_amount_{self.ticket.pk}', '5.00')
-        self.event.settings.set(f'pwyc_suggested_amount_{self.ticket.pk}', '15.00')
-        self.event.settings.set(f'pwyc_explanation_{self.ticket.pk}', 'Test explanation')
+        PWYCItemConfig.objects.create(
+            event=self.event,
+            item=self.ticket,
+            enabled=True,
+            min_amount=decimal.Decimal('5.00'),
+            suggested_amount=decimal.Decimal('15.00'),
+            explanation='Test explanation'
+        )
 
     def test_item_is_pwyc(self):
         """Test that an item is correctly marked as PWYC"""
@@ -111,8 +116,702 @@ class PWYCTest(TestCase):
         )
 
         # Verify settings were copied
-        self.assertTrue(new_event.settings.get(f'pwyc_enabled_{new_ticket.pk}'))
+        new_config = PWYCItemConfig.objects.get(item=new_ticket)
+        self.assertTrue(new_config.enabled)
+        self.assertEqual(new_config.event, new_event)
+        self.assertEqual(new_config.min_amount, self.ticket.pwyc_config.min_amount)
+
+    def test_event_copy(self):
+        """Test that copying an event copies the configuration of all PWYC items in one batch"""
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from django_scopes import scopes_disabled
+        from pretix_pwyc.signals import event_copy_data_receiver
+
+        with scopes_disabled():
+            items = [self.ticket] + [
+                Item.objects.create(event=self.event, name=f'Ticket {i}', default_price=10) for i in range(50)
+            ]
+            for item in items[1:]:
+                PWYCItemConfig.objects.create(
+                    event=self.event, item=item, enabled=item.pk % 2 == 0,
+                    min_amount=decimal.Decimal('3.00'), explanation=f'Item {item.pk}'
+                )
+            new_event = Event.objects.create(
+                organizer=self.orga, name='Clone', slug='clone', date_from='2030-02-01 10:00:00Z',
+                plugins='pretix_pwyc',
+            )
+            item_map = {
+                item.pk: Item.objects.create(event=new_event, name=item.name, default_price=10) for item in items
+            }
+
+        with CaptureQueriesContext(connection) as ctx:
+            event_copy_data_receiver(new_event, other=self.event, item_map=item_map)
+        config_queries = [q for q in ctx.captured_queries if 'pretix_pwyc_pwycitemconfig' in q['sql']]
+        self.assertEqual(len(config_queries), 3)
+
+        copied = {c.item_id: c for c in PWYCItemConfig.objects.filter(event=new_event)}
+        expected = [item for item in items if item.pwyc_config.enabled]
+        self.assertEqual(set(copied), {item_map[item.pk].pk for item in expected})
+        for item in expected:
+            config = copied[item_map[item.pk].pk]
+            self.assertTrue(config.enabled)
+            self.assertEqual(config.min_amount, item.pwyc_config.min_amount)
+            self.assertEqual(config.suggested_amount, item.pwyc_config.suggested_amount)
+            self.assertEqual(config.explanation, item.pwyc_config.explanation)
+
+    def test_event_copy_atomic(self):
+        """Test that item and variation configurations are copied together with one invalidation"""
+        from unittest import mock
+        from django_scopes import scopes_disabled
+        from pretix_pwyc import config
+        from pretix_pwyc.models import PWYCVariationConfig
+        from pretix_pwyc.signals import event_copy_data_receiver
+
+        with scopes_disabled():
+            variation = self.ticket.variations.create(value='Supporter')
+            PWYCVariationConfig.objects.create(
+                event=self.event, item=self.ticket, variation=variation, min_amount=decimal.Decimal('20.00')
+            )
+            new_event = Event.objects.create(
+                organizer=self.orga, name='Clone', slug='clone', date_from='2030-02-01 10:00:00Z',
+                plugins='pretix_pwyc',
+            )
+            new_item = Item.objects.create(event=new_event, name='Test Ticket', default_price=10)
+            new_variation = new_item.variations.create(value='Supporter')
+        kwargs = {
+            'other': self.event, 'item_map': {self.ticket.pk: new_item}, 'variation_map': {variation.pk: new_variation},
+        }
+
+        with mock.patch.object(config, '_copy_variation_configs', side_effect=RuntimeError), \
+                mock.patch.object(config, 'invalidate_config') as invalidate:
+            event_copy_data_receiver(new_event, **kwargs)
+        self.assertFalse(PWYCItemConfig.objects.filter(event=new_event).exists())
+        invalidate.assert_not_called()
+
+        with mock.patch.object(config, 'invalidate_config', wraps=config.invalidate_config) as invalidate:
+            event_copy_data_receiver(new_event, **kwargs)
+        invalidate.assert_called_once()
+        self.assertTrue(PWYCItemConfig.objects.filter(event=new_event, item=new_item).exists())
+        self.assertEqual(PWYCVariationConfig.objects.get(event=new_event).min_amount, decimal.Decimal('20.00'))
+
+    def test_bulk_editor(self):
+        """Test that the settings page edits all items at once and only writes changed rows"""
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from pretix.base.models import LogEntry, User
+
+        others = [Item.objects.create(event=self.event, name=f'Ticket {i}', default_price=10) for i in range(3)]
+        user = User.objects.create_user('dummy@dummy.dummy', 'dummy')
+        team = self.orga.teams.create(name='Admins', all_events=True, all_event_permissions=True)
+        team.members.add(user)
+        self.client.login(email='dummy@dummy.dummy', password='dummy')
+        url = f'/control/event/{self.orga.slug}/{self.event.slug}/settings/pwyc/'
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        formset = response.context['items_formset']
+        self.assertEqual([item.pk for item in formset.items], [self.ticket.pk] + [item.pk for item in others])
+
+        data = {
+            'pwyc_explanation_default': '',
+            'items-TOTAL_FORMS': '4',
+            'items-INITIAL_FORMS': '4',
+            'items-MIN_NUM_FORMS': '0',
+            'items-MAX_NUM_FORMS': '10000',
+        }
+        for i, form in enumerate(formset.forms):
+            for name, value in form.initial.items():
+                if value is None or value is False:
+                    continue
+                data[f'items-{i}-{name}'] = 'on' if value is True else str(value)
+        data['items-0-pwyc_min_amount'] = '6.00'
+        data['items-2-pwyc_enabled'] = 'on'
+        data['items-2-pwyc_suggested_amount'] = '12.00'
+
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(url, data)
+        self.assertEqual(response.status_code, 302)
+        writes = [q['sql'] for q in queries if 'pretix_pwyc_pwycitemconfig' in q['sql'] and not q['sql'].startswith('SELECT')]
+        self.assertEqual(len(writes), 2)
         self.assertEqual(
-            new_event.settings.get(f'pwyc_min_amount_{new_ticket.pk}'),
-            self.event.settings.get(f'pwyc_min_amount_{self.ticket.pk}')
+            list(LogEntry.objects.filter(action_type__startswith='pretix_pwyc.item').values_list('action_type', 'object_id', 'user')),
+            [('pretix_pwyc.item.enabled', others[1].pk, user.pk)],
         )
+
+        configs = {c.item_id: c for c in PWYCItemConfig.objects.filter(event=self.event)}
+        self.assertEqual(set(configs), {self.ticket.pk, others[1].pk})
+        self.assertEqual(configs[self.ticket.pk].min_amount, decimal.Decimal('6.00'))
+        self.assertEqual(configs[self.ticket.pk].explanation, 'Test explanation')
+        self.assertTrue(configs[others[1].pk].enabled)
+        self.assertEqual(configs[others[1].pk].suggested_amount, decimal.Decimal('12.00'))
+
+        data['items-3-item_id'] = str(others[0].pk)
+        response = self.client.post(url, data)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('please reload the page', response.content.decode())
+
+    def test_order_price_log(self):
+        """Test that the custom prices of an order are logged with one insert at commit"""
+        import json
+        from datetime import timedelta
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from django.utils.timezone import now
+        from django_scopes import scope
+        from pretix.base.models import LogEntry, Order, OrderPosition
+        from pretix_pwyc.signals import log_pwyc_prices
+
+        with scope(organizer=self.orga):
+            order = Order.objects.create(
+                event=self.event, status=Order.STATUS_PENDING, email='test@example.org', datetime=now(),
+                expires=now() + timedelta(days=10), total=decimal.Decimal('15.00'),
+                sales_channel=self.orga.sales_channels.get(identifier='web'),
+                meta_info=json.dumps({'pwyc': {'positions': [
+                    {'item_id': self.ticket.pk, 'variation_id': None, 'original_price': '10.00', 'price': '7.50'},
+                ]}}),
+            )
+            for i in range(2):
+                OrderPosition.objects.create(order=order, item=self.ticket, price=decimal.Decimal('7.50'), positionid=i + 1)
+
+            with self.captureOnCommitCallbacks() as callbacks:
+                log_pwyc_prices(self.event, order=order)
+            self.assertFalse(LogEntry.objects.filter(action_type='pretix_pwyc.order.price_changed').exists())
+            with CaptureQueriesContext(connection) as queries:
+                for callback in callbacks:
+                    callback()
+
+        self.assertEqual(len([q for q in queries if q['sql'].startswith('INSERT INTO "pretixbase_logentry"')]), 1)
+        entries = LogEntry.objects.filter(action_type='pretix_pwyc.order.price_changed', object_id=order.pk)
+        self.assertEqual(sorted(e.parsed_data['positionid'] for e in entries), [1, 2])
+        self.assertEqual(entries[0].parsed_data['original_price'], '10.00')
+
+    def test_settings_migration(self):
+        """Test that legacy per-item settings keys are moved to PWYCItemConfig"""
+        from importlib import import_module
+        from django.apps import apps
+        from django_scopes import scopes_disabled
+        migration = import_module('pretix_pwyc.migrations.0002_migrate_settings')
+
+        legacy = Item.objects.create(
+            event=self.event,
+            name='Legacy Ticket',
+            default_price=10,
+            admission=True
+        )
+        self.event.settings.set(f'pwyc_enabled_{legacy.pk}', 'true')
+        self.event.settings.set(f'pwyc_min_amount_{legacy.pk}', '3.50')
+        self.event.settings.set(f'pwyc_suggested_amount_{legacy.pk}', '')
+        self.event.settings.set(f'pwyc_explanation_{legacy.pk}', 'Legacy explanation')
+
+        with scopes_disabled():
+            migration.settings_to_configs(apps, None)
+
+        config = PWYCItemConfig.objects.get(item=legacy)
+        self.assertTrue(config.enabled)
+        self.assertEqual(config.min_amount, decimal.Decimal('3.50'))
+        self.assertIsNone(config.suggested_amount)
+        self.assertEqual(config.explanation, 'Legacy explanation')
+        self.assertFalse(
+            self.event._settings_objects.filter(key__startswith='pwyc_enabled_').exists()
+        )
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_config_snapshot(self):
+        """Test that the config snapshot is reused and dropped when the configuration changes"""
+        from django.core.cache import cache
+        from pretix_pwyc.config import get_config_snapshot
+        from pretix_pwyc.forms import save_config
+        cache.clear()
+
+        snapshot = get_config_snapshot(self.event)
+        self.assertTrue(snapshot.is_enabled(self.ticket.pk))
+        self.assertIsNone(snapshot.get(self.ticket.pk + 1000))
+
+        with self.assertNumQueries(0):
+            self.assertIs(get_config_snapshot(self.event), snapshot)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            save_config(self.event, self.ticket, {'pwyc_enabled': False})
+
+        new_snapshot = get_config_snapshot(self.event)
+        self.assertIsNot(new_snapshot, snapshot)
+        self.assertNotEqual(new_snapshot.version, snapshot.version)
+        self.assertFalse(new_snapshot.is_enabled(self.ticket.pk))
+
+    def test_subevent_overrides(self):
+        """Test that date overrides are merged into the snapshot and resolved without queries"""
+        from django.core.cache import cache
+        from django_scopes import scopes_disabled
+        from pretix_pwyc.config import get_config_snapshot
+        from pretix_pwyc.models import PWYCSubEventConfig
+        from pretix_pwyc.validation import PriceError, validate_price
+        cache.clear()
+
+        self.event.has_subevents = True
+        self.event.save()
+        with scopes_disabled():
+            subevents = SubEvent.objects.bulk_create([
+                SubEvent(event=self.event, name=f'Date {i}', date_from='2030-01-01 10:00:00Z') for i in range(200)
+            ])
+        matinee, closed, regular = subevents[:3]
+        PWYCSubEventConfig.objects.bulk_create([
+            PWYCSubEventConfig(event=self.event, subevent=matinee, item=self.ticket, min_amount=decimal.Decimal('2.00')),
+            PWYCSubEventConfig(event=self.event, subevent=closed, item=self.ticket, enabled=False),
+        ] + [
+            PWYCSubEventConfig(event=self.event, subevent=se, item=self.ticket, suggested_amount=decimal.Decimal('20.00'))
+            for se in subevents[3:]
+        ])
+
+        with self.assertNumQueries(1):
+            snapshot = get_config_snapshot(self.event, refresh=True)
+        with self.assertNumQueries(0):
+            self.assertEqual(snapshot.get(self.ticket.pk, matinee.pk).min_amount, decimal.Decimal('2.00'))
+            self.assertEqual(snapshot.get(self.ticket.pk, matinee.pk).suggested_amount, decimal.Decimal('15.00'))
+            self.assertEqual(snapshot.get(self.ticket.pk, matinee.pk).explanation, 'Test explanation')
+            self.assertFalse(snapshot.is_enabled(self.ticket.pk, closed.pk))
+            self.assertEqual(snapshot.enabled_item_ids(closed.pk), [])
+            self.assertEqual(snapshot.get(self.ticket.pk, regular.pk).min_amount, decimal.Decimal('5.00'))
+            self.assertEqual(snapshot.get(self.ticket.pk, subevents[-1].pk).suggested_amount, decimal.Decimal('20.00'))
+            self.assertEqual(snapshot.get(self.ticket.pk), snapshot.get(self.ticket.pk, None))
+
+        # The date is unknown when a price is set, so the lowest minimum of all dates applies
+        self.assertEqual(
+            validate_price(snapshot, 'EUR', self.ticket.pk, None, decimal.Decimal('3.00')), decimal.Decimal('3.00')
+        )
+        with self.assertRaises(PriceError):
+            validate_price(snapshot, 'EUR', self.ticket.pk, None, decimal.Decimal('1.00'))
+
+    def test_subevent_fragments(self):
+        """Test that dates without overrides share their head block and fragments are kept up to a limit"""
+        from django_scopes import scopes_disabled
+        from pretix_pwyc.config import BoundedCache, get_config_snapshot
+        from pretix_pwyc.fragments import head_fragment, item_fragment
+        from pretix_pwyc.models import PWYCSubEventConfig
+
+        with scopes_disabled():
+            subevents = SubEvent.objects.bulk_create([
+                SubEvent(event=self.event, name=f'Date {i}', date_from='2030-01-01 10:00:00Z') for i in range(50)
+            ])
+        PWYCSubEventConfig.objects.create(
+            event=self.event, subevent=subevents[0], item=self.ticket, suggested_amount=decimal.Decimal('20.00')
+        )
+        snapshot = get_config_snapshot(self.event, refresh=True)
+        heads = {head_fragment(self.event, snapshot, subevent_id=se.pk) for se in subevents}
+        for se in subevents:
+            item_fragment(self.event, self.ticket.pk, snapshot, subevent_id=se.pk)
+        self.assertEqual(len(heads), 2)
+        self.assertEqual(len(snapshot.fragments), 3)
+
+        fragments = BoundedCache(2)
+        for key in range(3):
+            fragments[key] = str(key)
+        self.assertEqual(list(fragments), [1, 2])
+
+    def test_subevent_overrides_applied(self):
+        """Test that the minimum of the date is enforced when the price is applied to the cart"""
+        from datetime import timedelta
+        from django.utils.timezone import now
+        from django_scopes import scopes_disabled
+        from pretix_pwyc.models import PWYCCartPrice, PWYCSubEventConfig
+        from pretix_pwyc.signals import apply_pwyc_price
+
+        self.event.has_subevents = True
+        self.event.save()
+        with scopes_disabled():
+            matinee = SubEvent.objects.create(event=self.event, name='Matinee', date_from='2030-01-01 10:00:00Z')
+            evening = SubEvent.objects.create(event=self.event, name='Evening', date_from='2030-01-01 20:00:00Z')
+            PWYCSubEventConfig.objects.create(
+                event=self.event, subevent=matinee, item=self.ticket, min_amount=decimal.Decimal('2.00')
+            )
+            PWYCCartPrice.objects.create(event=self.event, cart_id='a', item=self.ticket, price=decimal.Decimal('3.00'))
+            positions = [
+                CartPosition.objects.create(
+                    event=self.event, subevent=subevent, cart_id='a', item=self.ticket, price=10,
+                    expires=now() + timedelta(minutes=30)
+                )
+                for subevent in (matinee, evening)
+            ]
+
+        apply_pwyc_price(self.event, positions=positions, invoice_address=None, request=None)
+        self.assertEqual(positions[0].price, decimal.Decimal('3.00'))
+        self.assertEqual(positions[1].price, decimal.Decimal('10.00'))
+
+    def test_subevent_form_bulk_copy(self):
+        """Test that the date form copies the overrides of the source date to every new date in one batch"""
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from django_scopes import scopes_disabled
+        from pretix_pwyc.forms import PWYCSubEventForm
+        from pretix_pwyc.models import PWYCSubEventConfig
+
+        self.event.has_subevents = True
+        self.event.save()
+        with scopes_disabled():
+            source = SubEvent.objects.create(event=self.event, name='Source', date_from='2030-01-01 10:00:00Z')
+            targets = [
+                SubEvent.objects.create(event=self.event, name=f'Copy {i}', date_from='2030-01-02 10:00:00Z')
+                for i in range(5)
+            ]
+            PWYCSubEventConfig.objects.create(
+                event=self.event, subevent=source, item=self.ticket, enabled=True, min_amount=decimal.Decimal('1.00')
+            )
+
+            form = PWYCSubEventForm(event=self.event, subevent=None, copy_from=source, prefix='pwyc')
+            self.assertEqual(form.initial[f'enabled_{self.ticket.pk}'], 'on')
+            data = {
+                f'pwyc-enabled_{self.ticket.pk}': 'on',
+                f'pwyc-min_amount_{self.ticket.pk}': '1.00',
+                f'pwyc-suggested_amount_{self.ticket.pk}': '',
+            }
+            form = PWYCSubEventForm(data=data, event=self.event, subevent=None, copy_from=source, prefix='pwyc')
+            self.assertTrue(form.is_valid(), form.errors)
+            with CaptureQueriesContext(connection) as ctx:
+                with self.captureOnCommitCallbacks(execute=True):
+                    for subevent in targets:
+                        form.subevent = subevent
+                        form.save()
+                    self.assertFalse(PWYCSubEventConfig.objects.filter(subevent__in=targets).exists())
+        writes = [q['sql'].split()[0] for q in ctx.captured_queries if q['sql'].startswith(('INSERT', 'DELETE'))]
+        self.assertEqual(writes, ['DELETE', 'INSERT'])
+
+        copied = PWYCSubEventConfig.objects.filter(subevent__in=targets)
+        self.assertEqual(copied.count(), len(targets))
+        self.assertTrue(all(c.enabled and c.min_amount == decimal.Decimal('1.00') for c in copied))
+        self.assertIsNone(copied[0].suggested_amount)
+
+    def test_variation_configs(self):
+        """Test that variations are configured and priced separately, resolved from one table"""
+        from datetime import timedelta
+        from django.core.cache import cache
+        from django.utils.timezone import now
+        from django_scopes import scopes_disabled
+        from pretix_pwyc.config import get_config_snapshot
+        from pretix_pwyc.fragments import item_fragment
+        from pretix_pwyc.models import PWYCCartPrice, PWYCVariationConfig
+        from pretix_pwyc.signals import apply_pwyc_price
+        from pretix_pwyc.validation import PriceError, validate_price
+        cache.clear()
+
+        with scopes_disabled():
+            variations = [self.ticket.variations.create(value=f'Variation {i}') for i in range(30)]
+        supporter, reduced, closed = variations[:3]
+        PWYCVariationConfig.objects.bulk_create([
+            PWYCVariationConfig(event=self.event, item=self.ticket, variation=supporter, min_amount=decimal.Decimal('20.00')),
+            PWYCVariationConfig(event=self.event, item=self.ticket, variation=reduced, min_amount=decimal.Decimal('1.00')),
+            PWYCVariationConfig(event=self.event, item=self.ticket, variation=closed, enabled=False),
+        ])
+
+        with self.assertNumQueries(1):
+            snapshot = get_config_snapshot(self.event, refresh=True)
+        with self.assertNumQueries(0):
+            self.assertEqual(snapshot.get(self.ticket.pk, variation_id=supporter.pk).min_amount, decimal.Decimal('20.00'))
+            self.assertEqual(snapshot.get(self.ticket.pk, variation_id=reduced.pk).suggested_amount, decimal.Decimal('15.00'))
+            self.assertEqual(snapshot.get(self.ticket.pk, variation_id=variations[-1].pk).min_amount, decimal.Decimal('5.00'))
+            self.assertFalse(snapshot.is_enabled(self.ticket.pk, variation_id=closed.pk))
+            fragments = [item_fragment(self.event, self.ticket.pk, snapshot, variation_id=v.pk) for v in variations]
+            self.assertEqual(item_fragment(self.event, self.ticket.pk, snapshot), '')
+        self.assertIn(f'pwyc-variation-{supporter.pk}', fragments[0])
+        self.assertEqual(fragments[2], '')
+        self.assertEqual(sum(1 for f in fragments if f), 29)
+
+        validate_price(snapshot, 'EUR', self.ticket.pk, reduced.pk, decimal.Decimal('2.00'))
+        with self.assertRaises(PriceError):
+            validate_price(snapshot, 'EUR', self.ticket.pk, supporter.pk, decimal.Decimal('15.00'))
+
+        with scopes_disabled():
+            PWYCCartPrice.objects.bulk_create([
+                PWYCCartPrice(event=self.event, cart_id='a', item=self.ticket, variation=supporter, price=decimal.Decimal('25.00')),
+                PWYCCartPrice(event=self.event, cart_id='a', item=self.ticket, variation=reduced, price=decimal.Decimal('2.00')),
+            ])
+            positions = [
+                CartPosition.objects.create(
+                    event=self.event, cart_id='a', item=self.ticket, variation=variation, price=10,
+                    expires=now() + timedelta(minutes=30)
+                )
+                for variation in (supporter, reduced, closed)
+            ]
+        apply_pwyc_price(self.event, positions=positions, invoice_address=None, request=None)
+        self.assertEqual([p.price for p in positions], [decimal.Decimal('25.00'), decimal.Decimal('2.00'), 10])
+
+    def test_variation_formset(self):
+        """Test that the variation overrides are edited on the item page and written in one batch"""
+        from django_scopes import scopes_disabled
+        from pretix_pwyc.forms import PWYCVariationConfigFormSet
+        from pretix_pwyc.models import PWYCVariationConfig
+
+        with scopes_disabled():
+            variations = [self.ticket.variations.create(value=f'Variation {i}') for i in range(3)]
+            data = {
+                'pwycvariations-TOTAL_FORMS': '3',
+                'pwycvariations-INITIAL_FORMS': '3',
+            }
+            for i, variation in enumerate(variations):
+                data.update({
+                    f'pwycvariations-{i}-variation_id': str(variation.pk),
+                    f'pwycvariations-{i}-enabled': 'off' if i == 2 else '',
+                    f'pwycvariations-{i}-min_amount': '20.00' if i == 0 else '',
+                    f'pwycvariations-{i}-suggested_amount': '',
+                })
+            formset = PWYCVariationConfigFormSet(data=data, event=self.event, item=self.ticket)
+            self.assertTrue(formset.is_valid(), formset.errors)
+            formset.save()
+
+        configs = {c.variation_id: c for c in PWYCVariationConfig.objects.filter(item=self.ticket)}
+        self.assertEqual(set(configs), {variations[0].pk, variations[2].pk})
+        self.assertEqual(configs[variations[0].pk].min_amount, decimal.Decimal('20.00'))
+        self.assertIsNone(configs[variations[0].pk].enabled)
+        self.assertFalse(configs[variations[2].pk].enabled)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_fragment_cache(self):
+        """Test that rendered fragments are reused until the configuration changes and pre-warmed on save"""
+        from django.core.cache import cache
+        from pretix_pwyc.config import _build_snapshot, get_config_snapshot
+        from pretix_pwyc.forms import save_config
+        from pretix_pwyc.fragments import fragment_stats, head_fragment, item_fragment, schedule_prewarm
+        cache.clear()
+        fragment_stats.clear()
+
+        head = head_fragment(self.event)
+        self.assertIn('pwyc-config', head)
+        self.assertIn(f'pwyc-item-{self.ticket.pk}', item_fragment(self.event, self.ticket.pk))
+        self.assertEqual(fragment_stats['misses'], 2)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(head_fragment(self.event), head)
+            item_fragment(self.event, self.ticket.pk)
+        self.assertEqual(fragment_stats['hits'], 2)
+
+        # Another worker finds the head block in the shared cache
+        snapshot = get_config_snapshot(self.event)
+        other_worker = _build_snapshot(self.event.pk, snapshot.version)
+        self.assertEqual(head_fragment(self.event, other_worker), head)
+        self.assertEqual(fragment_stats['shared_hits'], 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            save_config(self.event, self.ticket, {
+                'pwyc_enabled': True,
+                'pwyc_min_amount': decimal.Decimal('5.00'),
+                'pwyc_suggested_amount': decimal.Decimal('20.00'),
+            })
+            schedule_prewarm(self.event)
+
+        fragment_stats.clear()
+        new_head = head_fragment(self.event)
+        self.assertIn('20.00', new_head)
+        self.assertEqual(fragment_stats['hits'], 1)
+        self.assertEqual(fragment_stats['misses'], 0)
+
+    def test_request_config_cache(self):
+        """Test that the configuration is fetched at most once per request"""
+        from django_scopes import scope
+        from pretix_pwyc.config import request_cache_stats
+
+        self.event.live = True
+        self.event.save()
+        with scope(organizer=self.orga):
+            quota = self.event.quotas.create(name='Tickets', size=100)
+            for i in range(5):
+                quota.items.add(Item.objects.create(event=self.event, name=f'Ticket {i}', default_price=10))
+            quota.items.add(self.ticket)
+
+        request_cache_stats.clear()
+        response = self.client.get(f'/{self.orga.slug}/{self.event.slug}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(f'pwyc-item-{self.ticket.pk}', response.content.decode())
+        self.assertEqual(request_cache_stats['requests'], 1)
+        self.assertGreaterEqual(request_cache_stats['lookups'], 6)
+        self.assertEqual(request_cache_stats['max_fetches_per_request'], 1)
+
+    def test_product_list_html_size(self):
+        """Test that the price widget is shipped once per page, not once per item"""
+        from django_scopes import scope
+
+        self.event.live = True
+        self.event.save()
+        with scope(organizer=self.orga):
+            quota = self.event.quotas.create(name='Tickets', size=100)
+            items = [
+                Item.objects.create(event=self.event, name=f'Ticket {i}', default_price=10, description='Ticket')
+                for i in range(100)
+            ]
+            quota.items.add(*items)
+
+        response = self.client.get(f'/{self.orga.slug}/{self.event.slug}/')
+        size_without_pwyc = len(response.content)
+
+        PWYCItemConfig.objects.bulk_create([
+            PWYCItemConfig(
+                event=self.event, item=item, enabled=True,
+                min_amount=decimal.Decimal('5.00'), suggested_amount=decimal.Decimal('15.00'),
+                explanation='Pay what you can afford'
+            )
+            for item in items
+        ])
+        response = self.client.get(f'/{self.orga.slug}/{self.event.slug}/')
+        content = response.content.decode()
+
+        self.assertEqual(content.count('pretix_pwyc/js/pwyc.min.js'), 1)
+        self.assertEqual(content.count('id="pwyc-config"'), 1)
+        self.assertEqual(content.count('class="pwyc-data'), 100)
+        self.assertNotIn('<script>', content[content.index('class="pwyc-data'):])
+        # Per item, we only add the data container and the item's entry in the configuration block
+        self.assertLess(len(response.content) - size_without_pwyc, 100 * 200)
+
+    def test_set_price_batch(self):
+        """Test that a batch of prices is stored with a single request"""
+        import json
+        from django.contrib.sessions.backends.db import SessionStore
+        from django.test import RequestFactory
+        from django_scopes import scope
+        from pretix_pwyc.models import PWYCCartPrice
+        from pretix_pwyc.views import PWYCSetPriceView
+
+        other = Item.objects.create(event=self.event, name='Other Ticket', default_price=20)
+        PWYCItemConfig.objects.create(event=self.event, item=other, enabled=True)
+        session = SessionStore()
+
+        def post(prices):
+            request = RequestFactory().post('/pwyc/set-price/', data=json.dumps({'prices': prices}),
+                                            content_type='application/json')
+            request.session, request.event = session, self.event
+            with scope(organizer=self.orga):
+                return PWYCSetPriceView.as_view()(request)
+
+        response = post([{'item_id': self.ticket.pk, 'price': '7.50'}, {'item_id': other.pk, 'price': 12}])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(dict(PWYCCartPrice.objects.values_list('item_id', 'price')), {
+            self.ticket.pk: decimal.Decimal('7.50'), other.pk: decimal.Decimal('12.00'),
+        })
+
+        response = post([{'item_id': self.ticket.pk, 'price': '8.00'}, {'item_id': other.pk, 'price': -1}])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(PWYCCartPrice.objects.get(item=self.ticket).price, decimal.Decimal('7.50'))
+
+    def test_set_price_without_event(self):
+        """Test that the retired URL without an event stores no prices"""
+        import json
+        from django.contrib.sessions.backends.db import SessionStore
+
+        session = SessionStore()
+        session.create()
+        self.client.cookies['pretix_session'] = session.session_key
+        response = self.client.post('/pwyc/set-price/', data=json.dumps({
+            'item_id': self.ticket.pk, 'price': '1000.00',
+        }), content_type='application/json')
+        self.assertEqual(response.status_code, 410)
+        self.assertEqual(json.loads(response.content)['errors'][0]['code'], 'no_event')
+        self.assertNotIn('pwyc_prices', SessionStore(session.session_key).load())
+
+    def test_log_sampling(self):
+        """Test that sampled paths drop INFO messages but always keep warnings"""
+        from unittest import mock
+        from pretix_pwyc import log
+
+        logger = log.get_logger('pretix_pwyc.test', 'test_path')
+        with mock.patch.dict(log._sample_rates, {'test_path': 0, 'detail': False}):
+            with self.assertLogs('pretix_pwyc.test', level='DEBUG') as cm:
+                logger.info("dropped %s", 1)
+                logger.detail("dropped %s", 2)
+                logger.warning("kept %s", 3)
+            self.assertEqual([r.getMessage() for r in cm.records], ['kept 3'])
+            self.assertEqual(cm.records[0].pwyc_path, 'test_path')
+
+        with mock.patch.dict(log._sample_rates, {'test_path': 1, 'detail': True}):
+            with self.assertLogs('pretix_pwyc.test', level='DEBUG') as cm:
+                logger.info("kept %s", 1)
+                logger.detail("kept %s", 2)
+            self.assertEqual([r.getMessage() for r in cm.records], ['kept 1', 'kept 2'])
+
+    async def test_async_set_price(self):
+        """Test that the async set-price view keeps the JSON contract of the sync view"""
+        import json
+        from asgiref.sync import sync_to_async
+        from pretix_pwyc.models import PWYCCartPrice
+
+        url = f'/{self.orga.slug}/{self.event.slug}/pwyc/async/set-price/'
+        body = json.dumps({'prices': [{'item_id': self.ticket.pk, 'price': '7.50'}]})
+        response = await self.async_client.post(url, data=body, content_type='application/json')
+        self.assertEqual(response.status_code, 404)
+
+        self.event.live = True
+        await sync_to_async(self.event.save)()
+        response = await self.async_client.post(url, data=body, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'success': True, 'prices': {str(self.ticket.pk): 7.5}})
+        price = await PWYCCartPrice.objects.aget(event=self.event, item=self.ticket)
+        self.assertEqual(price.price, decimal.Decimal('7.50'))
+
+        response = await self.async_client.post(
+            url, data=json.dumps({'item_id': self.ticket.pk, 'price': -1}), content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'error': 'Price cannot be negative', 'errors': [
+            {'code': 'negative', 'message': 'Price cannot be negative', 'item_id': self.ticket.pk},
+        ]})
+
+    def test_set_price_validation(self):
+        """Test that prices are validated against the item configuration before they are stored"""
+        import json
+        from django.contrib.sessions.backends.db import SessionStore
+        from django.test import RequestFactory
+        from pretix_pwyc.views import PWYCSetPriceView
+
+        other = Item.objects.create(event=self.event, name='Regular Ticket', default_price=10)
+
+        def post(prices):
+            request = RequestFactory().post('/pwyc/set-price/', data=json.dumps({'prices': prices}),
+                                            content_type='application/json')
+            request.session = SessionStore()
+            request.event = self.event
+            return PWYCSetPriceView.as_view()(request)
+
+        response = post([
+            {'item_id': self.ticket.pk, 'price': '4.99'},
+            {'item_id': other.pk, 'price': '10'},
+            {'item_id': self.ticket.pk, 'variation_id': 5, 'price': '5.001'},
+            {'item_id': self.ticket.pk + 1000, 'price': '10'},
+        ])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([e['code'] for e in json.loads(response.content)['errors']], [
+            'below_minimum', 'item_unavailable', 'invalid_precision', 'item_unavailable',
+        ])
+
+        response = post([{'item_id': self.ticket.pk, 'price': 'NaN'}])
+        self.assertEqual(json.loads(response.content)['errors'][0]['code'], 'invalid_format')
+
+        response = post([{'item_id': self.ticket.pk, 'price': 5.1}])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content), {'success': True, 'prices': {str(self.ticket.pk): 5.1}})
+
+
+class PWYCSubEventFormTest(TransactionTestCase):
+    """The date form saved outside of a transaction, e.g. from a script or a management command"""
+
+    def test_save_outside_transaction(self):
+        from django.db import connection
+        from django_scopes import scopes_disabled
+        from pretix_pwyc.forms import PWYCSubEventForm
+        from pretix_pwyc.models import PWYCSubEventConfig
+
+        orga = Organizer.objects.create(name='PWYC Test', slug='pwyc-test')
+        event = Event.objects.create(
+            organizer=orga, name='PWYC Test Event', slug='pwyc-test-event', date_from='2030-01-01 10:00:00Z',
+            plugins='pretix_pwyc', has_subevents=True,
+        )
+        ticket = Item.objects.create(event=event, name='Test Ticket', default_price=10)
+        PWYCItemConfig.objects.create(event=event, item=ticket, enabled=True, min_amount=decimal.Decimal('5.00'))
+        with scopes_disabled():
+            subevent = SubEvent.objects.create(event=event, name='Matinee', date_from='2030-01-01 10:00:00Z')
+            form = PWYCSubEventForm(data={
+                f'pwyc-enabled_{ticket.pk}': 'on',
+                f'pwyc-min_amount_{ticket.pk}': '2.00',
+                f'pwyc-suggested_amount_{ticket.pk}': '',
+            }, event=event, subevent=subevent, prefix='pwyc')
+            self.assertTrue(form.is_valid(), form.errors)
+            self.assertFalse(connection.in_atomic_block)
+            form.save()
+
+        override = PWYCSubEventConfig.objects.get(subevent=subevent, item=ticket)
+        self.assertEqual(override.min_amount, decimal.Decimal('2.00'))
@@ -0,0 +1,84 @@
+import json
+
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import cache
+from django.test import RequestFactory, TestCase, override_settings
+from pretix.base.models import Event, Item, Organizer
+
+from pretix_pwyc import ratelimit
+from pretix_pwyc.models import PWYCItemConfig
+from pretix_pwyc.views import PWYCSetPriceView
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class RateLimitTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.orga = Organizer.objects.create(name='PWYC Test', slug='pwyc-test')
+        self.event = Event.objects.create(
+            organizer=self.orga,
+            name='PWYC Test Event',
+            slug='pwyc-test-event',
+            date_from='2030-01-01 10:00:00Z',
+            plugins='pretix_pwyc',
+        )
+        self.ticket = Item.objects.create(event=self.event, name='Test Ticket', default_price=10)
+        PWYCItemConfig.objects.create(event=self.event, item=self.ticket, enabled=True)
+
+    def tearDown(self):
+        ratelimit.set_rate_limiter(None)
+
+    def _post(self, session, ip='10.0.0.1'):
+        request = RequestFactory().post(
+            '/pwyc/set-price/', data=json.dumps({'item_id': self.ticket.pk, 'price': '12.00'}),
+            content_type='application/json', REMOTE_ADDR=ip,
+        )
+        request.session = session
+        request.event = self.event
+        return PWYCSetPriceView.as_view()(request)
+
+    def _session(self):
+        session = SessionStore()
+        session.create()
+        return session
+
+    def test_token_bucket(self):
+        """Test that a bucket allows a burst and refills at its rate"""
+        limiter = ratelimit.InMemoryRateLimiter()
+        limit = ratelimit.Limit(rate=1, burst=2)
+        self.assertEqual(limiter.consume('a', limit, now=0), 0)
+        self.assertEqual(limiter.consume('a', limit, now=0), 0)
+        self.assertAlmostEqual(limiter.consume('a', limit, now=0), 1)
+        self.assertAlmostEqual(limiter.consume('a', limit, now=0.5), 0.5)
+        self.assertEqual(limiter.consume('a', limit, now=1), 0)
+        self.assertEqual(limiter.consume('b', limit, now=1), 0)
+
+    def test_session_limit(self):
+        """Test that a session is throttled with a 429 response while others are not"""
+        for limiter in (ratelimit.InMemoryRateLimiter(), ratelimit.CacheRateLimiter()):
+            ratelimit.set_rate_limiter(limiter, {
+                'session': ratelimit.Limit(0.1, 3),
+                'ip': ratelimit.Limit(100, 100),
+                'event': ratelimit.Limit(100, 100),
+            })
+            session = self._session()
+            for _ in range(3):
+                self.assertEqual(self._post(session).status_code, 200)
+            response = self._post(session)
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response['Retry-After'], '10')
+            self.assertEqual(self._post(self._session()).status_code, 200)
+
+    def test_ip_and_event_limit(self):
+        """Test that clients without cookies are throttled by IP address and all clients by event"""
+        ratelimit.set_rate_limiter(ratelimit.CacheRateLimiter(), {
+            'session': ratelimit.Limit(100, 100),
+            'ip': ratelimit.Limit(0.01, 2),
+            'event': ratelimit.Limit(0.01, 4),
+        })
+        self.assertEqual(self._post(SessionStore()).status_code, 200)
+        self.assertEqual(self._post(SessionStore()).status_code, 200)
+        self.assertEqual(self._post(SessionStore()).status_code, 429)
+        self.assertEqual(self._post(SessionStore(), ip='10.0.0.2').status_code, 200)
+        self.assertEqual(self._post(SessionStore(), ip='10.0.0.3').status_code, 200)
+        self.assertEqual(self._post(SessionStore(), ip='10.0.0.4').status_code, 429)
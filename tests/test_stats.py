@@ -0,0 +1,144 @@
+import decimal
+from datetime import timedelta
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils.timezone import now
+from django_scopes import scope
+from pretix.base.models import Event, Item, Order, OrderPosition, Organizer
+
+from pretix_pwyc.models import PWYCItemConfig, PWYCPriceStats, PWYCVariationConfig
+from pretix_pwyc.signals import pwyc_dashboard_widget, update_stats_on_cancel, update_stats_on_payment
+from pretix_pwyc.stats import HISTOGRAM_BOUNDS
+
+
+class PriceStatsTest(TestCase):
+    def setUp(self):
+        self.orga = Organizer.objects.create(name='PWYC Test', slug='pwyc-test')
+        self.event = Event.objects.create(
+            organizer=self.orga,
+            name='PWYC Test Event',
+            slug='pwyc-test-event',
+            date_from='2030-01-01 10:00:00Z',
+            plugins='pretix_pwyc',
+        )
+        self.ticket = Item.objects.create(event=self.event, name='Test Ticket', default_price=10)
+        self.regular = Item.objects.create(event=self.event, name='Regular Ticket', default_price=20)
+        PWYCItemConfig.objects.create(
+            event=self.event, item=self.ticket, enabled=True, suggested_amount=decimal.Decimal('15.00')
+        )
+
+    def _order(self, *prices, status=Order.STATUS_PAID):
+        with scope(organizer=self.orga):
+            order = Order.objects.create(
+                event=self.event, status=status, email='test@example.org', datetime=now(),
+                expires=now() + timedelta(days=10), total=sum(map(decimal.Decimal, prices)) + 20,
+                sales_channel=self.orga.sales_channels.get(identifier='web'),
+            )
+            for i, price in enumerate(prices):
+                OrderPosition.objects.create(order=order, item=self.ticket, price=decimal.Decimal(price), positionid=i + 1)
+            OrderPosition.objects.create(order=order, item=self.regular, price=20, positionid=len(prices) + 1)
+        return order
+
+    def _stats(self):
+        stats = PWYCPriceStats.objects.get(item=self.ticket)
+        return (
+            stats.count, stats.total, stats.min_price, stats.max_price, stats.histogram,
+            stats.below_suggested, stats.at_suggested, stats.above_suggested,
+        )
+
+    def test_incremental_updates(self):
+        """Test that paid orders are counted once and canceled ones are removed again"""
+        first = self._order('7.50', '15.00')
+        second = self._order('40.00')
+        pending = self._order('1.00', status=Order.STATUS_PENDING)
+        with scope(organizer=self.orga):
+            for order in (first, second, pending, first):
+                update_stats_on_payment(self.event, order=order)
+
+        stats = PWYCPriceStats.objects.get(item=self.ticket)
+        self.assertEqual(stats.count, 3)
+        self.assertEqual(stats.total, decimal.Decimal('62.50'))
+        self.assertEqual((stats.min_price, stats.max_price), (decimal.Decimal('7.50'), decimal.Decimal('40.00')))
+        self.assertEqual((stats.below_suggested, stats.at_suggested, stats.above_suggested), (1, 1, 1))
+        self.assertEqual(sum(stats.histogram), 3)
+        self.assertEqual(stats.histogram[HISTOGRAM_BOUNDS.index(40)], 1)
+        self.assertAlmostEqual(float(stats.mean), 62.5 / 3)
+        self.assertFalse(PWYCPriceStats.objects.filter(item=self.regular).exists())
+
+        second.status = Order.STATUS_CANCELED
+        with scope(organizer=self.orga):
+            update_stats_on_cancel(self.event, order=second)
+            update_stats_on_cancel(self.event, order=second)
+        stats = PWYCPriceStats.objects.get(item=self.ticket)
+        self.assertEqual(stats.count, 2)
+        self.assertEqual(stats.total, decimal.Decimal('22.50'))
+        self.assertEqual(stats.above_suggested, 0)
+        self.assertEqual(stats.histogram[HISTOGRAM_BOUNDS.index(40)], 0)
+
+    def test_rebuild(self):
+        """Test that rebuilding from scratch gives the same numbers as the incremental updates"""
+        orders = [self._order('7.50', '15.00'), self._order('40.00'), self._order('0.00')]
+        with scope(organizer=self.orga):
+            for order in orders:
+                update_stats_on_payment(self.event, order=order)
+        incremental = self._stats()
+
+        PWYCPriceStats.objects.all().delete()
+        out = StringIO()
+        call_command('pwyc_rebuild_stats', event='pwyc-test/pwyc-test-event', stdout=out)
+        self.assertIn('4 positions of 1 products', out.getvalue())
+        self.assertEqual(self._stats(), incremental)
+
+        # Orders counted by the rebuild are not counted again
+        with scope(organizer=self.orga):
+            update_stats_on_payment(self.event, order=orders[0])
+        self.assertEqual(self._stats(), incremental)
+
+    def test_variations(self):
+        """Test that excluded variations are neither counted nor uncounted, and variation amounts are used"""
+        with scope(organizer=self.orga):
+            excluded = self.ticket.variations.create(value='Excluded', default_price=50)
+            supporter = self.ticket.variations.create(value='Supporter')
+        PWYCVariationConfig.objects.bulk_create([
+            PWYCVariationConfig(event=self.event, item=self.ticket, variation=excluded, enabled=False),
+            PWYCVariationConfig(
+                event=self.event, item=self.ticket, variation=supporter, suggested_amount=decimal.Decimal('30.00'),
+            ),
+        ])
+        first = self._order('20.00')
+        second = self._order('10.00')
+        with scope(organizer=self.orga):
+            OrderPosition.objects.create(order=first, item=self.ticket, variation=excluded, price=50, positionid=3)
+            OrderPosition.objects.create(order=second, item=self.ticket, variation=excluded, price=50, positionid=3)
+            OrderPosition.objects.create(
+                order=second, item=self.ticket, variation=supporter, price=decimal.Decimal('20.00'), positionid=4
+            )
+            for order in (first, second):
+                update_stats_on_payment(self.event, order=order)
+        # 20 is above the item's suggestion of 15, but below the supporter's suggestion of 30
+        self.assertEqual(self._stats()[:2], (3, decimal.Decimal('50.00')))
+        self.assertEqual(self._stats()[5:], (2, 0, 1))
+
+        call_command('pwyc_rebuild_stats', stdout=StringIO())
+        self.assertEqual(self._stats()[:2], (3, decimal.Decimal('50.00')))
+        self.assertEqual(self._stats()[5:], (2, 0, 1))
+
+        second.status = Order.STATUS_CANCELED
+        with scope(organizer=self.orga):
+            update_stats_on_cancel(self.event, order=second)
+        stats = self._stats()
+        self.assertEqual((stats[0], stats[1], sum(stats[4])), (1, decimal.Decimal('20.00'), 1))
+        self.assertEqual(stats[5:], (0, 0, 1))
+
+    def test_dashboard_widget(self):
+        """Test that the dashboard widget is rendered from the aggregates only"""
+        with scope(organizer=self.orga):
+            update_stats_on_payment(self.event, order=self._order('7.50', '15.00'))
+
+            with self.assertNumQueries(1):
+                widgets = pwyc_dashboard_widget(self.event)
+        self.assertEqual(len(widgets), 1)
+        self.assertIn('Test Ticket', widgets[0]['content'])
+        self.assertIn('1 / 1 / 0', widgets[0]['content'])
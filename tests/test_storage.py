@@ -0,0 +1,328 @@
+import decimal
+import random
+import threading
+from datetime import timedelta
+
+from django.contrib.sessions.backends.db import SessionStore
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.utils.timezone import now
+from django_scopes import scope
+from pretix.base.models import CartPosition, Event, Item, Organizer
+
+from pretix_pwyc.models import PWYCCartPrice, PWYCItemConfig
+from pretix_pwyc.storage import CartPriceStore, SessionPriceStore, SignedCookiePriceStore
+
+
+class PriceStoreTest(TestCase):
+    def setUp(self):
+        self.orga = Organizer.objects.create(name='PWYC Test', slug='pwyc-test')
+        self.event = Event.objects.create(
+            organizer=self.orga,
+            name='PWYC Test Event',
+            slug='pwyc-test-event',
+            date_from='2030-01-01 10:00:00Z',
+            plugins='pretix_pwyc',
+        )
+        self.ticket = Item.objects.create(event=self.event, name='Test Ticket', default_price=10)
+        PWYCItemConfig.objects.create(event=self.event, item=self.ticket, enabled=True)
+
+    def _request(self):
+        request = RequestFactory().get('/')
+        request.session = SessionStore()
+        request.event = self.event
+        return request
+
+    def test_cart_store_applies_price_per_cart(self):
+        """Test that prices stored with the cart are applied to that cart's positions only"""
+        from pretix_pwyc.signals import apply_pwyc_price
+
+        PWYCCartPrice.objects.create(event=self.event, cart_id='cart-a', item=self.ticket, price=decimal.Decimal('7.50'))
+        with scope(organizer=self.orga):
+            positions = [
+                CartPosition.objects.create(
+                    event=self.event, cart_id=cart_id, item=self.ticket, price=10, expires=now() + timedelta(minutes=30)
+                )
+                for cart_id in ('cart-a', 'cart-b')
+            ]
+
+        with self.assertNumQueries(1):
+            prices = CartPriceStore(self.event).get_prices(None, {'cart-a', 'cart-b'})
+        self.assertEqual(prices, {(self.ticket.pk, None): decimal.Decimal('7.50')})
+
+        apply_pwyc_price(self.event, positions=positions[:1], invoice_address=None, request=None)
+        self.assertEqual(positions[0].price, decimal.Decimal('7.50'))
+
+    def test_price_written_to_cart(self):
+        """Test that prices are written onto cart positions once and read from there afterwards"""
+        import json
+        from pretix.presale.views.cart import get_or_create_cart_id
+        from pretix_pwyc.config import get_config_snapshot, request_cache
+        from pretix_pwyc.signals import apply_pwyc_price
+        from pretix_pwyc.views import PWYCSetPriceView
+
+        request = self._request()
+        cart_id = get_or_create_cart_id(request)
+        with scope(organizer=self.orga):
+            existing = CartPosition.objects.create(
+                event=self.event, cart_id=cart_id, item=self.ticket, price=10, listed_price=10,
+                price_after_voucher=10, expires=now() + timedelta(minutes=30)
+            )
+
+        post = RequestFactory().post('/pwyc/set-price/', data=json.dumps({
+            'prices': [{'item_id': self.ticket.pk, 'price': '7.50'}],
+        }), content_type='application/json')
+        post.session, post.event = request.session, self.event
+        with scope(organizer=self.orga):
+            response = PWYCSetPriceView.as_view()(post)
+        self.assertEqual(response.status_code, 200)
+        existing.refresh_from_db()
+        self.assertEqual(
+            (existing.price, existing.custom_price_input, existing.listed_price),
+            (decimal.Decimal('7.50'), decimal.Decimal('7.50'), decimal.Decimal('10.00'))
+        )
+
+        # A position added afterwards is priced on the first recalculation only
+        with scope(organizer=self.orga):
+            CartPosition.objects.create(
+                event=self.event, cart_id=cart_id, item=self.ticket, price=10, listed_price=10,
+                price_after_voucher=10, expires=now() + timedelta(minutes=30)
+            )
+            positions = list(CartPosition.objects.filter(cart_id=cart_id).order_by('pk'))
+            with request_cache():
+                get_config_snapshot(self.event)
+                # Stored prices of the new position and one batched update
+                with self.assertNumQueries(2):
+                    apply_pwyc_price(self.event, positions=positions, invoice_address=None, request=request)
+                with self.assertNumQueries(0):
+                    apply_pwyc_price(self.event, positions=positions, invoice_address=None, request=request)
+            self.assertEqual(
+                list(CartPosition.objects.filter(cart_id=cart_id).values_list('price', flat=True)),
+                [decimal.Decimal('7.50')] * 2
+            )
+
+    def test_cart_store_versions(self):
+        """Test that a stored price is only replaced by one chosen later"""
+        store = CartPriceStore(self.event)
+        request = self._request()
+        key = (self.ticket.pk, None)
+        self.assertEqual(
+            store.set_prices(request, HttpResponse(), {key: decimal.Decimal('8.00')}, {key: 2000}),
+            {key: decimal.Decimal('8.00')}
+        )
+        # A retried or overtaken request with an older price
+        self.assertEqual(store.set_prices(request, HttpResponse(), {key: decimal.Decimal('6.00')}, {key: 1000}), {})
+        self.assertEqual(store.get_prices(request), {key: decimal.Decimal('8.00')})
+        # Prices without version are versioned with the current time
+        store.set_prices(request, HttpResponse(), {key: decimal.Decimal('9.00')})
+        self.assertEqual(store.get_prices(request), {key: decimal.Decimal('9.00')})
+        self.assertEqual(PWYCCartPrice.objects.count(), 1)
+
+    def test_set_price_versions(self):
+        """Test that prices kept for a newer one are reported and client versions are clamped"""
+        import json
+        from pretix_pwyc.storage import new_price_version
+        from pretix_pwyc.views import PWYCSetPriceView
+
+        session = SessionStore()
+
+        def post(price, version):
+            request = RequestFactory().post('/pwyc/set-price/', data=json.dumps({'prices': [
+                {'item_id': self.ticket.pk, 'price': price, 'version': version},
+            ]}), content_type='application/json')
+            request.session, request.event = session, self.event
+            with scope(organizer=self.orga):
+                return json.loads(PWYCSetPriceView.as_view()(request).content)
+
+        # A clock far ahead cannot pin the price beyond the allowed skew
+        self.assertEqual(post('8.00', 2 ** 53 - 1), {'success': True, 'prices': {str(self.ticket.pk): 8.0}})
+        self.assertLessEqual(
+            PWYCCartPrice.objects.get().version, new_price_version() + PWYCSetPriceView.max_version_skew
+        )
+        self.assertEqual(post('6.00', 1000), {'success': True, 'prices': {}, 'rejected': [str(self.ticket.pk)]})
+        self.assertEqual(PWYCCartPrice.objects.get().price, decimal.Decimal('8.00'))
+
+        # A clock that runs behind still replaces prices chosen before the skew
+        PWYCCartPrice.objects.update(version=new_price_version() - 2 * PWYCSetPriceView.max_version_skew)
+        self.assertEqual(post('6.00', 1000), {'success': True, 'prices': {str(self.ticket.pk): 6.0}})
+
+    def test_cookie_store_roundtrip(self):
+        """Test that the signed cookie store needs no server-side state"""
+        store = SignedCookiePriceStore(self.event)
+        request = self._request()
+        response = HttpResponse()
+        store.set_prices(request, response, {(self.ticket.pk, None): decimal.Decimal('12.00')})
+
+        request = self._request()
+        request.COOKIES[store.cookie_name] = response.cookies[store.cookie_name].value
+        self.assertEqual(store.get_prices(request), {(self.ticket.pk, None): decimal.Decimal('12.00')})
+
+        request.COOKIES[store.cookie_name] = 'tampered' + response.cookies[store.cookie_name].value
+        self.assertEqual(store.get_prices(request), {})
+
+    def test_session_store_roundtrip(self):
+        """Test that the session store keeps all prices of an event in one entry"""
+        store = SessionPriceStore(self.event)
+        request = self._request()
+        store.set_prices(request, HttpResponse(), {(self.ticket.pk, None): decimal.Decimal('4.00')})
+        store.set_prices(request, HttpResponse(), {(self.ticket.pk, 3): decimal.Decimal('5.00')})
+        self.assertEqual(request.session[store.session_key], {str(self.ticket.pk): '4.00', f'{self.ticket.pk}_3': '5.00'})
+        self.assertEqual(store.get_prices(request), {
+            (self.ticket.pk, None): decimal.Decimal('4.00'),
+            (self.ticket.pk, 3): decimal.Decimal('5.00'),
+        })
+
+    def test_session_store_legacy_keys(self):
+        """Test that prices of sessions from before the entry per event are moved into it"""
+        store = SessionPriceStore(self.event)
+        request = self._request()
+        request.session[f'pwyc_price_{self.ticket.pk}'] = '6.00'
+        request.session[f'pwyc_price_{self.ticket.pk}_3'] = '7.00'
+        request.session['unrelated'] = 'value'
+
+        self.assertEqual(store.get_prices(request), {
+            (self.ticket.pk, None): decimal.Decimal('6.00'),
+            (self.ticket.pk, 3): decimal.Decimal('7.00'),
+        })
+        self.assertEqual(set(request.session.keys()), {store.session_key, 'unrelated'})
+
+    def test_session_store_ignores_unscoped_prices(self):
+        """Test that prices set through the retired URL without an event are not applied to events"""
+        store = SessionPriceStore(self.event)
+        request = self._request()
+        request.session['pwyc_prices'] = {str(self.ticket.pk): '1000.00'}
+        self.assertEqual(store.get_prices(request), {})
+
+        store.set_prices(request, HttpResponse(), {(self.ticket.pk, None): decimal.Decimal('4.00')})
+        self.assertEqual(store.get_prices(request), {(self.ticket.pk, None): decimal.Decimal('4.00')})
+
+    def test_order_meta(self):
+        """Test that the order metadata lists the original and chosen price of every PWYC position"""
+        from pretix.presale.views.cart import get_or_create_cart_id
+        from pretix_pwyc.signals import pwyc_order_meta
+
+        request = self._request()
+        cart_id = get_or_create_cart_id(request)
+        PWYCCartPrice.objects.create(event=self.event, cart_id=cart_id, item=self.ticket, price=decimal.Decimal('7.50'))
+        other = Item.objects.create(event=self.event, name='Regular Ticket', default_price=20)
+        with scope(organizer=self.orga):
+            for item in (self.ticket, other):
+                CartPosition.objects.create(
+                    event=self.event, cart_id=cart_id, item=item, price=item.default_price,
+                    listed_price=item.default_price, expires=now() + timedelta(minutes=30)
+                )
+
+            # Stored prices, configuration snapshot and cart positions
+            with self.assertNumQueries(3):
+                meta = pwyc_order_meta(self.event, request=request)
+        self.assertEqual(meta, {'pwyc': {
+            'prices': {str(self.ticket.pk): '7.50'},
+            'positions': [
+                {'item_id': self.ticket.pk, 'variation_id': None, 'original_price': '10.00', 'price': '7.50'},
+            ],
+        }})
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ConcurrentPriceTest(TransactionTestCase):
+    """
+    Writers in threads of their own, with database connections of their own, like concurrent
+    requests. SQLite's in-memory test database fails concurrent writes instead of waiting for
+    them, run with PostgreSQL or a file-based test database.
+    """
+    writers = 8
+
+    def setUp(self):
+        from django.db import connection
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            self.skipTest('The in-memory SQLite database does not support concurrent writers')
+        self.orga = Organizer.objects.create(name='PWYC Test', slug='pwyc-test')
+        self.event = Event.objects.create(
+            organizer=self.orga,
+            name='PWYC Test Event',
+            slug='pwyc-test-event',
+            date_from='2030-01-01 10:00:00Z',
+            plugins='pretix_pwyc',
+        )
+        self.items = [
+            Item.objects.create(event=self.event, name=f'Ticket {i}', default_price=10) for i in range(self.writers)
+        ]
+        for item in self.items:
+            PWYCItemConfig.objects.create(event=self.event, item=item, enabled=True)
+        self.session = SessionStore()
+        self.session.create()
+
+    def _tab(self):
+        """A request of another tab of the same customer, with its own copy of the session"""
+        request = RequestFactory().post('/')
+        request.session = SessionStore(self.session.session_key)
+        request.event = self.event
+        return request
+
+    def _run(self, writes):
+        """Run ``writes`` of ``(prices, versions)`` at the same time, each as a request of its own"""
+        from django.db import connection
+        from pretix_pwyc.config import get_config_snapshot
+        from pretix_pwyc.views import PWYCSetPriceView
+
+        snapshot = get_config_snapshot(self.event)
+        barrier = threading.Barrier(len(writes))
+        errors = []
+
+        def write(prices, versions):
+            try:
+                request = self._tab()
+                barrier.wait()
+                PWYCSetPriceView().save_prices(
+                    request, HttpResponse(), CartPriceStore(self.event), snapshot, prices, versions
+                )
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=write, args=w) for w in writes]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+
+    def _stored(self):
+        return {
+            item_id: (price, version)
+            for item_id, price, version in PWYCCartPrice.objects.values_list('item_id', 'price', 'version')
+        }
+
+    def test_different_prices(self):
+        """Test that tabs setting different prices of the same cart keep all of them"""
+        from pretix.presale.views.cart import get_or_create_cart_id
+        request = self._tab()
+        get_or_create_cart_id(request, create=True)
+        request.session.save()
+
+        self._run([
+            ({(item.pk, None): decimal.Decimal(i + 1)}, {}) for i, item in enumerate(self.items)
+        ])
+        self.assertEqual(
+            {item_id: price for item_id, (price, _) in self._stored().items()},
+            {item.pk: decimal.Decimal(i + 1) for i, item in enumerate(self.items)},
+        )
+
+    def test_same_price(self):
+        """Test that of concurrent writers of the same price, the one chosen last wins in any order"""
+        from pretix.presale.views.cart import get_or_create_cart_id
+        request = self._tab()
+        get_or_create_cart_id(request, create=True)
+        request.session.save()
+        item = self.items[0]
+
+        for attempt in range(5):
+            versions = list(range(1000 * attempt + 1, 1000 * attempt + 1 + self.writers))
+            random.shuffle(versions)
+            self._run([
+                ({(item.pk, None): decimal.Decimal(version)}, {(item.pk, None): version}) for version in versions
+            ])
+            newest = max(versions)
+            self.assertEqual(self._stored(), {item.pk: (decimal.Decimal(newest), newest)})
+        self.assertEqual(PWYCCartPrice.objects.count(), 1)